@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from telebot import apihelper, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+logger = logging.getLogger(__name__)
+
+
+class _Response:
+    """Ответ aiohttp в том виде, который ждет синхронный apihelper (как у requests)"""
+
+    def __init__(self, status_code, reason, text):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _query_value(value):
+    # requests передает True как "True", числа - строкой
+    return value if isinstance(value, str) else str(value)
+
+
+class AsyncLaneDispatcher:
+    """Полосы обработки апдейтов на asyncio - замена LaneDispatcher с тем же интерфейсом.
+
+    Цикл событий работает в отдельном потоке. Полоса - задача цикла со своей очередью:
+    апдейты одного пользователя (key(update) % lanes) обрабатываются по очереди, разных -
+    параллельно. Сам обработчик process(update) синхронный (SQLite, вызовы bot.*) и
+    выполняется в пуле из executor_workers потоков.
+
+    После start() все запросы синхронного TeleBot к Bot API уходят в цикл событий и
+    выполняются через общую сессию aiohttp AsyncTeleBot: потоки только ждут ответа,
+    соединения с Telegram мультиплексируются в одном цикле.
+    """
+
+    def __init__(self, process, key, lanes, lane_size, executor_workers):
+        self.process = process
+        self.key = key
+        self.lanes = lanes
+        self.lane_size = lane_size
+        self.executor = ThreadPoolExecutor(executor_workers, thread_name_prefix='handlers')
+        self.loop = None
+        self._queues = None
+        self._pending = 0
+        self._counters = [{'processed': 0, 'errors': 0, 'rejected': 0, 'max_depth': 0} for _ in range(lanes)]
+        self._lock = threading.Lock()
+        self._started = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run_loop, name='asyncio-runtime', daemon=True)
+            self._thread.start()
+        self._started.wait()
+        apihelper.CUSTOM_REQUEST_SENDER = self.request_sender
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._queues = [asyncio.Queue(self.lane_size) for _ in range(self.lanes)]
+        for lane in range(self.lanes):
+            self.loop.create_task(self._lane(lane))
+        self.loop.call_soon(self._started.set)
+        self.loop.run_forever()
+
+    def lane_of(self, update):
+        return hash(self.key(update)) % self.lanes
+
+    async def _put(self, update, block):
+        lane = self.lane_of(update)
+        updates = self._queues[lane]
+        if block:
+            await updates.put(update)
+        else:
+            try:
+                updates.put_nowait(update)
+            except asyncio.QueueFull:
+                with self._lock:
+                    self._counters[lane]['rejected'] += 1
+                return False
+        with self._lock:
+            self._pending += 1
+            counters = self._counters[lane]
+            counters['max_depth'] = max(counters['max_depth'], updates.qsize())
+        return True
+
+    def submit(self, update, block=True):
+        """Ставит апдейт в очередь его полосы. Если block=False и очередь полна, возвращает False"""
+        if self._thread is None:
+            self.start()
+        return asyncio.run_coroutine_threadsafe(self._put(update, block), self.loop).result()
+
+    async def _lane(self, lane):
+        updates = self._queues[lane]
+        while True:
+            update = await updates.get()
+            failed = False
+            try:
+                await self.loop.run_in_executor(self.executor, self.process, update)
+            except Exception as e:
+                failed = True
+                logger.error(f"Error processing update in lane {lane}: {e}")
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                    self._counters[lane]['processed'] += 1
+                    self._counters[lane]['errors'] += failed
+
+    def pending(self):
+        """Сколько принятых апдейтов еще не обработано"""
+        with self._lock:
+            return self._pending
+
+    def join(self, timeout):
+        """Ждет обработки принятых апдейтов не дольше timeout секунд. True - все обработаны"""
+        deadline = time.monotonic() + timeout
+        while self.pending():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def stats(self):
+        """Счетчики по полосам: глубина очереди сейчас и максимальная, обработано, ошибок, отклонено"""
+        with self._lock:
+            return [{
+                'lane': lane,
+                'depth': self._queues[lane].qsize() if self._queues else 0,
+                'max_depth': counters['max_depth'],
+                'processed': counters['processed'],
+                'errors': counters['errors'],
+                'rejected': counters['rejected'],
+            } for lane, counters in enumerate(self._counters)]
+
+    def request_sender(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """apihelper.CUSTOM_REQUEST_SENDER: выполняет запрос в цикле событий и ждет ответа"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("Synchronous Bot API call from the event loop thread")
+        return asyncio.run_coroutine_threadsafe(self._request(method, url, params, files, timeout), self.loop).result()
+
+    async def _request(self, method, url, params, files, timeout):
+        session = await asyncio_helper.session_manager.get_session()
+        query = {key: _query_value(value) for key, value in (params or {}).items() if value is not None}
+        data = None
+        if files:
+            data = aiohttp.FormData()
+            for name, value in files.items():
+                filename, file = value if isinstance(value, tuple) else (name, value)
+                data.add_field(name, file, filename=filename)
+        if isinstance(timeout, tuple):
+            client_timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        else:
+            client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with session.request(method, url, params=query, data=data, timeout=client_timeout) as response:
+            return _Response(response.status, response.reason, await response.text())
+
+    async def _poll(self, token, allowed_updates, timeout):
+        async_bot = AsyncTeleBot(token)
+        offset = None
+        error_delay = 1
+        while True:
+            try:
+                updates = await async_bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates,
+                                                      request_timeout=timeout + 10)
+                error_delay = 1
+            except Exception as e:
+                logger.error(f"Polling error: {e}")
+                await asyncio.sleep(error_delay)
+                error_delay = min(error_delay * 2, 60)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                await self._put(update, True)
+
+    def poll(self, token, allowed_updates, timeout):
+        """Long polling через AsyncTeleBot в цикле событий. Блокирует вызывающий поток"""
+        self.start()
+        asyncio.run_coroutine_threadsafe(self._poll(token, allowed_updates, timeout), self.loop).result()
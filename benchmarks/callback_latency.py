@@ -0,0 +1,147 @@
+"""Время ответа на нажатие кнопки и время обработки, p50/p99.
+
+Бот работает с временной базой и Bot API без сети: каждый запрос к API
+"идет" FAKE_API_LATENCY секунд. Ответ на нажатие - момент, когда ушел
+answerCallbackQuery, обработка - возврат из handle_callback.
+
+    python benchmarks/callback_latency.py [число нажатий на маршрут]
+"""
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bot-bench-'), 'nft_market.db')
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+from telebot import apihelper, types
+
+FAKE_API_LATENCY = float(os.environ.get('FAKE_API_LATENCY', '0.05'))
+USERS = 120
+SLOTS = 300
+
+answered = {}
+messages = {}
+answered_lock = threading.Lock()
+
+
+class FakeResponse:
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, result):
+        self.text = json.dumps({'ok': True, 'result': result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def fake_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    name = url.rsplit('/', 1)[-1]
+    time.sleep(FAKE_API_LATENCY)
+    if name == 'answerCallbackQuery':
+        with answered_lock:
+            answered[params['callback_query_id']] = time.perf_counter()
+    if name in ('sendMessage', 'sendPhoto'):
+        with answered_lock:
+            messages[name] = messages.get(name, 0) + 1
+    if name in ('sendMessage', 'sendPhoto', 'editMessageText'):
+        chat_id = int((params or {}).get('chat_id', 1))
+        return FakeResponse({'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': ''})
+    if name == 'getChatMember':
+        return FakeResponse({'user': {'id': 1, 'is_bot': False, 'first_name': 'U'}, 'status': 'member'})
+    if name == 'getMe':
+        return FakeResponse({'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'bot'})
+    return FakeResponse(True)
+
+
+apihelper.CUSTOM_REQUEST_SENDER = fake_request_sender
+
+import bot  # noqa: E402
+
+
+def seed():
+    connection = sqlite3.connect(os.environ['DB_PATH'])
+    for user_id in range(1000, 1000 + USERS):
+        connection.execute('INSERT OR IGNORE INTO users (user_id, username, full_name, balance) VALUES (?, ?, ?, ?)',
+                           (user_id, f'u{user_id}', f'User {user_id}', 100000))
+    for i in range(SLOTS):
+        connection.execute('''
+            INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (1000 + i % USERS, 'photo', f'NFT gift number {i}', 100 + i, '@contact'))
+    connection.commit()
+    connection.close()
+
+
+def make_call(call_id, user_id, data):
+    return types.CallbackQuery.de_json({
+        'id': call_id, 'chat_instance': 'bench', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'U'},
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': ''},
+    })
+
+
+def percentile(samples, point):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * point / 100))] * 1000
+
+
+def measure(name, calls):
+    acks, dones = [], []
+    sent_before = sum(messages.values())
+    for call in calls:
+        started = time.perf_counter()
+        bot.handle_callback(call)
+        dones.append(time.perf_counter() - started)
+        # Ответ маршрутов с ack= уходит из пула callback_ack_pool
+        deadline = time.perf_counter() + 5
+        while call.id not in answered and time.perf_counter() < deadline:
+            time.sleep(0.001)
+        acks.append(answered.get(call.id, float('inf')) - started)
+    # Сообщения уходят через очередь отправки, ждем, пока она опустеет
+    while bot.outbound.stats()['depth']:
+        time.sleep(0.01)
+    time.sleep(FAKE_API_LATENCY * 2)
+    print(f"{name:<22} n={len(calls):<4} "
+          f"ответ p50 {percentile(acks, 50):6.0f} p99 {percentile(acks, 99):6.0f} мс | "
+          f"обработка p50 {percentile(dones, 50):6.0f} p99 {percentile(dones, 99):6.0f} мс | "
+          f"сообщений {sum(messages.values()) - sent_before}")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    bot.init_db()
+    seed()
+    bot.listing_index.load()
+    print(f"Bot API: {FAKE_API_LATENCY * 1000:.0f} мс на запрос")
+
+    buyers = range(1000 + USERS // 2, 1000 + USERS)
+    measure('buy_ (ack=)', [
+        make_call(f'buy{i}', buyers[i % len(buyers)], f'buy_{i * 2 + 1}') for i in range(count)
+    ])
+    measure('slot_', [
+        make_call(f'slot{i}', 1000 + i % USERS, f'slot_{SLOTS - i}') for i in range(count)
+    ])
+    measure('back_to_main', [
+        make_call(f'main{i}', 1000 + i % USERS, 'back_to_main') for i in range(count)
+    ])
+    # Отказ обработчика: текст должен прийти ответом на нажатие, а не отдельным сообщением
+    measure('slot_ (нет слота)', [
+        make_call(f'missing{i}', 1000 + i % USERS, f'slot_{SLOTS * 10 + i}') for i in range(count)
+    ])
+
+    latency = bot.router.latency()
+    print(f"router.latency(): ответ p50 {latency['ack'][0]:.0f} p99 {latency['ack'][1]:.0f} мс, "
+          f"обработка p50 {latency['done'][0]:.0f} p99 {latency['done'][1]:.0f} мс")
+
+
+if __name__ == '__main__':
+    main()
+    os._exit(0)
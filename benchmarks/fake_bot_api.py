@@ -0,0 +1,76 @@
+"""Bot API без Telegram для нагрузочных замеров, каждый ответ через FAKE_API_LATENCY секунд.
+
+Сообщения "отправляются", getChatMember отвечает "member", chat_id 403 получает
+ошибку "bot was blocked by the user", остальные методы возвращают True.
+Отдельным процессом - aiohttp-сервер; request_sender - то же самое внутри
+процесса бота (apihelper.CUSTOM_REQUEST_SENDER).
+
+    python benchmarks/fake_bot_api.py [порт]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+from aiohttp import web
+
+FAKE_API_LATENCY = float(os.environ.get('FAKE_API_LATENCY', '0.05'))
+DEFAULT_PORT = 8765
+
+
+def _result(method, params):
+    """(HTTP-статус, тело ответа) на вызов method"""
+    if str(params.get('chat_id')) == '403':
+        return 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+    if method in ('sendMessage', 'sendPhoto', 'editMessageText'):
+        chat_id = int(params.get('chat_id', 1))
+        result = {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': ''}
+    elif method == 'getChatMember':
+        result = {'user': {'id': 1, 'is_bot': False, 'first_name': 'U'}, 'status': 'member'}
+    elif method == 'getMe':
+        result = {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'bot'}
+    else:
+        result = True
+    return 200, {'ok': True, 'result': result}
+
+
+async def handle(request):
+    await asyncio.sleep(FAKE_API_LATENCY)
+    params = dict(request.query)
+    if request.method == 'POST' and request.can_read_body:
+        try:
+            params.update(await request.post())
+        except ValueError:
+            pass
+    status, body = _result(request.match_info['method'], params)
+    return web.json_response(body, status=status)
+
+
+class FakeResponse:
+    reason = 'OK'
+
+    def __init__(self, status, body):
+        self.status_code = status
+        self.text = json.dumps(body)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    """Для apihelper.CUSTOM_REQUEST_SENDER: ответ без сети и без сервера"""
+    if FAKE_API_LATENCY:
+        time.sleep(FAKE_API_LATENCY)
+    return FakeResponse(*_result(url.rsplit('/', 1)[-1], params or {}))
+
+
+def make_app():
+    app = web.Application()
+    app.router.add_route('*', '/bot{token}/{method}', handle)
+    return app
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    web.run_app(make_app(), host='127.0.0.1', port=port, access_log=None, print=None)
@@ -0,0 +1,109 @@
+"""Пропускная способность обработчиков: handle_text и handle_callback в секунду, 1 и 8 потоков.
+
+Bot API без сети и без задержки (benchmarks/fake_bot_api.py), поэтому
+меряется работа самого бота: доступ к базе, клавиатуры, очередь отправки.
+200 пользователей, 500 слотов, UPDATES апдейтов каждого вида.
+
+Для сравнения "до/после" BOT_ROOT указывает на другую версию бота,
+например на git worktree нужного коммита:
+
+    python benchmarks/handler_throughput.py
+    BOT_ROOT=/tmp/bot-before python benchmarks/handler_throughput.py
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('FAKE_API_LATENCY', '0')
+
+ROOT = os.environ.get('BOT_ROOT') or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Старые версии держат базу в текущем каталоге, новые - по DB_PATH
+workdir = tempfile.mkdtemp(prefix='bot-bench-')
+os.chdir(workdir)
+os.environ['DB_PATH'] = os.path.join(workdir, 'nft_market.db')
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+from telebot import apihelper, types  # noqa: E402
+
+import fake_bot_api  # noqa: E402
+
+apihelper.CUSTOM_REQUEST_SENDER = fake_bot_api.request_sender
+
+import bot  # noqa: E402
+
+UPDATES = int(os.environ.get('UPDATES', '2000'))
+USERS = 200
+SLOTS = 500
+TEXTS = ['📊 Мой профиль', 'hello', '🔍 Найти слоты', '⬅️ Главное меню']
+
+
+def seed():
+    connection = sqlite3.connect(os.environ['DB_PATH'])
+    connection.executemany('INSERT OR IGNORE INTO users (user_id, username, full_name, balance) VALUES (?, ?, ?, 100000)',
+                           [(user_id, f'u{user_id}', f'User {user_id}') for user_id in range(1000, 1000 + USERS)])
+    connection.executemany('''
+        INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info) VALUES (?, ?, ?, ?, ?)
+    ''', [(1000 + i % USERS, 'photo', f'NFT gift number {i}', 100 + i, '@contact') for i in range(SLOTS)])
+    connection.commit()
+    connection.close()
+
+
+def make_message(user_id, text):
+    return types.Message.de_json({
+        'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'U', 'username': f'u{user_id}'}, 'text': text,
+    })
+
+
+def make_call(user_id, data):
+    return types.CallbackQuery.de_json({
+        'id': '1', 'chat_instance': 'bench', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'U'},
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': ''},
+    })
+
+
+def rate(handler, updates, threads):
+    """Апдейтов в секунду: updates делятся поровну между threads потоками"""
+    chunks = [updates[index::threads] for index in range(threads)]
+    workers = [threading.Thread(target=lambda chunk=chunk: [handler(update) for update in chunk]) for chunk in chunks]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return len(updates) / (time.perf_counter() - started)
+
+
+def main():
+    if hasattr(bot, 'init_db'):
+        bot.init_db()
+    seed()
+    if hasattr(bot, 'listing_index'):
+        bot.listing_index.load()
+    if hasattr(bot, 'outbound'):
+        # Меряется сам бот, а не лимиты Telegram
+        from ratelimit import TokenBucket
+        bot.outbound.global_limiter = TokenBucket(1e6, 1e6)
+        bot.outbound.chat_rate = bot.outbound.chat_burst = 1e6
+
+    messages = [make_message(1000 + i % USERS, TEXTS[i % len(TEXTS)]) for i in range(UPDATES)]
+    callbacks = [
+        make_call(1000 + i % USERS, ['back_to_main', f'slot_{1 + i % 400}', 'my_reviews', f'contact_{1 + i % 400}'][i % 4])
+        for i in range(UPDATES)
+    ]
+    print(f"бот: {ROOT}")
+    for threads in (1, 8):
+        text_rate = rate(bot.handle_text, messages, threads)
+        callback_rate = rate(bot.handle_callback, callbacks, threads)
+        print(f"потоков {threads}: handle_text {text_rate:8.0f}/с  handle_callback {callback_rate:8.0f}/с")
+
+
+if __name__ == '__main__':
+    main()
+    os._exit(0)
@@ -0,0 +1,96 @@
+"""Время и память на сообщение: клавиатура главного меню и проверка "это кнопка меню?".
+
+Было: ReplyKeyboardMarkup собирается и сериализуется при каждой отправке,
+список кнопок меню создается заново при каждой проверке. Стало: готовая
+JSON-строка из menus.reply_markup и frozenset подписей.
+
+Время - лучший из 5 прогонов по CALLS вызовов. Память - tracemalloc:
+пик за один вызов и сколько байт остается на вызов, если результат хранить.
+
+    python benchmarks/menu_allocations.py
+"""
+import gc
+import os
+import sys
+import timeit
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telebot.apihelper import _convert_markup  # noqa: E402
+from telebot.types import KeyboardButton, ReplyKeyboardMarkup  # noqa: E402
+
+from menus import reply_markup  # noqa: E402
+
+CALLS = int(os.environ.get('CALLS', '100000'))
+MAIN_MENU = ["🎁 Выставить NFT", "🔍 Найти слоты", "📊 Мой профиль", "🛒 Мои NFT", "📞 Поддержка"]
+MENU_LABELS = frozenset([
+    "🎁 Выставить NFT", "🔍 Найти слоты", "📊 Мой профиль", "🛒 Мои NFT",
+    "📞 Поддержка", "⬅️ Главное меню", "📊 Статистика", "📞 Тикеты",
+    "👥 Пользователи", "💳 Управление балансом", "💰 Заявки на вывод",
+    "🎁 Промокоды", "📢 Рассылка", "👑 Управление админами",
+])
+MAIN_MENU_MARKUP = reply_markup(MAIN_MENU)
+
+
+def build_menu():
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    keyboard.add(*(KeyboardButton(label) for label in MAIN_MENU))
+    return _convert_markup(keyboard)
+
+
+def cached_menu():
+    return _convert_markup(MAIN_MENU_MARKUP)
+
+
+def list_check(text='hello'):
+    menu_commands = ["🎁 Выставить NFT", "🔍 Найти слоты", "📊 Мой профиль", "🛒 Мои NFT",
+                     "📞 Поддержка", "⬅️ Главное меню", "📊 Статистика", "📞 Тикеты",
+                     "👥 Пользователи", "💳 Управление балансом", "💰 Заявки на вывод",
+                     "🎁 Промокоды", "📢 Рассылка", "👑 Управление админами"]
+    return text in menu_commands
+
+
+def frozenset_check(text='hello'):
+    return text in MENU_LABELS
+
+
+def best_ns(func):
+    return min(timeit.repeat(func, number=CALLS, repeat=5)) / CALLS * 1e9
+
+
+def peak_bytes(func):
+    """Пик памяти tracemalloc за один вызов (после прогрева)"""
+    func()
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def retained_bytes(func, calls=2000):
+    """Сколько байт на вызов остается занятым, если результаты хранить"""
+    func()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    results = [func() for _ in range(calls)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del results
+    return sum(stat.size_diff for stat in after.compare_to(before, 'lineno')) / calls
+
+
+def main():
+    # Кэш должен давать ровно тот же JSON, что и сборка клавиатуры
+    assert build_menu() == cached_menu()
+    for name, before, after in (('клавиатура меню', build_menu, cached_menu),
+                                ('проверка подписи', list_check, frozenset_check)):
+        print(f"{name:<18} было {best_ns(before):7.0f} нс, пик {peak_bytes(before):5d} Б, {retained_bytes(before):5.0f} Б/вызов | "
+              f"стало {best_ns(after):5.0f} нс, пик {peak_bytes(after):5d} Б, {retained_bytes(after):5.0f} Б/вызов")
+
+
+if __name__ == '__main__':
+    main()
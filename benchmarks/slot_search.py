@@ -0,0 +1,77 @@
+"""Время поиска по слотам (search_slots, FTS5), p50/p95, на LISTINGS активных слотах.
+
+Описания - по 6 случайных слов: частые ("мишка", "роза", ...) и редкие
+(w0..w2999), поэтому есть и широкие запросы на тысячи совпадений, и узкие.
+
+    LISTINGS=100000 python benchmarks/slot_search.py
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bot-bench-'), 'nft_market.db')
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+import bot  # noqa: E402
+
+LISTINGS = int(os.environ.get('LISTINGS', '100000'))
+SELLERS = 500
+RUNS = 200
+COMMON_WORDS = ['редкий', 'подарок', 'мишка', 'кольцо', 'звезда', 'ракета', 'торт', 'роза', 'кубок', 'сердце',
+                'plush', 'pepe', 'durov', 'cap', 'cat', 'lol', 'snoop', 'gem', 'diamond', 'vintage']
+WORDS = COMMON_WORDS + [f'w{i}' for i in range(3000)]
+QUERIES = ['мишка', 'w17', 'мишка роза', 'pepe durov cap', 'w1234', 'ра', 'несуществующее']
+
+
+def seed():
+    random.seed(1)
+    connection = sqlite3.connect(os.environ['DB_PATH'])
+    connection.executemany('INSERT OR IGNORE INTO users (user_id, username, balance) VALUES (?, ?, 0)',
+                           [(user_id, f'u{user_id}') for user_id in range(1000, 1000 + SELLERS)])
+    rows = []
+    for i in range(LISTINGS):
+        description = ' '.join(
+            random.choice(COMMON_WORDS) if random.random() < 0.3 else random.choice(WORDS) for _ in range(6)
+        )
+        rows.append((1000 + i % SELLERS, 'photo', description, random.randint(50, 50000), '@contact'))
+    connection.executemany('INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info) VALUES (?, ?, ?, ?, ?)', rows)
+    connection.commit()
+    active = connection.execute('SELECT COUNT(*) FROM slots WHERE is_active = TRUE').fetchone()[0]
+    connection.close()
+    return active
+
+
+def measure(viewer_id, text, offset=0):
+    bot.search_slots(viewer_id, text, offset)
+    samples = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        bot.search_slots(viewer_id, text, offset)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return samples[RUNS // 2] * 1000, samples[int(RUNS * 0.95)] * 1000
+
+
+def main():
+    bot.init_db()
+    print(f"активных слотов: {seed()}")
+    connection = sqlite3.connect(os.environ['DB_PATH'])
+    for text in QUERIES:
+        matches = connection.execute('SELECT COUNT(*) FROM slots_fts WHERE slots_fts MATCH ?',
+                                     (bot.build_search_query(text),)).fetchone()[0]
+        p50, p95 = measure(1000, text)
+        deep_p50, _ = measure(1000, text, 500)
+        print(f"{text:<16} совпадений {matches:6d}  p50 {p50:5.2f} мс  p95 {p95:5.2f} мс  "
+              f"смещение 500: p50 {deep_p50:5.2f} мс")
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
+    os._exit(0)
@@ -0,0 +1,121 @@
+"""Выбор обработчика состояния: цепочка elif (как было в handle_user_state) против реестра fsm.StateMachine.
+
+23 состояния, обработчики ничего не делают - меряется только поиск
+обработчика и разбор state_data (старый формат "a|b|c" против JSON).
+Лучший из 5 прогонов по CALLS вызовов.
+
+    python benchmarks/state_dispatch.py
+"""
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fsm import StateMachine  # noqa: E402
+
+CALLS = int(os.environ.get('CALLS', '200000'))
+STATES = [
+    'waiting_promocode', 'waiting_nft_photo', 'waiting_nft_description', 'waiting_nft_price',
+    'waiting_nft_contact', 'waiting_withdraw_card', 'waiting_withdraw_amount', 'waiting_name_change',
+    'waiting_support_message', 'waiting_admin_balance', 'waiting_admin_ban', 'waiting_admin_unban',
+    'waiting_reject_reason', 'waiting_ticket_reply', 'waiting_transfer_user', 'waiting_transfer_amount',
+    'waiting_rating', 'waiting_add_admin', 'waiting_remove_admin', 'waiting_promocode_name',
+    'waiting_promocode_amount', 'waiting_promocode_activations', 'waiting_broadcast_message',
+]
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+def elif_chain(state, state_data):
+    if state == STATES[0]:
+        noop()
+    elif state == STATES[1]:
+        noop()
+    elif state == STATES[2]:
+        noop({'photo_id': state_data})
+    elif state == STATES[3]:
+        noop({'photo_id': state_data.split('|')[0], 'description': state_data.split('|')[1]})
+    elif state == STATES[4]:
+        noop({'photo_id': state_data.split('|')[0], 'description': state_data.split('|')[1],
+              'price': state_data.split('|')[2]})
+    elif state == STATES[5]:
+        noop(float(state_data))
+    elif state == STATES[6]:
+        parts = state_data.split('|')
+        noop(float(parts[0]), parts[1])
+    elif state == STATES[7]:
+        noop()
+    elif state == STATES[8]:
+        noop()
+    elif state == STATES[9]:
+        noop(state_data)
+    elif state == STATES[10]:
+        noop()
+    elif state == STATES[11]:
+        noop()
+    elif state == STATES[12]:
+        noop(state_data)
+    elif state == STATES[13]:
+        noop(state_data)
+    elif state == STATES[14]:
+        noop()
+    elif state == STATES[15]:
+        noop(int(state_data.split('|')[0]))
+    elif state == STATES[16]:
+        parts = state_data.split('|')
+        noop(int(parts[0]), parts[1], int(parts[2]))
+    elif state == STATES[17]:
+        noop()
+    elif state == STATES[18]:
+        noop()
+    elif state == STATES[19]:
+        noop()
+    elif state == STATES[20]:
+        noop(state_data.split('|')[0])
+    elif state == STATES[21]:
+        parts = state_data.split('|')
+        noop(parts[0], float(parts[1]))
+    elif state == STATES[22]:
+        noop()
+
+
+fsm = StateMachine()
+for name in STATES:
+    fsm.state(name)(noop)
+fsm.state('waiting_nft_contact', photo_id=str, description=str, price=float)(noop)
+fsm.state('waiting_promocode_activations', code=str, amount=float)(noop)
+
+
+def registry(state, state_data):
+    entry, payload = fsm.resolve(state, state_data)
+    entry.handler(None, **payload)
+
+
+CASES = [
+    ('первое, без данных', 'waiting_promocode', None, None),
+    ('последнее, без данных', 'waiting_broadcast_message', None, None),
+    ('nft_contact, 3 поля', 'waiting_nft_contact', 'AgAD|Cool gift|250.0',
+     fsm.encode({'photo_id': 'AgAD', 'description': 'Cool gift', 'price': 250.0})),
+    ('promocode_activations', 'waiting_promocode_activations', 'GIFT|30.0',
+     fsm.encode({'code': 'GIFT', 'amount': 30.0})),
+]
+
+
+def best(func):
+    return min(timeit.repeat(func, number=CALLS, repeat=5)) / CALLS * 1e9
+
+
+def main():
+    print(f"{'состояние':<24} {'elif':>9} {'реестр':>9}")
+    for label, state, legacy_data, json_data in CASES:
+        chain_ns = best(lambda: elif_chain(state, legacy_data))
+        registry_ns = best(lambda: registry(state, json_data))
+        print(f"{label:<24} {chain_ns:6.0f} нс {registry_ns:6.0f} нс")
+
+
+if __name__ == '__main__':
+    main()
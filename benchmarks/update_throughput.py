@@ -0,0 +1,129 @@
+"""Апдейтов в секунду: полосы на потоках (BOT_RUNTIME=threads) против asyncio (BOT_RUNTIME=asyncio).
+
+Одни и те же апдейты идут через update_lanes.submit: половина - нажатия
+"back_to_main", половина - сообщения "🔍 Найти слоты", все от разных
+пользователей. Лимиты Telegram сняты, Bot API - benchmarks/fake_bot_api.py
+(по умолчанию 50 мс на запрос). Бот и сервер API закреплены на одном ядре
+(CPU), поэтому оба режима получают одинаковый процессор. CPU в отчете -
+время процесса бота на апдейт.
+
+    BOT_RUNTIME=threads UPDATE_LANES=8 python benchmarks/update_throughput.py
+    BOT_RUNTIME=asyncio UPDATE_LANES=64 OUTBOUND_WORKERS=64 python benchmarks/update_throughput.py
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bot-bench-'), 'nft_market.db')
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+UPDATES = int(os.environ.get('UPDATES', '1500'))
+OUTBOUND_WORKERS = os.environ.get('OUTBOUND_WORKERS')
+CPU = os.environ.get('CPU', '0')
+PORT = 8765
+SLOTS = 300
+
+if CPU and hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, {int(CPU)})
+
+# Сервер API наследует привязку к ядру
+api_server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_bot_api.py'), str(PORT)])
+
+import sqlite3  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+
+from telebot import apihelper, types  # noqa: E402
+
+apihelper.API_URL = f'http://127.0.0.1:{PORT}/bot{{0}}/{{1}}'
+
+import bot  # noqa: E402
+from ratelimit import TokenBucket  # noqa: E402
+
+
+def wait_for_api(timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', PORT), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('fake Bot API did not start')
+
+
+def seed(user_ids):
+    connection = sqlite3.connect(os.environ['DB_PATH'])
+    connection.executemany('INSERT OR IGNORE INTO users (user_id, username, full_name, balance) VALUES (?, ?, ?, 100000)',
+                           [(user_id, f'u{user_id}', f'User {user_id}') for user_id in user_ids])
+    connection.executemany('''
+        INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info) VALUES (?, ?, ?, ?, ?)
+    ''', [(user_ids[i % len(user_ids)], 'photo', f'NFT gift number {i}', 100 + i, '@contact') for i in range(SLOTS)])
+    connection.commit()
+    connection.close()
+
+
+def make_update(update_id, user_id):
+    sender = {'id': user_id, 'is_bot': False, 'first_name': 'U', 'username': f'u{user_id}'}
+    chat = {'id': user_id, 'type': 'private'}
+    if update_id % 2:
+        return types.Update.de_json({'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': 0, 'chat': chat, 'from': sender, 'text': '🔍 Найти слоты'}})
+    return types.Update.de_json({'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'chat_instance': 'bench', 'data': 'back_to_main', 'from': sender,
+        'message': {'message_id': 1, 'date': 0, 'chat': chat, 'text': ''}}})
+
+
+def main():
+    wait_for_api()
+    bot.init_db()
+    user_ids = list(range(1000, 1000 + UPDATES + 1))
+    seed(user_ids)
+    bot.listing_index.load()
+    for user_id in user_ids:
+        bot.subscription_cache.set(user_id, True)
+
+    # Меряется сам бот, а не лимиты Telegram
+    bot.outbound.global_limiter = TokenBucket(1e6, 1e6)
+    bot.outbound.chat_rate = bot.outbound.chat_burst = 1e6
+    if OUTBOUND_WORKERS:
+        bot.outbound.workers = int(OUTBOUND_WORKERS)
+        bot.callback_ack_pool = ThreadPoolExecutor(int(OUTBOUND_WORKERS), thread_name_prefix='callback-ack')
+
+    updates = [make_update(update_id, user_id) for update_id, user_id in enumerate(user_ids, 1)]
+    bot.update_lanes.start()
+    # Прогрев: соединения, кэши
+    bot.update_lanes.submit(updates[0])
+    bot.update_lanes.join(30)
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    for update in updates[1:]:
+        bot.update_lanes.submit(update)
+    bot.update_lanes.join(600)
+    # Ждем, пока уйдут ответы
+    while bot.outbound.stats()['depth']:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+
+    count = len(updates) - 1
+    reply = bot.outbound.stats()['priorities']['reply']
+    print(f"{bot.BOT_RUNTIME:<8} полос {bot.UPDATE_LANES:<3} отправителей {bot.outbound.workers:<3} "
+          f"{count} апдейтов: {count / elapsed:6.0f} апд/с, CPU {cpu * 1000 / count:.2f} мс на апдейт "
+          f"({cpu / elapsed * 100:.0f}% ядра), отправлено {reply['sent']}, ошибок {reply['failed']}, "
+          f"потоков {threading.active_count()}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        api_server.terminate()
+    os._exit(0)
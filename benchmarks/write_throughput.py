@@ -0,0 +1,93 @@
+"""Пропускная способность записи: транзакция на каждую запись (db_write)
+против группового коммита пишущего потока (db_submit / db_execute).
+
+Пишут 1, 8 и 32 потока; каждая запись - UPDATE одной строки users, как
+отметка подписки. Режимы: db_write, db_execute с ожиданием коммита
+(.result()) и db_execute без ожидания.
+
+    SYNC=FULL WRITES=6000 python benchmarks/write_throughput.py
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bot-bench-'), 'nft_market.db')
+
+import db  # noqa: E402
+
+SYNC = os.environ.get('SYNC', 'NORMAL')
+WRITES = int(os.environ.get('WRITES', '6000'))
+USERS = 10000
+THREADS = (1, 8, 32)
+
+SQL = 'UPDATE users SET has_subscribed = ?, subscription_checked_at = ? WHERE user_id = ?'
+
+
+def setup():
+    db.PRAGMAS = tuple(
+        f"PRAGMA synchronous={SYNC}" if 'synchronous' in pragma else pragma for pragma in db.PRAGMAS
+    )
+    with db.db_write() as cursor:
+        cursor.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, has_subscribed BOOLEAN, subscription_checked_at REAL)')
+        cursor.executemany('INSERT INTO users VALUES (?, 0, 0)', [(user_id,) for user_id in range(USERS)])
+
+
+def write(mode, user_id, value):
+    if mode == 'db_write':
+        with db.db_write() as cursor:
+            cursor.execute(SQL, (value, time.time(), user_id))
+    elif mode == 'wait':
+        db.db_execute(SQL, (value, time.time(), user_id)).result()
+    else:
+        db.db_execute(SQL, (value, time.time(), user_id))
+
+
+def run(mode, threads):
+    per_thread = WRITES // threads
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(index):
+        samples = []
+        for i in range(per_thread):
+            started = time.perf_counter()
+            write(mode, (index * per_thread + i) % USERS, i % 2)
+            samples.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(samples)
+
+    groups = db.writer_stats()['groups']
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if mode != 'db_write':
+        db.db_flush()
+    elapsed = time.perf_counter() - started
+
+    writes = per_thread * threads
+    commits = writes if mode == 'db_write' else db.writer_stats()['groups'] - groups
+    latencies.sort()
+    print(f"{mode:<16} потоков {threads:<3} {writes / elapsed:8.0f} записей/с  "
+          f"p50 {latencies[len(latencies) // 2] * 1000:6.2f} мс  "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.2f} мс  коммитов {commits}")
+
+
+def main():
+    setup()
+    print(f"synchronous={SYNC}, {WRITES} записей на замер")
+    for threads in THREADS:
+        for mode in ('db_write', 'wait', 'fire-and-forget'):
+            run(mode, threads)
+
+
+if __name__ == '__main__':
+    main()
+    os._exit(0)
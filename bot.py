@@ -1,10 +1,33 @@
 ﻿import os
+import re
+import sys
+import hmac
+import time
+import atexit
+import hashlib
+import signal
 import logging
 import sqlite3
 import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from flask import Flask
-from threading import Thread
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from flask import Flask, request, abort
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor
+from db import db_read, db_write, db_submit, db_execute, db_flush, writer_stats
+from cache import TTLCache
+from state_store import StateStore
+from fsm import StateMachine
+from router import CallbackRouter
+from menus import MenuRegistry, reply_markup, inline_markup
+from listing_index import ListingIndex
+from ratelimit import TokenBucket
+from broadcast import Broadcast
+from telegram_errors import classify_error, retry_after, member_not_found, BLOCKED, RATE_LIMITED, UNDELIVERABLE
+from outbound import OutboundQueue, QueuedTeleBot, URGENT, BULK
+from dispatcher import LaneDispatcher
+from async_runtime import AsyncLaneDispatcher
+import ledger
+from ledger import ESCROW, WITHDRAWALS, PAYOUTS, DEPOSITS, PROMOCODES
 
 # Веб-сервер для здоровья приложения на Railway
 app = Flask('')
@@ -13,11 +36,17 @@ app = Flask('')
 def home():
     return "🤖 NFT Marketplace Bot is running!"
 
+# Апдейты от Telegram в режиме вебхука (см. receive_webhook_update)
+@app.route('/webhook/<secret>', methods=['POST'])
+def webhook(secret):
+    return receive_webhook_update(secret)
+
 def run():
     app.run(host='0.0.0.0', port=8080)
 
 def keep_alive():
-    t = Thread(target=run)
+    # Фоновый поток, чтобы не мешать завершению процесса по SIGTERM
+    t = Thread(target=run, daemon=True)
     t.start()
 
 # Запускаем веб-сервер
@@ -41,14 +70,128 @@ ADMINS = [ADMIN_ID]  # Список админов
 REQUIRED_CHANNEL = "@GetGemsNFTseller"
 CHANNEL_ID = "@GetGemsNFTseller"  # ID канала
 
-# Создаем бота
-bot = telebot.TeleBot(BOT_TOKEN)
+# Кэш проверок подписки (TTL в секундах)
+SUBSCRIPTION_CACHE_SIZE = 10000
+SUBSCRIPTION_TTL = 600
+SUBSCRIPTION_NEGATIVE_TTL = 30
+
+# Кэш состояний пользователей: размер и период сброса в базу (0 - писать сразу)
+STATE_CACHE_SIZE = 50000
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "1"))
+
+# Фоновая сверка подписок: как часто, сколько за раз и какие записи считать устаревшими.
+# Пока есть устаревшие записи, пачки идут одна за другой с паузой DELAY между запросами:
+# не больше 1 / DELAY проверок в секунду (172 800 в сутки при 0.5). Если пользователей
+# больше, чем успевает за STALE_AFTER, записи устаревают сильнее - уменьшите DELAY
+SUBSCRIPTION_RECONCILE_INTERVAL = 60
+SUBSCRIPTION_RECONCILE_BATCH = 20
+SUBSCRIPTION_RECONCILE_DELAY = 0.5
+SUBSCRIPTION_STALE_AFTER = 24 * 60 * 60
+
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
+
+# Сколько слотов показывать на одной странице поиска
+SLOTS_PAGE_SIZE = 10
+
+# Сортировки списка слотов: код -> (название, ключ keyset-пагинации, направление, индекс).
+# Последний столбец ключа - slot_id, он делает ключ уникальным. Индекс задан явно, чтобы
+# страница всегда читалась по порядку сортировки, без сортировки во временном дереве
+SLOT_SORTS = {
+    'n': ("🆕 Сначала новые", ('s.slot_id',), 'DESC', 'idx_slots_active_newest'),
+    'p': ("💰 Сначала дешевые", ('s.price_rub', 's.slot_id'), 'ASC', 'idx_slots_active_price'),
+    'r': ("⭐ По рейтингу продавца", ('s.seller_rating', 's.slot_id'), 'DESC', 'idx_slots_active_rating'),
+}
+DEFAULT_SLOT_SORT = 'n'
+
+# Ценовые диапазоны фильтра: (от, до, название); None - без границы
+PRICE_BANDS = [
+    (None, None, "Любая цена"),
+    (None, 500, "до 500 руб"),
+    (500, 2000, "500 - 2 000 руб"),
+    (2000, 10000, "2 000 - 10 000 руб"),
+    (10000, None, "от 10 000 руб"),
+]
+
+# Индекс активных слотов в памяти: как часто сверять его с базой
+LISTING_INDEX_CHECK_INTERVAL = 300
+
+# Полнотекстовый поиск: сколько самых свежих совпадений ранжировать и сколько слов запроса учитывать
+SEARCH_CANDIDATES = 1000
+SEARCH_MAX_TERMS = 8
+
+# Рассылка: скорость (общий лимит Telegram ~30 сообщений в секунду), число потоков
+# отправки, размер пачки получателей и как часто обновлять сообщение с прогрессом.
+# После каждой пачки позиция сохраняется в broadcast_jobs: при перезапуске заново
+# отправится не больше одной пачки
+BROADCAST_RATE = 25
+BROADCAST_WORKERS = 4
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_PROGRESS_INTERVAL = 3
+
+# Очередь исходящих сообщений: общий лимит Telegram ~30 сообщений в секунду, в один чат -
+# около одного в секунду (короткие всплески допустимы), число потоков отправки и размер очереди
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_CHAT_RATE = 1
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_WORKERS = 8
+OUTBOUND_QUEUE_SIZE = 10000
+
+# Outbox уведомлений о сделках: размер пачки, как часто проверять без сигнала, сколько раз
+# и с какой базовой задержкой (удваивается) повторять, сколько дней хранить отправленные
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_INTERVAL = 1
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_DELAY = 5
+OUTBOX_RETENTION_DAYS = 7
+
+# Журнал денег: как часто снимать балансы счетов и сверять их с users.balance
+LEDGER_SNAPSHOT_INTERVAL = 300
+
+# Просроченные сделки: NFT не отправлен за ESCROW_SEND_TIMEOUT_HOURS от покупки - сделка
+# отменяется; получение не подтверждено за ESCROW_CONFIRM_TIMEOUT_HOURS от отправки -
+# завершается. Проверка раз в ESCROW_SWEEP_INTERVAL секунд, не больше ESCROW_SWEEP_BATCH
+# сделок каждого вида за раз
+ESCROW_SEND_TIMEOUT_HOURS = 48
+ESCROW_CONFIRM_TIMEOUT_HOURS = 72
+ESCROW_SWEEP_INTERVAL = 60
+ESCROW_SWEEP_BATCH = 50
+
+# Сколько потоков отвечают на нажатия кнопок с ack= (answer_callback_query), пока работают обработчики
+CALLBACK_ACK_WORKERS = 4
+
+# Типы апдейтов, которые обрабатывает бот (my_chat_member - пользователь заблокировал или разблокировал бота)
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_member', 'my_chat_member']
+
+# Обработка апдейтов: число полос (апдейты одного пользователя идут по очереди в одной полосе,
+# разных - параллельно) и размер очереди каждой полосы. Таймаут long polling, секунд
+UPDATE_LANES = int(os.environ.get("UPDATE_LANES", "8"))
+UPDATE_LANE_SIZE = 200
+POLLING_TIMEOUT = 20
+
+# Среда выполнения: "threads" - полосы на потоках, запросы к Bot API через requests;
+# "asyncio" - прием апдейтов и все запросы к Bot API в одном цикле событий (AsyncTeleBot, aiohttp),
+# обработчики - в отдельном пуле потоков
+BOT_RUNTIME = os.environ.get("BOT_RUNTIME", "threads")
+
+# Вебхук вместо long polling включается переменной WEBHOOK_URL - публичный адрес приложения
+# (например, https://bot.up.railway.app). Секрет - часть пути и заголовок X-Telegram-Bot-Api-Secret-Token;
+# по умолчанию выводится из токена, чтобы у всех реплик он совпадал.
+# Если очередь полосы переполнена, Telegram получает 503 и повторит доставку.
+# При остановке принятые апдейты дообрабатываются не дольше WEBHOOK_DRAIN_TIMEOUT секунд
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_DRAIN_TIMEOUT = 10
+
+# Создаем бота: send_message, send_photo и edit_message_text идут через очередь отправки.
+# Обработчики выполняют полосы update_lanes, свой пул потоков боту не нужен
+outbound = OutboundQueue(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+                         OUTBOUND_WORKERS, OUTBOUND_QUEUE_SIZE)
+bot = QueuedTeleBot(BOT_TOKEN, outbound, threaded=False)
+callback_ack_pool = ThreadPoolExecutor(CALLBACK_ACK_WORKERS, thread_name_prefix='callback-ack')
 
 # Инициализация базы данных
 def init_db():
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
     tables = {
         'user_states': '''
             CREATE TABLE IF NOT EXISTS user_states (
@@ -74,7 +217,9 @@ def init_db():
                 balance REAL DEFAULT 0,
                 is_banned BOOLEAN DEFAULT FALSE,
                 is_admin BOOLEAN DEFAULT FALSE,
-                has_subscribed BOOLEAN DEFAULT FALSE
+                has_subscribed BOOLEAN DEFAULT FALSE,
+                subscription_checked_at REAL,
+                delivery_status TEXT DEFAULT 'ok'
             )
         ''',
         'slots': '''
@@ -87,6 +232,7 @@ def init_db():
                 contact_info TEXT,
                 is_active BOOLEAN DEFAULT TRUE,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                seller_rating REAL DEFAULT 0,
                 FOREIGN KEY (seller_id) REFERENCES users (user_id)
             )
         ''',
@@ -100,6 +246,7 @@ def init_db():
                 status TEXT DEFAULT 'pending',
                 nft_sent BOOLEAN DEFAULT FALSE,
                 nft_received BOOLEAN DEFAULT FALSE,
+                sent_at TIMESTAMP,
                 buyer_rated BOOLEAN DEFAULT FALSE,
                 seller_rated BOOLEAN DEFAULT FALSE,
                 buyer_rating INTEGER DEFAULT 0,
@@ -127,6 +274,7 @@ def init_db():
                 FOREIGN KEY (purchase_id) REFERENCES purchases (purchase_id)
             )
         ''',
+        # Старая история операций; деньги учитываются в журнале ledger (ledger.py)
         'transactions': '''
             CREATE TABLE IF NOT EXISTS transactions (
                 transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -182,154 +330,403 @@ def init_db():
                 FOREIGN KEY (promocode_id) REFERENCES promocodes (promocode_id),
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
+        ''',
+        # Рассылки: last_user_id - до какого получателя (по возрастанию user_id) все отправлено
+        'broadcast_jobs': '''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER,
+                chat_id INTEGER,
+                status_message_id INTEGER,
+                text TEXT,
+                status TEXT DEFAULT 'running',
+                last_user_id INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                delivered INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        # Уведомления, записанные в одной транзакции с изменением сделки; отправляет outbox_relay
+        'outbox': '''
+            CREATE TABLE IF NOT EXISTS outbox (
+                outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                text TEXT,
+                reply_markup TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        '''
+    }
+    
+    indexes = [
+        'CREATE INDEX IF NOT EXISTS idx_users_subscription_checked ON users (subscription_checked_at)',
+        # Получатели рассылки выбираются по delivery_status = 'ok' в порядке user_id
+        'CREATE INDEX IF NOT EXISTS idx_users_delivery ON users (delivery_status, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_slots_seller ON slots (seller_id)',
+        'CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status)',
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (outbox_id) WHERE status = 'pending'",
+        # Просроченные сделки ищутся по статусу от самых старых
+        'CREATE INDEX IF NOT EXISTS idx_purchases_status_created ON purchases (status, created_at)',
+        # Отправленные, но не подтвержденные сделки - по времени отправки
+        'CREATE INDEX IF NOT EXISTS idx_purchases_sent ON purchases (status, nft_sent, sent_at)',
+        # Покрывающие индексы для каждой сортировки списка слотов (только активные слоты);
+        # idx_slots_active заменен idx_slots_active_newest
+        'DROP INDEX IF EXISTS idx_slots_active',
+        'CREATE INDEX IF NOT EXISTS idx_slots_active_newest ON slots (slot_id, price_rub, seller_id) WHERE is_active = TRUE',
+        'CREATE INDEX IF NOT EXISTS idx_slots_active_price ON slots (price_rub, slot_id, seller_id) WHERE is_active = TRUE',
+        'CREATE INDEX IF NOT EXISTS idx_slots_active_rating ON slots (seller_rating, slot_id, price_rub, seller_id) WHERE is_active = TRUE',
+    ]
+    
+    # Триггеры денормализованных данных: slots_fts и рейтинг продавца в slots
+    triggers = [
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_fts_insert AFTER INSERT ON slots WHEN new.is_active BEGIN
+                INSERT INTO slots_fts (rowid, description) VALUES (new.slot_id, new.description);
+            END
+        ''',
         '''
+            CREATE TRIGGER IF NOT EXISTS slots_fts_delete AFTER DELETE ON slots WHEN old.is_active BEGIN
+                INSERT INTO slots_fts (slots_fts, rowid, description) VALUES ('delete', old.slot_id, old.description);
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_fts_update AFTER UPDATE OF is_active, description ON slots BEGIN
+                INSERT INTO slots_fts (slots_fts, rowid, description)
+                    SELECT 'delete', old.slot_id, old.description WHERE old.is_active;
+                INSERT INTO slots_fts (rowid, description)
+                    SELECT new.slot_id, new.description WHERE new.is_active;
+            END
+        ''',
+        # Рейтинг продавца копируется в slots.seller_rating, чтобы сортировать по нему по индексу
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_seller_rating_insert AFTER INSERT ON slots BEGIN
+                UPDATE slots SET seller_rating = COALESCE((SELECT rating_seller FROM users WHERE user_id = new.seller_id), 0)
+                WHERE slot_id = new.slot_id;
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS users_seller_rating_update AFTER UPDATE OF rating_seller ON users BEGIN
+                UPDATE slots SET seller_rating = COALESCE(new.rating_seller, 0) WHERE seller_id = new.user_id;
+            END
+        ''',
+    ]
+    
+    # Колонки, добавленные после создания таблиц (для существующих баз)
+    columns = {
+        'users': {
+            'subscription_checked_at': 'REAL',
+            'delivery_status': "TEXT DEFAULT 'ok'",
+        },
+        'slots': {
+            'seller_rating': 'REAL DEFAULT 0',
+        },
+        'purchases': {
+            'sent_at': 'TIMESTAMP',
+        },
     }
     
-    for table_name, table_sql in tables.items():
-        cursor.execute(table_sql)
+    # Заполнение добавленных колонок по уже существующим строкам
+    backfills = {
+        ('slots', 'seller_rating'):
+            'UPDATE slots SET seller_rating = COALESCE((SELECT rating_seller FROM users WHERE user_id = slots.seller_id), 0)',
+        # Время отправки уже отправленных сделок неизвестно: срок подтверждения считаем с миграции
+        ('purchases', 'sent_at'):
+            "UPDATE purchases SET sent_at = CURRENT_TIMESTAMP WHERE status = 'pending' AND nft_sent = TRUE",
+    }
     
-    # Добавляем основного админа если его нет
-    cursor.execute('SELECT is_admin FROM users WHERE user_id = ?', (ADMIN_ID,))
-    admin_exists = cursor.fetchone()
-    if not admin_exists:
-        cursor.execute('INSERT OR REPLACE INTO users (user_id, username, full_name, is_admin) VALUES (?, ?, ?, ?)',
-                     (ADMIN_ID, "Admin", "Administrator", True))
+    with db_write() as cursor:
+        for table_name, table_sql in tables.items():
+            cursor.execute(table_sql)
+        
+        for table_name, table_columns in columns.items():
+            cursor.execute(f'PRAGMA table_info({table_name})')
+            existing = {row[1] for row in cursor.fetchall()}
+            for column, column_type in table_columns.items():
+                if column not in existing:
+                    cursor.execute(f'ALTER TABLE {table_name} ADD COLUMN {column} {column_type}')
+                    if (table_name, column) in backfills:
+                        cursor.execute(backfills[(table_name, column)])
+        
+        for index_sql in indexes:
+            cursor.execute(index_sql)
+        
+        # Полнотекстовый индекс описаний активных слотов; при первом создании заполняем его
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'slots_fts'")
+        fts_exists = cursor.fetchone()
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS slots_fts USING fts5(
+                description,
+                content='slots', content_rowid='slot_id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+        ''')
+        if not fts_exists:
+            cursor.execute('INSERT INTO slots_fts (rowid, description) SELECT slot_id, description FROM slots WHERE is_active = TRUE')
+        
+        for trigger_sql in triggers:
+            cursor.execute(trigger_sql)
+        
+        # Журнал денег; users.balance - его проекция
+        ledger.create_schema(cursor)
+        
+        # Добавляем основного админа если его нет
+        cursor.execute('SELECT is_admin FROM users WHERE user_id = ?', (ADMIN_ID,))
+        admin_exists = cursor.fetchone()
+        if not admin_exists:
+            cursor.execute('INSERT OR REPLACE INTO users (user_id, username, full_name, is_admin) VALUES (?, ?, ?, ?)',
+                         (ADMIN_ID, "Admin", "Administrator", True))
     
-    conn.commit()
-    conn.close()
     logger.info("✅ База данных инициализирована")
 
 # Функция проверки подписки на канал
-def check_subscription(user_id):
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_TTL, SUBSCRIPTION_NEGATIVE_TTL)
+
+def fetch_subscription(user_id):
+    """Спрашивает статус у Telegram и сохраняет его в users.has_subscribed"""
+    chat_member = bot.get_chat_member(CHANNEL_ID, user_id)
+    status = chat_member.status in SUBSCRIBED_STATUSES
+    update_user_subscription(user_id, status)
+    return status
+
+def load_subscription(user_id):
+    """Статус из users.has_subscribed (его поддерживают события chat_member и сверка).
+    
+    В Telegram идем только если статус пользователя еще ни разу не проверялся.
+    """
+    with db_read() as cursor:
+        cursor.execute('SELECT has_subscribed, subscription_checked_at FROM users WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+    
+    if row and row[1] is not None:
+        return bool(row[0])
+    return fetch_subscription(user_id)
+
+def check_subscription(user_id, fresh=False):
     try:
-        chat_member = bot.get_chat_member(CHANNEL_ID, user_id)
-        return chat_member.status in ['member', 'administrator', 'creator']
+        if fresh:
+            subscription_cache.invalidate(user_id)
+            return subscription_cache.get(user_id, fetch_subscription)
+        return subscription_cache.get(user_id, load_subscription)
     except Exception as e:
         logger.error(f"Error checking subscription: {e}")
         return False
 
+# События вступления/выхода из канала (бот должен быть админом канала)
+@bot.chat_member_handler(func=lambda update: update.chat.username and f"@{update.chat.username}" == REQUIRED_CHANNEL)
+def handle_channel_member(update):
+    user_id = update.new_chat_member.user.id
+    status = update.new_chat_member.status in SUBSCRIBED_STATUSES
+    update_user_subscription(user_id, status)
+    subscription_cache.set(user_id, status)
+
+@bot.my_chat_member_handler(func=lambda update: update.chat.type == 'private')
+def handle_bot_blocked(update):
+    # kicked - пользователь заблокировал бота, member - разблокировал
+    status = BLOCKED if update.new_chat_member.status == 'kicked' else 'ok'
+    set_delivery_status(update.chat.id, status)
+
+def reconcile_subscriptions():
+    """Перепроверяет пачку самых давно проверенных статусов подписки.
+    
+    Не подписанным пользователь считается только по ответу Telegram (в том числе
+    "user not found"). На 429 ждем retry_after и повторяем; на прочих ошибках
+    (бот не админ канала, канал не найден) пачка прерывается без записи.
+    Возвращает, сколько статусов проверено.
+    """
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT user_id FROM users
+            WHERE subscription_checked_at IS NULL OR subscription_checked_at < ?
+            ORDER BY subscription_checked_at
+            LIMIT ?
+        ''', (time.time() - SUBSCRIPTION_STALE_AFTER, SUBSCRIPTION_RECONCILE_BATCH))
+        user_ids = [row[0] for row in cursor.fetchall()]
+    
+    checked = 0
+    for user_id in user_ids:
+        while True:
+            try:
+                subscription_cache.set(user_id, fetch_subscription(user_id))
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is not None:
+                    logger.warning(f"Subscription reconcile rate limited, sleeping {delay}s")
+                    time.sleep(delay)
+                    continue
+                if not member_not_found(e):
+                    logger.error(f"Error reconciling subscriptions, batch aborted: {e}")
+                    return checked
+                update_user_subscription(user_id, False)
+                subscription_cache.set(user_id, False)
+            break
+        checked += 1
+        time.sleep(SUBSCRIPTION_RECONCILE_DELAY)
+    return checked
+
+def subscription_reconciler():
+    while True:
+        time.sleep(SUBSCRIPTION_RECONCILE_INTERVAL)
+        try:
+            # Полная пачка - устаревшие записи могли остаться, берем следующую
+            while reconcile_subscriptions() == SUBSCRIPTION_RECONCILE_BATCH:
+                pass
+        except Exception as e:
+            logger.error(f"Error in subscription reconciler: {e}")
+
 # Функция для показа сообщения о необходимости подписки
 def show_subscription_required(chat_id):
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("📢 Подписаться на канал", url=f"https://t.me/{REQUIRED_CHANNEL[1:]}"))
-    keyboard.add(InlineKeyboardButton("✅ Я подписался", callback_data="check_subscription"))
-    
     bot.send_message(
         chat_id,
         f"📢 Для использования бота необходимо подписаться на наш канал:\n{REQUIRED_CHANNEL}\n\n"
         f"После подписки нажмите кнопку '✅ Я подписался'",
-        reply_markup=keyboard
+        reply_markup=SUBSCRIPTION_MARKUP
     )
 
 # Функции для работы с состояниями
-def set_user_state(user_id, state, state_data=None):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    if state_data:
-        cursor.execute('REPLACE INTO user_states (user_id, state, state_data) VALUES (?, ?, ?)', 
-                      (user_id, state, state_data))
-    else:
-        cursor.execute('REPLACE INTO user_states (user_id, state) VALUES (?, ?)', 
-                      (user_id, state))
-    
-    conn.commit()
-    conn.close()
+state_store = StateStore(STATE_CACHE_SIZE, STATE_FLUSH_INTERVAL)
+
+# Обработчики состояний регистрируются декоратором @fsm.state рядом с самими функциями
+fsm = StateMachine()
+
+# Обработчики инлайн-кнопок регистрируются декоратором @router.route
+router = CallbackRouter()
+
+# Обработчики кнопок текстового меню регистрируются декоратором @menu.command
+menu = MenuRegistry()
+
+# Активные слоты в памяти для листания списка; загружается при запуске,
+# после изменений слота вызывается listing_index.refresh(slot_id)
+listing_index = ListingIndex({
+    code: (tuple(column.split('.')[1] for column in key), direction == 'DESC')
+    for code, (_, key, direction, _) in SLOT_SORTS.items()
+}, [(low, high) for low, high, _ in PRICE_BANDS])
+
+def listing_index_checker():
+    while True:
+        time.sleep(LISTING_INDEX_CHECK_INTERVAL)
+        try:
+            missing, extra, stale = listing_index.check()
+            if missing or extra or stale:
+                logger.warning(f"Listing index out of sync: {missing} missing, {extra} extra, {stale} stale; reloading")
+                listing_index.load()
+        except Exception as e:
+            logger.error(f"Error checking listing index: {e}")
+
+# Статичные клавиатуры: собираются и сериализуются один раз при запуске
+MAIN_MENU_MARKUP = reply_markup([
+    "🎁 Выставить NFT", "🔍 Найти слоты", "🔎 Поиск", "📊 Мой профиль", "🛒 Мои NFT", "📞 Поддержка"
+])
+ADMIN_MENU_MARKUP = reply_markup([
+    "📊 Статистика", "📞 Тикеты", "👥 Пользователи", "💳 Управление балансом", "💰 Заявки на вывод",
+    "🎁 Промокоды", "📢 Рассылка", "👑 Управление админами", "⬅️ Главное меню"
+])
+SUBSCRIPTION_MARKUP = inline_markup(
+    [InlineKeyboardButton("📢 Подписаться на канал", url=f"https://t.me/{REQUIRED_CHANNEL[1:]}")],
+    [InlineKeyboardButton("✅ Я подписался", callback_data="check_subscription")]
+)
+BACK_TO_MAIN_MARKUP = inline_markup([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")])
+BACK_TO_ADMIN_MARKUP = inline_markup([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin")])
+PROMOCODES_MANAGEMENT_MARKUP = inline_markup(
+    [InlineKeyboardButton("➕ Создать промокод", callback_data="admin_create_promocode"),
+     InlineKeyboardButton("📋 Список промокодов", callback_data="admin_list_promocodes")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin")]
+)
+BROADCAST_MANAGEMENT_MARKUP = inline_markup(
+    [InlineKeyboardButton("📢 Сделать рассылку", callback_data="admin_broadcast")],
+    [InlineKeyboardButton("📋 Рассылки", callback_data="admin_broadcast_jobs")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin")]
+)
+USERS_MANAGEMENT_MARKUP = inline_markup(
+    [InlineKeyboardButton("👤 Забанить пользователя", callback_data="admin_ban"),
+     InlineKeyboardButton("👤 Разбанить пользователя", callback_data="admin_unban"),
+     InlineKeyboardButton("📋 Список пользователей", callback_data="admin_list_users")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin")]
+)
+BALANCE_MANAGEMENT_MARKUP = inline_markup(
+    [InlineKeyboardButton("💸 Пополнить баланс", callback_data="admin_add_balance"),
+     InlineKeyboardButton("📋 Балансы пользователей", callback_data="admin_list_balances")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin")]
+)
+ADMIN_MANAGEMENT_MARKUP = inline_markup(
+    [InlineKeyboardButton("👑 Добавить админа", callback_data="admin_add_admin"),
+     InlineKeyboardButton("👑 Удалить админа", callback_data="admin_remove_admin"),
+     InlineKeyboardButton("📋 Список админов", callback_data="admin_list_admins")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin")]
+)
+
+def set_user_state(user_id, state, **payload):
+    state_store.set(user_id, state, fsm.encode(payload))
 
 def get_user_state(user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT state, state_data FROM user_states WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        return result[0], result[1]
-    return None, None
+    return state_store.get(user_id)
 
 def clear_user_state(user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    state_store.clear(user_id)
 
 # Основные функции
 def get_or_create_user(user_id, username, full_name=None):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    
-    if not user:
-        cursor.execute(
-            'INSERT INTO users (user_id, username, full_name, balance, is_banned, is_admin, has_subscribed) VALUES (?, ?, ?, ?, ?, ?, ?)',
-            (user_id, username or "Не указан", full_name or "", 0, False, False, False)
-        )
-        conn.commit()
+    with db_read() as cursor:
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         user = cursor.fetchone()
+    
+    if not user:
+        with db_write() as cursor:
+            cursor.execute(
+                'INSERT INTO users (user_id, username, full_name, balance, is_banned, is_admin, has_subscribed) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (user_id, username or "Не указан", full_name or "", 0, False, False, False)
+            )
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            user = cursor.fetchone()
     elif full_name and (not user[2] or user[2] != full_name):
-        cursor.execute('UPDATE users SET full_name = ? WHERE user_id = ?', (full_name, user_id))
-        conn.commit()
+        # Не ждем коммита: имя из профиля Telegram не критично
+        db_execute('UPDATE users SET full_name = ? WHERE user_id = ?', (full_name, user_id))
     
-    conn.close()
     return user
 
 def update_user_subscription(user_id, status):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET has_subscribed = ? WHERE user_id = ?', (status, user_id))
-    conn.commit()
-    conn.close()
+    # Не ждем коммита: актуальный статус уже в subscription_cache
+    db_execute('UPDATE users SET has_subscribed = ?, subscription_checked_at = ? WHERE user_id = ?',
+               (status, time.time(), user_id))
 
 def is_user_banned(user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
     try:
-        cursor.execute('SELECT is_banned FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with db_read() as cursor:
+            cursor.execute('SELECT is_banned FROM users WHERE user_id = ?', (user_id,))
+            result = cursor.fetchone()
         return result[0] if result else False
     except sqlite3.OperationalError:
-        conn.close()
         return False
 
 def is_user_admin(user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
     try:
-        cursor.execute('SELECT is_admin FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with db_read() as cursor:
+            cursor.execute('SELECT is_admin FROM users WHERE user_id = ?', (user_id,))
+            result = cursor.fetchone()
         return result[0] if result else False
     except sqlite3.OperationalError:
-        conn.close()
         return False
 
 def has_user_subscribed(user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
     try:
-        cursor.execute('SELECT has_subscribed FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with db_read() as cursor:
+            cursor.execute('SELECT has_subscribed FROM users WHERE user_id = ?', (user_id,))
+            result = cursor.fetchone()
         return result[0] if result else False
     except sqlite3.OperationalError:
-        conn.close()
         return False
 
 def update_global_admins():
     global ADMINS
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM users WHERE is_admin = TRUE')
-    admins = cursor.fetchall()
+    with db_read() as cursor:
+        cursor.execute('SELECT user_id FROM users WHERE is_admin = TRUE')
+        admins = cursor.fetchall()
     ADMINS = [admin[0] for admin in admins]
-    conn.close()
 
 # Функции форматирования чисел
 def format_balance(balance):
@@ -350,16 +747,169 @@ def get_user_display(user_id, username):
     """Возвращает username для отображения (админы показываются как обычные пользователи)"""
     return username or "Не указан"
 
-# Функция проверки доступа (подписка + бан)
-def check_access(user_id):
-    """Проверяет доступ пользователя к функциям бота"""
-    if is_user_banned(user_id):
-        return False, "❌ Вы забанены и не можете использовать бота."
+# Доставка сообщений пользователям
+def set_delivery_status(user_id, status):
+    """Запоминает, можно ли писать пользователю: 'ok', 'blocked' или 'not_found' (без ожидания коммита)"""
+    db_execute('UPDATE users SET delivery_status = ? WHERE user_id = ? AND delivery_status != ?',
+               (status, user_id, status))
+
+def is_deliverable(user_id):
+    with db_read() as cursor:
+        cursor.execute('SELECT delivery_status FROM users WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+    return row is None or row[0] not in UNDELIVERABLE
+
+def record_delivery_error(user_id, error):
+    """Разбирает ошибку отправки: 403 и "chat not found" помечают пользователя недоступным"""
+    status = classify_error(error)
+    if status in UNDELIVERABLE:
+        set_delivery_status(user_id, status)
+    else:
+        logger.warning(f"Error sending message to {user_id}: {error}")
+    return status
+
+# Ошибки отправок, которых никто не ждет (ответы обработчиков, уведомления)
+bot.on_error = record_delivery_error
+
+def notify_user(user_id, text, **kwargs):
+    """Уведомление другому пользователю. Не ждет отправки и не бросает исключений.
     
-    if not is_user_admin(user_id) and not check_subscription(user_id):
-        return False, "subscribe_required"
+    Пользователям, которые заблокировали бота, уведомление не отправляется вовсе.
+    Возвращает Future отправки или None.
+    """
+    if not is_deliverable(user_id):
+        return None
+    return bot.send_message(user_id, text, priority=URGENT, **kwargs)
+
+# Outbox: уведомления о сделках доставляются не меньше одного раза
+outbox_wakeup = Event()
+
+def queue_notification(cursor, chat_id, text, reply_markup=None):
+    """Записывает уведомление в outbox в транзакции cursor. После коммита вызвать outbox_wakeup.set()"""
+    cursor.execute('INSERT INTO outbox (chat_id, text, reply_markup) VALUES (?, ?, ?)',
+                   (chat_id, text, reply_markup.to_json() if reply_markup is not None else None))
+
+def relay_outbox_batch():
+    """Отправляет пачку ожидающих уведомлений и отмечает результат. Возвращает размер пачки"""
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT outbox_id, chat_id, text, reply_markup, attempts
+            FROM outbox INDEXED BY idx_outbox_pending
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY outbox_id LIMIT ?
+        ''', (time.time(), OUTBOX_BATCH_SIZE))
+        rows = cursor.fetchall()
+    if not rows:
+        return 0
+    
+    # Вся пачка сразу ставится в очередь отправки, потом собираются результаты
+    results = {'sent': [], 'failed': [], 'skipped': []}
+    pending = []
+    for outbox_id, chat_id, text, reply_markup, attempts in rows:
+        if not is_deliverable(chat_id):
+            results['skipped'].append(outbox_id)
+            continue
+        future = bot.send_message(chat_id, text, reply_markup=reply_markup, priority=URGENT)
+        pending.append((outbox_id, chat_id, attempts, future))
+    
+    retries = []
+    for outbox_id, chat_id, attempts, future in pending:
+        try:
+            future.result()
+            results['sent'].append(outbox_id)
+        except Exception as e:
+            # Ошибку уже разобрал bot.on_error (record_delivery_error).
+            # Ответ API 4xx (кроме 429) не изменится от повтора; сеть, 5xx и 429 - повторяем
+            permanent = isinstance(e, telebot.apihelper.ApiTelegramException) and e.error_code < 500 and e.error_code != 429
+            if permanent or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                results['failed'].append(outbox_id)
+            else:
+                retries.append((attempts + 1, time.time() + OUTBOX_RETRY_DELAY * 2 ** attempts, outbox_id))
+    
+    with db_write() as cursor:
+        for status, outbox_ids in results.items():
+            if outbox_ids:
+                cursor.execute(f'''
+                    UPDATE outbox SET status = ?, sent_at = CURRENT_TIMESTAMP
+                    WHERE outbox_id IN ({', '.join('?' * len(outbox_ids))})
+                ''', (status, *outbox_ids))
+        cursor.executemany('UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE outbox_id = ?', retries)
+    return len(rows)
+
+def outbox_relay():
+    cleaned_at = 0
+    while True:
+        outbox_wakeup.wait(OUTBOX_POLL_INTERVAL)
+        outbox_wakeup.clear()
+        try:
+            while relay_outbox_batch() == OUTBOX_BATCH_SIZE:
+                pass
+            if time.time() - cleaned_at > 60 * 60:
+                with db_write() as cursor:
+                    cursor.execute('''
+                        DELETE FROM outbox WHERE status != 'pending' AND created_at < datetime('now', ?)
+                    ''', (f'-{OUTBOX_RETENTION_DAYS} days',))
+                cleaned_at = time.time()
+        except Exception as e:
+            logger.error(f"Error relaying outbox: {e}")
+
+# Снимки балансов журнала и сверка users.balance с журналом
+ledger_audit = {'accounts': 0, 'entries': 0, 'imbalance': 0.0, 'mismatches': [], 'at': None}
+
+def ledger_snapshotter():
+    while True:
+        time.sleep(LEDGER_SNAPSHOT_INTERVAL)
+        try:
+            result = db_submit(ledger.snapshot).result()
+            if result['mismatches'] or abs(result['imbalance']) > ledger.TOLERANCE:
+                logger.error(f"Ledger audit failed: imbalance {result['imbalance']}, "
+                             f"mismatched balances (user_id, cached, ledger): {result['mismatches'][:20]}")
+            ledger_audit.update(result, at=time.time())
+        except Exception as e:
+            logger.error(f"Error taking ledger snapshot: {e}")
+
+# Контекст пользователя на время обработки одного апдейта
+class UserContext:
+    """Бан, админство и подписка пользователя (одним запросом) и его состояние из кэша"""
+    
+    def __init__(self, user_id):
+        self.user_id = user_id
+        with db_read() as cursor:
+            cursor.execute('SELECT is_banned, is_admin, has_subscribed FROM users WHERE user_id = ?', (user_id,))
+            is_banned, is_admin, has_subscribed = cursor.fetchone() or (False, False, False)
+        
+        self.is_banned = bool(is_banned)
+        self.is_admin = bool(is_admin)
+        self.has_subscribed = bool(has_subscribed)
+        self.state, self.state_data = get_user_state(user_id)
+        self._is_subscribed = None
+        self._access = None
+    
+    def is_subscribed(self):
+        """Подписка на канал (проверяется не больше одного раза за апдейт)"""
+        if self._is_subscribed is None:
+            self._is_subscribed = check_subscription(self.user_id)
+        return self._is_subscribed
+    
+    def check_access(self):
+        if self._access is None:
+            if self.is_banned:
+                self._access = (False, "❌ Вы забанены и не можете использовать бота.")
+            elif not self.is_admin and not self.is_subscribed():
+                self._access = (False, "subscribe_required")
+            else:
+                self._access = (True, "access_granted")
+        return self._access
     
-    return True, "access_granted"
+    def clear_state(self):
+        if self.state is not None:
+            clear_user_state(self.user_id)
+            self.state, self.state_data = None, None
+
+# Функция проверки доступа (подписка + бан)
+def check_access(ctx):
+    """Проверяет доступ пользователя к функциям бота"""
+    return ctx.check_access()
 
 # КОМАНДЫ
 @bot.message_handler(commands=['start'])
@@ -369,7 +919,8 @@ def start(message):
     update_global_admins()
     
     # Проверяем доступ
-    access, message_text = check_access(user.id)
+    ctx = UserContext(user.id)
+    access, message_text = check_access(ctx)
     if not access:
         if message_text == "subscribe_required":
             show_subscription_required(message.chat.id)
@@ -381,7 +932,7 @@ def start(message):
 
 @bot.message_handler(commands=['admin'])
 def admin_command(message):
-    if not is_user_admin(message.from_user.id):
+    if not UserContext(message.from_user.id).is_admin:
         bot.send_message(message.chat.id, "❌ У вас нет прав доступа")
         return
     
@@ -396,6 +947,7 @@ def help_command(message):
 /help - Помощь
 /profile - Мой профиль
 /mynft - Мои NFT
+/search - Поиск слотов
 
 Для админа:
 /admin - Админ панель
@@ -410,40 +962,36 @@ def profile_command(message):
 def mynft_command(message):
     show_my_nft_text(message)
 
+@bot.message_handler(commands=['search'])
+def search_command(message):
+    search_start_text(message)
+
 # ОБРАБОТЧИК ТЕКСТОВЫХ СООБЩЕНИЙ
 @bot.message_handler(content_types=['text'])
 def handle_text(message):
-    user_id = message.from_user.id
+    ctx = UserContext(message.from_user.id)
     text = message.text
     
     # Сначала проверяем, не является ли текст командой меню
-    menu_commands = [
-        "🎁 Выставить NFT", "🔍 Найти слоты", "📊 Мой профиль", "🛒 Мои NFT", 
-        "📞 Поддержка", "⬅️ Главное меню", "📊 Статистика", "📞 Тикеты", 
-        "👥 Пользователи", "💳 Управление балансом", "💰 Заявки на вывод", 
-        "🎁 Промокоды", "📢 Рассылка", "👑 Управление админами"
-    ]
-    
-    if text in menu_commands:
+    if text in menu.labels:
         # Если это команда меню - очищаем состояние и выполняем команду
-        clear_user_state(user_id)
-        handle_menu_commands(message, text)
+        ctx.clear_state()
+        handle_menu_commands(message, text, ctx)
         return
     
     # ВТОРОЕ - проверяем состояние пользователя
-    state, state_data = get_user_state(user_id)
-    if state:
+    if ctx.state:
         # Если у пользователя есть состояние, обрабатываем как ввод данных
-        handle_user_state(message, state, state_data)
+        handle_user_state(message, ctx)
         return
     
     # ТРЕТЬЕ - проверяем бан
-    if is_user_banned(user_id):
+    if ctx.is_banned:
         bot.send_message(message.chat.id, "❌ Вы забанены и не можете использовать бота.")
         return
     
     # ЧЕТВЕРТОЕ - проверяем доступ для основных команд
-    access, message_text = check_access(user_id)
+    access, message_text = check_access(ctx)
     if not access:
         if message_text == "subscribe_required":
             show_subscription_required(message.chat.id)
@@ -454,10 +1002,10 @@ def handle_text(message):
     # Если не команда меню, нет состояния и доступ есть - показываем сообщение
     bot.send_message(message.chat.id, "Используйте кнопки меню для навигации")
 
-def handle_menu_commands(message, text):
+def handle_menu_commands(message, text, ctx):
     """Обработка команд главного меню"""
     # Проверяем доступ для команд меню
-    access, message_text = check_access(message.from_user.id)
+    access, message_text = check_access(ctx)
     if not access:
         if message_text == "subscribe_required":
             show_subscription_required(message.chat.id)
@@ -465,192 +1013,73 @@ def handle_menu_commands(message, text):
             bot.send_message(message.chat.id, message_text)
         return
     
-    if text == "🎁 Выставить NFT":
-        create_slot_start_text(message)
-    elif text == "🔍 Найти слоты":
-        find_slots_text(message)
-    elif text == "📊 Мой профиль":
-        show_profile_text(message)
-    elif text == "🛒 Мои NFT":
-        show_my_nft_text(message)
-    elif text == "📞 Поддержка":
-        support_start_text(message)
-    elif text == "⬅️ Главное меню":
-        show_main_menu(message.chat.id, "Главное меню:")
-    
-    # Админские команды
-    elif is_user_admin(message.from_user.id):
-        if text == "📊 Статистика":
-            show_stats(message)
-        elif text == "📞 Тикеты":
-            show_tickets(message)
-        elif text == "👥 Пользователи":
-            show_users_management(message)
-        elif text == "💳 Управление балансом":
-            show_balance_management(message)
-        elif text == "💰 Заявки на вывод":
-            show_withdraw_requests(message)
-        elif text == "🎁 Промокоды":
-            show_promocodes_management(message)
-        elif text == "📢 Рассылка":
-            show_broadcast_management(message)
-        elif text == "👑 Управление админами":
-            show_admin_management(message)
+    command = menu.get(text)
+    if command.admin_only and not ctx.is_admin:
+        return
+    command.handler(message)
+
+@menu.command("⬅️ Главное меню")
+def back_to_main_menu(message):
+    show_main_menu(message.chat.id, "Главное меню:")
 
 # ОБРАБОТКА СОСТОЯНИЙ ПОЛЬЗОВАТЕЛЯ
-def handle_user_state(message, state, state_data):
-    user_id = message.from_user.id
+def handle_user_state(message, ctx):
+    user_id = ctx.user_id
     text = message.text
     
     # Сначала проверяем, не является ли текст командой меню
-    menu_commands = [
-        "🎁 Выставить NFT", "🔍 Найти слоты", "📊 Мой профиль", "🛒 Мои NFT", 
-        "📞 Поддержка", "⬅️ Главное меню", "📊 Статистика", "📞 Тикеты", 
-        "👥 Пользователи", "💳 Управление балансом", "💰 Заявки на вывод", 
-        "🎁 Промокоды", "📢 Рассылка", "👑 Управление админами"
-    ]
-    
-    if text in menu_commands:
+    if text in menu.labels:
         # Если это команда меню - очищаем состояние и выполняем команду
-        clear_user_state(user_id)
-        handle_menu_commands(message, text)
+        ctx.clear_state()
+        handle_menu_commands(message, text, ctx)
         return
     
     # Для состояний ввода проверяем только бан (не подписку)
-    if is_user_banned(user_id):
+    if ctx.is_banned:
         bot.send_message(message.chat.id, "❌ Вы забанены и не можете использовать бота.")
-        clear_user_state(user_id)
+        ctx.clear_state()
         return
     
-    # Обрабатываем состояния
-    if state == "waiting_promocode":
-        process_promocode_activation(message, user_id)
-    elif state == "waiting_nft_photo":
-        process_nft_photo(message)
-    elif state == "waiting_nft_description":
-        user_data = {'photo_id': state_data} if state_data else {}
-        process_description(message, user_data)
-    elif state == "waiting_nft_price":
-        user_data = {'photo_id': state_data.split('|')[0], 'description': state_data.split('|')[1]} if state_data else {}
-        process_price(message, user_data)
-    elif state == "waiting_nft_contact":
-        user_data = {'photo_id': state_data.split('|')[0], 'description': state_data.split('|')[1], 'price': state_data.split('|')[2]} if state_data else {}
-        process_contact_info(message, user_data)
-    elif state == "waiting_withdraw_card":
-        process_withdraw_card(message, float(state_data), user_id)
-    elif state == "waiting_withdraw_amount":
-        parts = state_data.split('|')
-        balance = float(parts[0])
-        card_number = parts[1]
-        process_withdraw_amount(message, balance, user_id, card_number)
-    elif state == "waiting_name_change":
-        process_name_change(message, user_id)
-    elif state == "waiting_support_message":
-        process_support_message(message)
-    elif state == "waiting_admin_balance":
-        if is_user_admin(user_id):
-            process_admin_balance(message)
-    elif state == "waiting_admin_ban":
-        if is_user_admin(user_id):
-            process_admin_ban(message)
-    elif state == "waiting_admin_unban":
-        if is_user_admin(user_id):
-            process_admin_unban(message)
-    elif state == "waiting_reject_reason":
-        if is_user_admin(user_id):
-            withdraw_id = state_data
-            process_reject_reason(message, withdraw_id)
-    elif state == "waiting_ticket_reply":
-        if is_user_admin(user_id):
-            ticket_id = state_data
-            process_ticket_reply(message, ticket_id)
-    elif state == "waiting_transfer_user":
-        process_transfer_user(message, user_id)
-    elif state == "waiting_transfer_amount":
-        parts = state_data.split('|')
-        target_user_id = int(parts[0])
-        process_transfer_amount(message, user_id, target_user_id)
-    elif state == "waiting_rating":
-        parts = state_data.split('|')
-        purchase_id = int(parts[0])
-        rate_type = parts[1]
-        rating = int(parts[2])
-        process_review(message, purchase_id, rate_type, rating)
-    elif state == "waiting_add_admin":
-        if is_user_admin(user_id):
-            process_add_admin(message)
-    elif state == "waiting_remove_admin":
-        if is_user_admin(user_id):
-            process_remove_admin(message)
-    elif state == "waiting_promocode_name":
-        if is_user_admin(user_id):
-            process_promocode_name(message)
-    elif state == "waiting_promocode_amount":
-        if is_user_admin(user_id):
-            parts = state_data.split('|')
-            code = parts[0]
-            process_promocode_amount(message, code)
-    elif state == "waiting_promocode_activations":
-        if is_user_admin(user_id):
-            parts = state_data.split('|')
-            code = parts[0]
-            amount = float(parts[1])
-            process_promocode_activations(message, code, amount)
-    elif state == "waiting_broadcast_message":
-        if is_user_admin(user_id):
-            process_broadcast_message(message)
-    else:
-        # Если состояние неизвестно - очищаем его
+    # Обрабатываем состояние
+    resolved = fsm.resolve(ctx.state, ctx.state_data)
+    if resolved is None:
+        # Если состояние неизвестно или его данные повреждены - очищаем его
         clear_user_state(user_id)
         bot.send_message(message.chat.id, "❌ Неизвестное состояние. Возврат в главное меню.")
         show_main_menu(message.chat.id, "Главное меню:")
+        return
+    
+    entry, payload = resolved
+    if entry.admin_only and not ctx.is_admin:
+        return
+    entry.handler(message, **payload)
 
 # ОСНОВНЫЕ ФУНКЦИИ МЕНЮ
 def show_main_menu(chat_id, text):
-    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    keyboard.add(
-        KeyboardButton("🎁 Выставить NFT"),
-        KeyboardButton("🔍 Найти слоты"),
-        KeyboardButton("📊 Мой профиль"),
-        KeyboardButton("🛒 Мои NFT"),
-        KeyboardButton("📞 Поддержка")
-    )
-    
-    bot.send_message(chat_id, text, reply_markup=keyboard)
+    bot.send_message(chat_id, text, reply_markup=MAIN_MENU_MARKUP)
 
 def show_admin_menu(chat_id):
-    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    keyboard.add(
-        KeyboardButton("📊 Статистика"),
-        KeyboardButton("📞 Тикеты"),
-        KeyboardButton("👥 Пользователи"),
-        KeyboardButton("💳 Управление балансом"),
-        KeyboardButton("💰 Заявки на вывод"),
-        KeyboardButton("🎁 Промокоды"),
-        KeyboardButton("📢 Рассылка"),
-        KeyboardButton("👑 Управление админами"),
-        KeyboardButton("⬅️ Главное меню")
-    )
-    
-    bot.send_message(chat_id, "👨‍💼 Админ панель\n\nВыберите действие:", reply_markup=keyboard)
+    bot.send_message(chat_id, "👨‍💼 Админ панель\n\nВыберите действие:", reply_markup=ADMIN_MENU_MARKUP)
 
 # ПОКАЗАТЬ ПРОФИЛЬ
+@menu.command("📊 Мой профиль")
 def show_profile_text(message):
     user_id = message.from_user.id
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    
-    # Получаем статистику сделок
-    cursor.execute('SELECT COUNT(*) FROM purchases WHERE (buyer_id = ? OR seller_id = ?) AND status = "completed"', (user_id, user_id))
-    successful_deals = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM purchases WHERE (buyer_id = ? OR seller_id = ?) AND status = "pending"', (user_id, user_id))
-    pending_deals = cursor.fetchone()[0]
-    
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT user_id, username, full_name, rating_seller, rating_buyer, total_sales, total_purchases,
+                   successful_sales, successful_purchases, failed_sales, failed_purchases, balance,
+                   is_banned, is_admin, has_subscribed
+            FROM users WHERE user_id = ?
+        ''', (user_id,))
+        user = cursor.fetchone()
+        
+        # Получаем статистику сделок
+        cursor.execute('SELECT COUNT(*) FROM purchases WHERE (buyer_id = ? OR seller_id = ?) AND status = "completed"', (user_id, user_id))
+        successful_deals = cursor.fetchone()[0]
+        
+        cursor.execute('SELECT COUNT(*) FROM purchases WHERE (buyer_id = ? OR seller_id = ?) AND status = "pending"', (user_id, user_id))
+        pending_deals = cursor.fetchone()[0]
 
     if user:
         user_id, username, full_name, rating_seller, rating_buyer, total_sales, total_purchases, successful_sales, successful_purchases, failed_sales, failed_purchases, balance, is_banned, is_admin, has_subscribed = user
@@ -689,125 +1118,337 @@ def show_profile_text(message):
         bot.send_message(message.chat.id, "❌ Ошибка загрузки профиля")
 
 # СОЗДАНИЕ NFT
+@menu.command("🎁 Выставить NFT")
 def create_slot_start_text(message):
     set_user_state(message.from_user.id, "waiting_nft_photo")
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main"))
-    
     bot.send_message(
         message.chat.id,
         "🎨 Создание нового слота для NFT\n\nПришлите ФОТО NFT:",
-        reply_markup=keyboard
+        reply_markup=BACK_TO_MAIN_MARKUP
     )
 
 @bot.message_handler(content_types=['photo'])
 def handle_photo(message):
-    state, state_data = get_user_state(message.from_user.id)
+    ctx = UserContext(message.from_user.id)
     
-    if state == "waiting_nft_photo":
+    if ctx.state == "waiting_nft_photo":
         process_nft_photo(message)
 
+@fsm.state("waiting_nft_photo")
 def process_nft_photo(message):
     if not message.photo:
         bot.send_message(message.chat.id, "❌ Пожалуйста, пришлите фото. Попробуйте снова:")
         return
     
     photo_id = message.photo[-1].file_id
-    set_user_state(message.from_user.id, "waiting_nft_description", photo_id)
+    set_user_state(message.from_user.id, "waiting_nft_description", photo_id=photo_id)
     bot.send_message(message.chat.id, "📝 Теперь введите описание NFT:")
 
-def process_description(message, user_data):
+@fsm.state("waiting_nft_description", photo_id=str)
+def process_description(message, photo_id):
     description = message.text
-    photo_id = user_data.get('photo_id', '')
-    set_user_state(message.from_user.id, "waiting_nft_price", f"{photo_id}|{description}")
+    set_user_state(message.from_user.id, "waiting_nft_price", photo_id=photo_id, description=description)
     bot.send_message(message.chat.id, "💰 Введите цену в рублях:")
 
-def process_price(message, user_data):
+@fsm.state("waiting_nft_price", photo_id=str, description=str)
+def process_price(message, photo_id, description):
     try:
         price = float(message.text)
         if price <= 0:
             bot.send_message(message.chat.id, "❌ Цена должна быть больше 0.")
             return
             
-        photo_id = user_data.get('photo_id', '')
-        description = user_data.get('description', '')
-        set_user_state(message.from_user.id, "waiting_nft_contact", f"{photo_id}|{description}|{price}")
+        set_user_state(message.from_user.id, "waiting_nft_contact", photo_id=photo_id, description=description, price=price)
         bot.send_message(message.chat.id, "📞 Введите контактные данные для связи (например, ваш username в Telegram):")
         
     except ValueError:
         bot.send_message(message.chat.id, "❌ Пожалуйста, введите корректную цену (число):")
 
-def process_contact_info(message, user_data):
+@fsm.state("waiting_nft_contact", photo_id=str, description=str, price=float)
+def process_contact_info(message, photo_id, description, price):
     contact_info = message.text
     if len(contact_info) < 3:
         bot.send_message(message.chat.id, "❌ Контактные данные слишком короткие")
         return
         
     user_id = message.from_user.id
-    photo_id = user_data.get('photo_id', '')
-    description = user_data.get('description', '')
-    price = user_data.get('price', '')
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, photo_id, description, price, contact_info))
-    
-    conn.commit()
-    conn.close()
+    with db_write() as cursor:
+        cursor.execute('''
+            INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, photo_id, description, price, contact_info))
+        slot_id = cursor.lastrowid
+    listing_index.refresh(slot_id)
     
     clear_user_state(user_id)
     bot.send_message(message.chat.id, "✅ Слот успешно создан!")
     show_main_menu(message.chat.id, "Главное меню:")
 
 # ПОИСК СЛОТОВ
+def build_slots_page_query(viewer_id, sort, band, after=None, before=None):
+    """SQL и параметры страницы слотов из базы: запрос идет по покрывающему индексу сортировки (INDEXED BY)"""
+    _, key, direction, index = SLOT_SORTS[sort]
+    low, high, _ = PRICE_BANDS[band]
+    backwards = before is not None
+    cursor_value = before if backwards else after
+    
+    conditions = ['s.is_active = TRUE', 's.seller_id != ?']
+    params = [viewer_id]
+    if low is not None:
+        conditions.append('s.price_rub >= ?')
+        params.append(low)
+    if high is not None:
+        conditions.append('s.price_rub < ?')
+        params.append(high)
+    if cursor_value is not None:
+        # Листая назад, идем против направления сортировки и потом разворачиваем страницу
+        forward_op = '<' if direction == 'DESC' else '>'
+        op = {'<': '>', '>': '<'}[forward_op] if backwards else forward_op
+        conditions.append(f"({', '.join(key)}) {op} ({', '.join('?' * len(key))})")
+        params.extend(float(value) for value in cursor_value.split(':'))
+    
+    order = direction if not backwards else {'ASC': 'DESC', 'DESC': 'ASC'}[direction]
+    query = f'''
+        SELECT s.slot_id, s.description, s.price_rub, {', '.join(key)}
+        FROM slots s INDEXED BY {index}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {', '.join(f'{column} {order}' for column in key)}
+        LIMIT ?
+    '''
+    return query, params + [SLOTS_PAGE_SIZE + 1]
+
+def get_slots_page(viewer_id, sort=DEFAULT_SLOT_SORT, band=0, after=None, before=None):
+    """Страница активных чужих слотов (keyset-пагинация по ключу сортировки).
+    
+    after/before - курсор соседней страницы: значения ключа сортировки через ":".
+    Возвращает (слоты, курсор_предыдущей, курсор_следующей); курсор None - страницы нет.
+    Читается на одну строку больше размера страницы, чтобы узнать, есть ли страница дальше.
+    Пока индекс слотов в памяти загружен, страница берется из него, без запроса к базе.
+    """
+    if listing_index.loaded:
+        return listing_index.page(viewer_id, sort, band, SLOTS_PAGE_SIZE, after, before)
+    
+    backwards = before is not None
+    query, params = build_slots_page_query(viewer_id, sort, band, after, before)
+    with db_read() as cursor:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    
+    has_more = len(rows) > SLOTS_PAGE_SIZE
+    rows = rows[:SLOTS_PAGE_SIZE]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return [], None, None
+    
+    first_key = ':'.join(str(value) for value in rows[0][3:])
+    last_key = ':'.join(str(value) for value in rows[-1][3:])
+    if backwards:
+        prev_cursor, next_cursor = (first_key if has_more else None), last_key
+    else:
+        prev_cursor, next_cursor = (first_key if after is not None else None), (last_key if has_more else None)
+    return [row[:3] for row in rows], prev_cursor, next_cursor
+
+def build_slots_keyboard(slots, prev_data=None, next_data=None, extra_buttons=()):
+    """Кнопки слотов страницы и навигация; prev_data/next_data - callback_data соседних страниц"""
+    keyboard = InlineKeyboardMarkup()
+    for slot_id, description, price in slots:
+        btn_text = f"🎁 {description[:20]}... - {format_balance(price)} руб"
+        keyboard.add(InlineKeyboardButton(btn_text, callback_data=f"slot_{slot_id}"))
+    
+    navigation = []
+    if prev_data:
+        navigation.append(InlineKeyboardButton("◀️", callback_data=prev_data))
+    if next_data:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=next_data))
+    if navigation:
+        keyboard.row(*navigation)
+    
+    for button in extra_buttons:
+        keyboard.add(button)
+    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main"))
+    return keyboard
+
+def build_browse_keyboard(slots, sort, band, prev_cursor, next_cursor):
+    # Сортировка, диапазон цен и курсор передаются в callback_data
+    return build_slots_keyboard(
+        slots,
+        f"slots_prev_{sort}_{band}_{prev_cursor}" if prev_cursor else None,
+        f"slots_next_{sort}_{band}_{next_cursor}" if next_cursor else None,
+        [InlineKeyboardButton("⚙️ Сортировка и цена", callback_data=f"slots_filters_{sort}_{band}")],
+    )
+
+def browse_title(sort, band):
+    title = f"🔍 Доступные слоты ({SLOT_SORTS[sort][0]}"
+    if band:
+        title += f", {PRICE_BANDS[band][2]}"
+    return title + "):"
+
+def send_slots_page(chat_id, viewer_id):
+    slots, prev_cursor, next_cursor = get_slots_page(viewer_id)
+    
+    if not slots:
+        bot.send_message(chat_id, "🔍 Активных слотов не найдено")
+        return
+    
+    bot.send_message(chat_id, browse_title(DEFAULT_SLOT_SORT, 0),
+                     reply_markup=build_browse_keyboard(slots, DEFAULT_SLOT_SORT, 0, prev_cursor, next_cursor))
+
+@menu.command("🔍 Найти слоты")
 def find_slots_text(message):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
+    send_slots_page(message.chat.id, message.from_user.id)
+
+def edit_slots_page(call, sort, band, after=None, before=None):
+    """Листает список слотов, редактируя уже отправленное сообщение"""
+    if sort not in SLOT_SORTS or not 0 <= band < len(PRICE_BANDS):
+        answer_callback(call, "❌ Неизвестная команда")
+        return
     
-    cursor.execute('''
-        SELECT s.slot_id, s.description, s.price_rub, u.username, u.user_id
-        FROM slots s 
-        JOIN users u ON s.seller_id = u.user_id 
-        WHERE s.is_active = TRUE AND s.seller_id != ?
-    ''', (message.from_user.id,))
-    slots = cursor.fetchall()
-    conn.close()
+    slots, prev_cursor, next_cursor = get_slots_page(call.from_user.id, sort, band, after, before)
+    if not slots and (after or before):
+        # Слоты на соседней странице успели купить или снять - возвращаемся к началу
+        slots, prev_cursor, next_cursor = get_slots_page(call.from_user.id, sort, band)
     
     if not slots:
-        bot.send_message(message.chat.id, "🔍 Активных слотов не найдено")
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(InlineKeyboardButton("⚙️ Сортировка и цена", callback_data=f"slots_filters_{sort}_{band}"))
+        keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main"))
+        bot.edit_message_text("🔍 Слотов с такими условиями не найдено", call.message.chat.id, call.message.message_id,
+                              reply_markup=keyboard)
+    else:
+        bot.edit_message_text(browse_title(sort, band), call.message.chat.id, call.message.message_id,
+                              reply_markup=build_browse_keyboard(slots, sort, band, prev_cursor, next_cursor))
+
+@router.route("slots_view_", str, int)
+def slots_view_callback(call, sort, band):
+    edit_slots_page(call, sort, band)
+
+@router.route("slots_next_", str, int, str)
+def slots_next_callback(call, sort, band, cursor):
+    edit_slots_page(call, sort, band, after=cursor)
+
+@router.route("slots_prev_", str, int, str)
+def slots_prev_callback(call, sort, band, cursor):
+    edit_slots_page(call, sort, band, before=cursor)
+
+@router.route("slots_filters_", str, int)
+def slots_filters_callback(call, sort, band):
+    """Выбор сортировки и ценового диапазона; текущие отмечены галочкой"""
+    if sort not in SLOT_SORTS or not 0 <= band < len(PRICE_BANDS):
+        answer_callback(call, "❌ Неизвестная команда")
         return
     
     keyboard = InlineKeyboardMarkup()
-    for slot in slots:
-        slot_id, description, price, username, seller_id = slot
-        btn_text = f"🎁 {description[:20]}... - {format_balance(price)} руб"
-        keyboard.add(InlineKeyboardButton(btn_text, callback_data=f"slot_{slot_id}"))
+    for code, (title, _, _, _) in SLOT_SORTS.items():
+        mark = "✅ " if code == sort else ""
+        keyboard.add(InlineKeyboardButton(f"{mark}{title}", callback_data=f"slots_view_{code}_{band}"))
+    for index, (_, _, title) in enumerate(PRICE_BANDS):
+        mark = "✅ " if index == band else ""
+        keyboard.add(InlineKeyboardButton(f"{mark}{title}", callback_data=f"slots_view_{sort}_{index}"))
+    
+    bot.edit_message_text("⚙️ Сортировка и цена\n\nВыберите порядок и диапазон цен:",
+                          call.message.chat.id, call.message.message_id, reply_markup=keyboard)
+
+# ПОЛНОТЕКСТОВЫЙ ПОИСК СЛОТОВ
+def build_search_query(text):
+    """Запрос FTS5 из ввода пользователя: все слова обязательны, каждое ищется как префикс"""
+    words = re.findall(r'\w+', text.lower())[:SEARCH_MAX_TERMS]
+    return ' '.join(f'"{word}"*' for word in words)
+
+def search_slots(viewer_id, text, offset=0):
+    """Страница результатов поиска: (слоты, есть_следующая).
+    
+    Ранжируются только SEARCH_CANDIDATES самых свежих совпадений (по bm25, затем по цене),
+    поэтому время запроса не растет вместе с числом объявлений.
+    """
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT s.slot_id, s.description, s.price_rub
+            FROM (
+                SELECT rowid AS slot_id, bm25(slots_fts) AS score
+                FROM slots_fts
+                WHERE slots_fts MATCH ?
+                ORDER BY rowid DESC
+                LIMIT ?
+            ) m
+            JOIN slots s ON s.slot_id = m.slot_id
+            WHERE s.is_active = TRUE AND s.seller_id != ?
+            ORDER BY m.score, s.price_rub, s.slot_id
+            LIMIT ? OFFSET ?
+        ''', (build_search_query(text), SEARCH_CANDIDATES, viewer_id, SLOTS_PAGE_SIZE + 1, offset))
+        rows = cursor.fetchall()
+    return rows[:SLOTS_PAGE_SIZE], len(rows) > SLOTS_PAGE_SIZE
+
+def build_search_keyboard(slots, offset, has_next):
+    return build_slots_keyboard(
+        slots,
+        f"search_page_{offset - SLOTS_PAGE_SIZE}" if offset else None,
+        f"search_page_{offset + SLOTS_PAGE_SIZE}" if has_next else None,
+    )
+
+@menu.command("🔎 Поиск")
+def search_start_text(message):
+    set_user_state(message.from_user.id, "waiting_search_query")
+    bot.send_message(
+        message.chat.id,
+        "🔎 Поиск слотов\n\nВведите слова из описания NFT:",
+        reply_markup=BACK_TO_MAIN_MARKUP
+    )
+
+@fsm.state("waiting_search_query")
+@fsm.state("search_results", query=str)
+def process_search_query(message, query=None):
+    # В состоянии search_results новый текст - это новый запрос
+    text = message.text.strip()
+    if not build_search_query(text):
+        bot.send_message(message.chat.id, "❌ Введите хотя бы одно слово для поиска:")
+        return
     
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main"))
+    slots, has_next = search_slots(message.from_user.id, text)
+    if not slots:
+        bot.send_message(message.chat.id, "🔎 Ничего не найдено. Попробуйте другой запрос:")
+        return
+    
+    # Запрос храним в состоянии: по нему листаются страницы результатов
+    set_user_state(message.from_user.id, "search_results", query=text)
+    bot.send_message(
+        message.chat.id,
+        f"🔎 Результаты по запросу «{text}»:",
+        reply_markup=build_search_keyboard(slots, 0, has_next)
+    )
+
+@router.route("search_page_", int)
+def search_page_callback(call, offset):
+    resolved = fsm.resolve(*get_user_state(call.from_user.id))
+    if resolved is None or resolved[0].name != "search_results":
+        answer_callback(call, "❌ Поиск устарел, начните заново")
+        return
     
-    bot.send_message(message.chat.id, "🔍 Доступные слоты:", reply_markup=keyboard)
+    text = resolved[1]['query']
+    slots, has_next = search_slots(call.from_user.id, text, max(offset, 0))
+    if not slots:
+        answer_callback(call, "🔎 Больше результатов нет")
+        return
+    
+    bot.edit_message_text(f"🔎 Результаты по запросу «{text}»:", call.message.chat.id, call.message.message_id,
+                          reply_markup=build_search_keyboard(slots, max(offset, 0), has_next))
 
 # ФУНКЦИЯ ДЛЯ ПОКАЗА ДЕТАЛЕЙ СЛОТА
+@router.route("slot_", int)
 def show_slot_details(call, slot_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT s.slot_id, s.nft_photo, s.description, s.price_rub, s.contact_info, 
-               u.username, u.user_id, u.rating_seller
-        FROM slots s 
-        JOIN users u ON s.seller_id = u.user_id 
-        WHERE s.slot_id = ? AND s.is_active = TRUE
-    ''', (slot_id,))
-    slot = cursor.fetchone()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT s.slot_id, s.nft_photo, s.description, s.price_rub, s.contact_info, 
+                   u.username, u.user_id, u.rating_seller
+            FROM slots s 
+            JOIN users u ON s.seller_id = u.user_id 
+            WHERE s.slot_id = ? AND s.is_active = TRUE
+        ''', (slot_id,))
+        slot = cursor.fetchone()
     
     if not slot:
-        bot.answer_callback_query(call.id, "❌ Слот не найден")
+        answer_callback(call, "❌ Слот не найден")
         return
     
     slot_id, nft_photo, description, price, contact_info, username, seller_id, rating_seller = slot
@@ -833,100 +1474,89 @@ def show_slot_details(call, slot_id):
     )
     keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_slots"))
     
-    try:
-        bot.send_photo(call.message.chat.id, nft_photo, caption=message_text, reply_markup=keyboard)
-    except:
-        bot.send_message(call.message.chat.id, message_text, reply_markup=keyboard)
-
-# ФУНКЦИЯ ДЛЯ ПОКУПКИ NFT
-def buy_nft(call, slot_id):
-    user_id = call.from_user.id
+    # Фото не ждем, чтобы не держать полосу на лимите чата; если оно не отправилось
+    # (например, file_id больше не действует), карточка приходит текстом
+    chat_id = call.message.chat.id
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
+    def send_text_instead(sent):
+        if sent.exception() is not None:
+            bot.send_message(chat_id, message_text, reply_markup=keyboard)
     
-    # Получаем информацию о слоте
+    bot.send_photo(chat_id, nft_photo, caption=message_text, reply_markup=keyboard).add_done_callback(send_text_instead)
+
+# ФУНКЦИЯ ДЛЯ ПОКУПКИ NFT
+def purchase_slot(cursor, slot_id, user_id):
+    """Покупка слота одной транзакцией писателя.
+
+    Слот и деньги списываются условными UPDATE: слот - только если он еще активен,
+    баланс - только если его хватает. Возвращает (ошибка, None) или (None, сделка).
+    """
     cursor.execute('SELECT seller_id, price_rub, description FROM slots WHERE slot_id = ? AND is_active = TRUE', (slot_id,))
     slot = cursor.fetchone()
-    
     if not slot:
-        bot.answer_callback_query(call.id, "❌ Слот не найден")
-        conn.close()
-        return
+        return "❌ Слот не найден", None
     
     seller_id, price, description = slot
     
     if seller_id == user_id:
-        bot.answer_callback_query(call.id, "❌ Нельзя купить свой собственный NFT")
-        conn.close()
-        return
+        return "❌ Нельзя купить свой собственный NFT", None
     
-    # Проверяем баланс покупателя
-    cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-    buyer_balance = cursor.fetchone()[0]
+    # Забираем слот: второй покупатель получит rowcount 0
+    cursor.execute('UPDATE slots SET is_active = FALSE WHERE slot_id = ? AND is_active = TRUE', (slot_id,))
+    if cursor.rowcount != 1:
+        return "❌ Слот уже продан", None
     
-    if buyer_balance < price:
-        bot.answer_callback_query(call.id, f"❌ Недостаточно средств. Нужно: {format_balance(price)} руб")
-        conn.close()
-        return
+    # Резервируем средства покупателя на счете эскроу
+    if not ledger.transfer(cursor, user_id, ESCROW, price, 'purchase', f'Покупка NFT: {description}', check_funds=True):
+        cursor.execute('UPDATE slots SET is_active = TRUE WHERE slot_id = ?', (slot_id,))
+        return f"❌ Недостаточно средств. Нужно: {format_balance(price)} руб", None
     
     # Создаем запись о покупке
     cursor.execute('INSERT INTO purchases (slot_id, buyer_id, seller_id, amount) VALUES (?, ?, ?, ?)',
                   (slot_id, user_id, seller_id, price))
     
-    # Резервируем средства у покупателя
-    cursor.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (price, user_id))
-    
-    # Делаем слот неактивным
-    cursor.execute('UPDATE slots SET is_active = FALSE WHERE slot_id = ?', (slot_id,))
-    
-    # Записываем транзакцию
-    cursor.execute('INSERT INTO transactions (user_id, amount, type, description) VALUES (?, ?, ?, ?)',
-                  (user_id, -price, 'purchase', f'Покупка NFT: {description}'))
-    
-    conn.commit()
-    conn.close()
-    
-    # Получаем информацию о покупателе для уведомления продавцу
-    conn_buyer = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor_buyer = conn_buyer.cursor()
-    cursor_buyer.execute('SELECT username, full_name FROM users WHERE user_id = ?', (user_id,))
-    buyer_info = cursor_buyer.fetchone()
-    conn_buyer.close()
+    # Данные покупателя и продавца для уведомлений
+    cursor.execute('SELECT user_id, username, full_name FROM users WHERE user_id IN (?, ?)', (user_id, seller_id))
+    users_info = {row[0]: row[1:] for row in cursor.fetchall()}
+    buyer_info = users_info.get(user_id)
+    seller_info = users_info.get(seller_id)
     
     buyer_username = buyer_info[0] if buyer_info else "Не указан"
     buyer_full_name = buyer_info[1] if buyer_info else "Не указано"
     display_buyer_username = get_user_display(user_id, buyer_username)
     
-    # Получаем информацию о продавце для уведомления покупателю
-    conn_seller = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor_seller = conn_seller.cursor()
-    cursor_seller.execute('SELECT username, full_name FROM users WHERE user_id = ?', (seller_id,))
-    seller_info = cursor_seller.fetchone()
-    conn_seller.close()
-    
     seller_username = seller_info[0] if seller_info else "Не указан"
     seller_full_name = seller_info[1] if seller_info else "Не указано"
     display_seller_username = get_user_display(seller_id, seller_username)
     
-    # Уведомляем продавца
-    try:
-        seller_keyboard = InlineKeyboardMarkup()
-        seller_keyboard.add(InlineKeyboardButton("✅ Подтвердить отправку", callback_data=f"confirm_send_{slot_id}"))
-        
-        seller_message = (
-            f"🛒 Новый покупатель!\n\n"
-            f"🎁 NFT: {description}\n"
-            f"💰 Сумма: {format_balance(price)} руб\n"
-            f"👤 Покупатель ID: {user_id}\n"
-            f"📛 Имя: {buyer_full_name}\n"
-            f"🔗 Username: @{display_buyer_username}\n\n"
-            f"✅ Подтвердите отправку NFT:"
-        )
-        
-        bot.send_message(seller_id, seller_message, reply_markup=seller_keyboard)
-    except:
-        pass
+    # Уведомление продавцу уходит через outbox вместе с покупкой
+    seller_keyboard = InlineKeyboardMarkup()
+    seller_keyboard.add(InlineKeyboardButton("✅ Подтвердить отправку", callback_data=f"confirm_send_{slot_id}"))
+    
+    seller_message = (
+        f"🛒 Новый покупатель!\n\n"
+        f"🎁 NFT: {description}\n"
+        f"💰 Сумма: {format_balance(price)} руб\n"
+        f"👤 Покупатель ID: {user_id}\n"
+        f"📛 Имя: {buyer_full_name}\n"
+        f"🔗 Username: @{display_buyer_username}\n\n"
+        f"✅ Подтвердите отправку NFT:"
+    )
+    queue_notification(cursor, seller_id, seller_message, seller_keyboard)
+    return None, (seller_id, price, description, seller_full_name, display_seller_username)
+
+@router.route("buy_", int, ack="⏳ Оформляем покупку...")
+def buy_nft(call, slot_id):
+    user_id = call.from_user.id
+    
+    error, deal = db_submit(purchase_slot, slot_id, user_id).result()
+    if error:
+        answer_callback(call, error)
+        return
+    
+    seller_id, price, description, seller_full_name, display_seller_username = deal
+    outbox_wakeup.set()
+    listing_index.refresh(slot_id)
     
     # Уведомляем покупателя
     buyer_keyboard = InlineKeyboardMarkup()
@@ -935,7 +1565,6 @@ def buy_nft(call, slot_id):
         InlineKeyboardButton("❌ Отменить сделку", callback_data=f"cancel_deal_{slot_id}")
     )
     
-    bot.answer_callback_query(call.id, "✅ Покупка оформлена!")
     bot.send_message(
         call.message.chat.id,
         f"✅ Покупка оформлена!\n\n"
@@ -950,18 +1579,16 @@ def buy_nft(call, slot_id):
     )
 
 # МОИ NFT
+@menu.command("🛒 Мои NFT")
 def show_my_nft_text(message):
     user_id = message.from_user.id
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT slot_id, description, price_rub
-        FROM slots 
-        WHERE seller_id = ? AND is_active = TRUE
-    ''', (user_id,))
-    slots = cursor.fetchall()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT slot_id, description, price_rub
+            FROM slots 
+            WHERE seller_id = ? AND is_active = TRUE
+        ''', (user_id,))
+        slots = cursor.fetchall()
     
     if not slots:
         bot.send_message(message.chat.id, "🛒 У вас нет активных NFT слотов")
@@ -976,6 +1603,7 @@ def show_my_nft_text(message):
     
     bot.send_message(message.chat.id, "🛒 Ваши NFT слоты:", reply_markup=keyboard)
 
+@router.route("myslot_", int)
 def show_my_slot_details(call, slot_id):
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("❌ Удалить", callback_data=f"delete_{slot_id}"))
@@ -987,77 +1615,73 @@ def show_my_slot_details(call, slot_id):
         reply_markup=keyboard
     )
 
+@router.route("delete_", int)
 def delete_slot(call, slot_id):
     user_id = call.from_user.id
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
     
     # Проверяем, принадлежит ли слот пользователю
-    cursor.execute('SELECT seller_id FROM slots WHERE slot_id = ?', (slot_id,))
-    slot = cursor.fetchone()
+    with db_read() as cursor:
+        cursor.execute('SELECT seller_id FROM slots WHERE slot_id = ?', (slot_id,))
+        slot = cursor.fetchone()
     
     if not slot or slot[0] != user_id:
-        bot.answer_callback_query(call.id, "❌ Вы не можете удалить этот слот")
-        conn.close()
+        answer_callback(call, "❌ Вы не можете удалить этот слот")
         return
     
-    # Удаляем слот
-    cursor.execute('DELETE FROM slots WHERE slot_id = ?', (slot_id,))
-    conn.commit()
-    conn.close()
+    # Удаляем слот, если по нему нет незавершенной сделки: иначе эскроу покупателя
+    # осталось бы без слота (проверка и удаление - в одном запросе писателя)
+    deleted = db_execute('''
+        DELETE FROM slots WHERE slot_id = ? AND seller_id = ?
+        AND NOT EXISTS (SELECT 1 FROM purchases WHERE slot_id = ? AND status = 'pending')
+    ''', (slot_id, user_id, slot_id)).result()
+    if not deleted:
+        answer_callback(call, "❌ По слоту идет сделка - удалить его можно после ее завершения")
+        return
+    listing_index.refresh(slot_id)
     
-    bot.answer_callback_query(call.id, "✅ Слот удален")
     bot.send_message(call.message.chat.id, "✅ Слот успешно удален")
 
 # ПОДДЕРЖКА
+@menu.command("📞 Поддержка")
 def support_start_text(message):
     set_user_state(message.from_user.id, "waiting_support_message")
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main"))
-    
     bot.send_message(
         message.chat.id,
         "📞 Поддержка\n\nОпишите вашу проблему или вопрос:",
-        reply_markup=keyboard
+        reply_markup=BACK_TO_MAIN_MARKUP
     )
 
+@fsm.state("waiting_support_message")
 def process_support_message(message):
     user = message.from_user
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute(
-        'INSERT INTO support_tickets (user_id, message) VALUES (?, ?)',
-        (user.id, message.text)
-    )
-    ticket_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with db_write() as cursor:
+        cursor.execute(
+            'INSERT INTO support_tickets (user_id, message) VALUES (?, ?)',
+            (user.id, message.text)
+        )
+        ticket_id = cursor.lastrowid
     
     clear_user_state(user.id)
     
-    try:
-        # Отправляем всем админам
-        for admin_id in ADMINS:
-            try:
-                # Используем новую функцию для отображения username
-                display_username = get_user_display(user.id, user.username)
-                bot.send_message(
-                    admin_id,
-                    f"📞 Новый тикет #{ticket_id}\n\n"
-                    f"👤 Пользователь: @{display_username} (ID: {user.id})\n"
-                    f"💬 Сообщение: {message.text}"
-                )
-            except:
-                continue
-        bot.send_message(message.chat.id, "✅ Ваше сообщение отправлено администратору.")
-    except:
-        bot.send_message(message.chat.id, "❌ Ошибка при отправке сообщения.")
+    # Тикет уже сохранен и виден в списке тикетов; уведомления админам не ждем,
+    # ошибки их доставки разбирает bot.on_error
+    display_username = get_user_display(user.id, user.username)
+    for admin_id in ADMINS:
+        notify_user(
+            admin_id,
+            f"📞 Новый тикет #{ticket_id}\n\n"
+            f"👤 Пользователь: @{display_username} (ID: {user.id})\n"
+            f"💬 Сообщение: {message.text}"
+        )
+    bot.send_message(message.chat.id, "✅ Ваше сообщение отправлено администратору.")
     
     show_main_menu(message.chat.id, "Главное меню:")
 
 # ПРОМОКОДЫ - ТОЛЬКО В ПРОФИЛЕ
-def process_promocode_activation(message, user_id):
+@fsm.state("waiting_promocode")
+def process_promocode_activation(message):
+    user_id = message.from_user.id
     promocode = message.text.strip().upper()
     
     # Если пользователь ввел команду "назад" или подобное
@@ -1066,16 +1690,13 @@ def process_promocode_activation(message, user_id):
         show_main_menu(message.chat.id, "Главное меню:")
         return
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
     # Проверяем существование промокода
-    cursor.execute('SELECT promocode_id, amount, max_activations, current_activations FROM promocodes WHERE code = ?', (promocode,))
-    promocode_data = cursor.fetchone()
+    with db_read() as cursor:
+        cursor.execute('SELECT promocode_id, amount, max_activations, current_activations FROM promocodes WHERE code = ?', (promocode,))
+        promocode_data = cursor.fetchone()
     
     if not promocode_data:
         bot.send_message(message.chat.id, "❌ Промокод не найден. Попробуйте еще раз:")
-        conn.close()
         return
     
     promocode_id, amount, max_activations, current_activations = promocode_data
@@ -1083,49 +1704,39 @@ def process_promocode_activation(message, user_id):
     # Проверяем лимит активаций
     if current_activations >= max_activations:
         bot.send_message(message.chat.id, "❌ Лимит активаций промокода исчерпан")
-        conn.close()
         clear_user_state(user_id)
         return
     
     # Проверяем, активировал ли пользователь уже этот промокод
-    cursor.execute('SELECT activation_id FROM promocode_activations WHERE promocode_id = ? AND user_id = ?', (promocode_id, user_id))
-    existing_activation = cursor.fetchone()
+    with db_read() as cursor:
+        cursor.execute('SELECT activation_id FROM promocode_activations WHERE promocode_id = ? AND user_id = ?', (promocode_id, user_id))
+        existing_activation = cursor.fetchone()
     
     if existing_activation:
         bot.send_message(message.chat.id, "❌ Вы уже активировали этот промокод")
-        conn.close()
         clear_user_state(user_id)
         return
     
     # Активируем промокод
-    cursor.execute('UPDATE promocodes SET current_activations = current_activations + 1 WHERE promocode_id = ?', (promocode_id,))
-    cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
-    cursor.execute('INSERT INTO promocode_activations (promocode_id, user_id) VALUES (?, ?)', (promocode_id, user_id))
-    cursor.execute('INSERT INTO transactions (user_id, amount, type, description) VALUES (?, ?, ?, ?)',
-                 (user_id, amount, 'promocode', f'Активация промокода {promocode}'))
-    
-    conn.commit()
-    conn.close()
+    with db_write() as cursor:
+        cursor.execute('UPDATE promocodes SET current_activations = current_activations + 1 WHERE promocode_id = ?', (promocode_id,))
+        cursor.execute('INSERT INTO promocode_activations (promocode_id, user_id) VALUES (?, ?)', (promocode_id, user_id))
+        ledger.transfer(cursor, PROMOCODES, user_id, amount, 'promocode', f'Активация промокода {promocode}')
     
     clear_user_state(user_id)
     bot.send_message(message.chat.id, f"✅ Промокод активирован! На ваш баланс зачислено {format_balance(amount)} руб")
     show_main_menu(message.chat.id, "Главное меню:")
 
 # УПРАВЛЕНИЕ ПРОМОКОДАМИ (АДМИН)
+@menu.command("🎁 Промокоды", admin_only=True)
 def show_promocodes_management(message):
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(
-        InlineKeyboardButton("➕ Создать промокод", callback_data="admin_create_promocode"),
-        InlineKeyboardButton("📋 Список промокодов", callback_data="admin_list_promocodes")
-    )
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
-    
     bot.send_message(
         message.chat.id,
         "🎁 Управление промокодами\n\nВыберите действие:",
-        reply_markup=keyboard
+        reply_markup=PROMOCODES_MANAGEMENT_MARKUP
     )
 
+@fsm.state("waiting_promocode_name", admin_only=True)
 def process_promocode_name(message):
     code = message.text.strip().upper()
     
@@ -1133,23 +1744,19 @@ def process_promocode_name(message):
         bot.send_message(message.chat.id, "❌ Промокод должен содержать минимум 3 символа")
         return
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
     # Проверяем, существует ли уже такой промокод
-    cursor.execute('SELECT promocode_id FROM promocodes WHERE code = ?', (code,))
-    existing_promocode = cursor.fetchone()
+    with db_read() as cursor:
+        cursor.execute('SELECT promocode_id FROM promocodes WHERE code = ?', (code,))
+        existing_promocode = cursor.fetchone()
     
     if existing_promocode:
         bot.send_message(message.chat.id, "❌ Промокод с таким названием уже существует")
-        conn.close()
         return
     
-    conn.close()
-    
-    set_user_state(message.from_user.id, "waiting_promocode_amount", code)
+    set_user_state(message.from_user.id, "waiting_promocode_amount", code=code)
     bot.send_message(message.chat.id, f"🎁 Промокод: {code}\n💰 Введите сумму вознаграждения:")
 
+@fsm.state("waiting_promocode_amount", admin_only=True, code=str)
 def process_promocode_amount(message, code):
     try:
         amount = float(message.text)
@@ -1158,12 +1765,13 @@ def process_promocode_amount(message, code):
             bot.send_message(message.chat.id, "❌ Сумма должна быть больше 0")
             return
         
-        set_user_state(message.from_user.id, "waiting_promocode_activations", f"{code}|{amount}")
+        set_user_state(message.from_user.id, "waiting_promocode_activations", code=code, amount=amount)
         bot.send_message(message.chat.id, f"🎁 Промокод: {code}\n💰 Сумма: {format_balance(amount)} руб\n\nВведите количество активаций:")
         
     except ValueError:
         bot.send_message(message.chat.id, "❌ Введите корректную сумму")
 
+@fsm.state("waiting_promocode_activations", admin_only=True, code=str, amount=float)
 def process_promocode_activations(message, code, amount):
     try:
         max_activations = int(message.text)
@@ -1172,14 +1780,9 @@ def process_promocode_activations(message, code, amount):
             bot.send_message(message.chat.id, "❌ Количество активаций должно быть больше 0")
             return
         
-        conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute('INSERT INTO promocodes (code, amount, max_activations, created_by) VALUES (?, ?, ?, ?)',
-                     (code, amount, max_activations, message.from_user.id))
-        
-        conn.commit()
-        conn.close()
+        with db_write() as cursor:
+            cursor.execute('INSERT INTO promocodes (code, amount, max_activations, created_by) VALUES (?, ?, ?, ?)',
+                         (code, amount, max_activations, message.from_user.id))
         
         clear_user_state(message.from_user.id)
         bot.send_message(message.chat.id, f"✅ Промокод создан!\n\n🎁 Код: {code}\n💰 Сумма: {format_balance(amount)} руб\n🔄 Активаций: {max_activations}")
@@ -1188,123 +1791,397 @@ def process_promocode_activations(message, code, amount):
         bot.send_message(message.chat.id, "❌ Введите корректное число")
 
 # РАССЫЛКА (АДМИН)
+@menu.command("📢 Рассылка", admin_only=True)
 def show_broadcast_management(message):
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("📢 Сделать рассылку", callback_data="admin_broadcast"))
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
-    
     bot.send_message(
         message.chat.id,
         "📢 Управление рассылкой\n\nВыберите действие:",
-        reply_markup=keyboard
+        reply_markup=BROADCAST_MANAGEMENT_MARKUP
     )
 
-def process_broadcast_message(message):
-    broadcast_text = message.text
+# Все рассылки делят один лимит скорости
+broadcast_limiter = TokenBucket(BROADCAST_RATE)
+
+# Рассылки, которые сейчас отправляются в этом процессе: job_id -> Broadcast
+active_broadcasts = {}
+active_broadcasts_lock = Lock()
+
+BROADCAST_STATUS_TITLES = {
+    'running': "📢 Идет рассылка",
+    'paused': "⏸ Рассылка на паузе",
+    'cancelled': "🚫 Рассылка отменена",
+    'completed': "✅ Рассылка завершена!",
+    'failed': "⚠️ Рассылка остановлена из-за ошибки",
+}
+
+def broadcast_recipients(after_user_id=0):
+    """Получатели рассылки пачками по BROADCAST_BATCH_SIZE в порядке user_id, начиная после after_user_id"""
+    last_user_id = after_user_id
+    while True:
+        with db_read() as cursor:
+            cursor.execute('''
+                SELECT user_id FROM users
+                WHERE delivery_status = 'ok' AND user_id > ? AND is_banned = FALSE
+                ORDER BY user_id LIMIT ?
+            ''', (last_user_id, BROADCAST_BATCH_SIZE))
+            batch = [row[0] for row in cursor.fetchall()]
+        if not batch:
+            return
+        yield batch
+        last_user_id = batch[-1]
+
+def broadcast_progress_text(job_id, status, total, delivered, failed, rate=None):
+    if status == 'completed':
+        return (
+            f"✅ Рассылка завершена!\n\n"
+            f"👥 Всего пользователей: {total}\n"
+            f"✅ Успешно отправлено: {delivered}\n"
+            f"❌ Не удалось отправить: {failed}"
+        )
+    text = (
+        f"{BROADCAST_STATUS_TITLES[status]} #{job_id}: {delivered + failed}/{total}\n\n"
+        f"✅ Отправлено: {delivered}\n"
+        f"❌ Не удалось отправить: {failed}"
+    )
+    if rate is not None:
+        text += f"\n⚡ Скорость: {rate:.1f} сообщ/с"
+    return text
+
+def broadcast_controls(job_id, status):
+    """Кнопки управления под сообщением с прогрессом рассылки"""
+    if status == 'running':
+        return inline_markup([
+            InlineKeyboardButton("⏸ Пауза", callback_data=f"broadcast_pause_{job_id}"),
+            InlineKeyboardButton("🚫 Отменить", callback_data=f"broadcast_cancel_{job_id}"),
+        ])
+    if status in ('paused', 'failed'):
+        return inline_markup([
+            InlineKeyboardButton("▶️ Продолжить", callback_data=f"broadcast_resume_{job_id}"),
+            InlineKeyboardButton("🚫 Отменить", callback_data=f"broadcast_cancel_{job_id}"),
+        ])
+    return None
+
+def update_broadcast_status_message(job_id, chat_id, message_id, status, total, delivered, failed, rate=None):
+    try:
+        bot.edit_message_text(
+            broadcast_progress_text(job_id, status, total, delivered, failed, rate),
+            chat_id, message_id,
+            reply_markup=broadcast_controls(job_id, status),
+            wait=True
+        )
+    except telebot.apihelper.ApiTelegramException as e:
+        # "message is not modified" и удаленное сообщение не мешают рассылке
+        logger.debug(f"Broadcast #{job_id} status not updated: {e}")
+
+def send_broadcast_message(user_id, text):
+    try:
+        bot.send_message(user_id, text, priority=BULK, wait=True)
+    except Exception as e:
+        # 429 повторит сама рассылка; заблокировавшие бота помечаются и больше в рассылки не попадают
+        if classify_error(e) != RATE_LIMITED:
+            record_delivery_error(user_id, e)
+        raise
+
+def save_broadcast_checkpoint(job_id, broadcast):
+    """Сохраняет позицию и счетчики рассылки; статус паузы или отмены выставляют сами кнопки"""
+    db_execute('''
+        UPDATE broadcast_jobs
+        SET last_user_id = ?, delivered = ?, failed = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE job_id = ?
+    ''', (broadcast.checkpoint, broadcast.delivered, broadcast.failed, job_id)).result()
+
+def start_broadcast_job(job_id):
+    """Запускает (или продолжает с сохраненной позиции) рассылку в фоновом потоке"""
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT chat_id, status_message_id, text, last_user_id, total, delivered, failed
+            FROM broadcast_jobs WHERE job_id = ? AND status = 'running'
+        ''', (job_id,))
+        job = cursor.fetchone()
+    if not job:
+        return False
+    chat_id, message_id, text, last_user_id, total, delivered, failed = job
+    
+    with active_broadcasts_lock:
+        if job_id in active_broadcasts:
+            return False
+        broadcast = Broadcast(
+            broadcast_recipients(last_user_id),
+            lambda user_id: send_broadcast_message(user_id, text),
+            broadcast_limiter,
+            BROADCAST_WORKERS,
+            total=total,
+            delivered=delivered,
+            failed=failed,
+            checkpoint=last_user_id,
+            on_batch=lambda broadcast: save_broadcast_checkpoint(job_id, broadcast),
+            on_progress=lambda broadcast: update_broadcast_status_message(
+                job_id, chat_id, message_id, broadcast.status if broadcast.finished else 'running',
+                broadcast.total, broadcast.delivered, broadcast.failed,
+                None if broadcast.finished else broadcast.rate()
+            ),
+            on_finish=lambda broadcast: finish_broadcast_job(job_id, broadcast),
+            progress_interval=BROADCAST_PROGRESS_INTERVAL,
+        )
+        active_broadcasts[job_id] = broadcast
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
+    broadcast.start()
+    return True
+
+def finish_broadcast_job(job_id, broadcast):
+    """Сохраняет итог рассылки; если она упала с ошибкой, ставит на паузу - продолжить можно кнопкой"""
+    status = 'paused' if broadcast.status == 'failed' else broadcast.status
+    try:
+        with db_write() as cursor:
+            cursor.execute('''
+                UPDATE broadcast_jobs
+                SET status = CASE WHEN status = 'running' THEN ? ELSE status END,
+                    last_user_id = ?, delivered = ?, failed = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = ?
+            ''', (status, broadcast.checkpoint, broadcast.delivered, broadcast.failed, job_id))
+    finally:
+        with active_broadcasts_lock:
+            active_broadcasts.pop(job_id, None)
+
+def resume_broadcast_jobs():
+    """Продолжает рассылки, прерванные перезапуском, с последней сохраненной позиции"""
+    with db_read() as cursor:
+        cursor.execute("SELECT job_id FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id")
+        job_ids = [row[0] for row in cursor.fetchall()]
+    for job_id in job_ids:
+        logger.info(f"Resuming broadcast #{job_id}")
+        start_broadcast_job(job_id)
+
+@fsm.state("waiting_broadcast_message", admin_only=True)
+def process_broadcast_message(message):
+    broadcast_text = message.text
+    clear_user_state(message.from_user.id)
     
-    cursor.execute('SELECT user_id FROM users WHERE is_banned = FALSE')
-    users = cursor.fetchall()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE delivery_status = 'ok' AND is_banned = FALSE")
+        total_users = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM users WHERE delivery_status != 'ok'")
+        undeliverable = cursor.fetchone()[0]
     
-    total_users = len(users)
-    successful_sends = 0
-    failed_sends = 0
+    status = bot.send_message(
+        message.chat.id,
+        f"📢 Начинаю рассылку для {total_users} пользователей...\n"
+        f"🚫 Пропущено заблокировавших бота: {undeliverable}",
+        wait=True
+    )
     
-    bot.send_message(message.chat.id, f"📢 Начинаю рассылку для {total_users} пользователей...")
+    with db_write() as cursor:
+        cursor.execute('''
+            INSERT INTO broadcast_jobs (admin_id, chat_id, status_message_id, text, total)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (message.from_user.id, message.chat.id, status.message_id, broadcast_text, total_users))
+        job_id = cursor.lastrowid
+    
+    # Отправка идет в фоне, обработчик сразу освобождается
+    start_broadcast_job(job_id)
+
+def change_broadcast_status(call, job_id, status, allowed_from):
+    """Меняет статус рассылки из кнопки; возвращает строку задачи или None"""
+    with db_write() as cursor:
+        cursor.execute(f'''
+            UPDATE broadcast_jobs SET status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND status IN ({', '.join('?' * len(allowed_from))})
+        ''', (status, job_id, *allowed_from))
+        changed = cursor.rowcount
+    if not changed:
+        answer_callback(call, "❌ Действие недоступно для этой рассылки")
+        return None
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT chat_id, status_message_id, total, delivered, failed
+            FROM broadcast_jobs WHERE job_id = ?
+        ''', (job_id,))
+        return cursor.fetchone()
+
+@router.route("broadcast_pause_", int, admin_only=True)
+def broadcast_pause_callback(call, job_id):
+    job = change_broadcast_status(call, job_id, 'paused', ('running',))
+    if not job:
+        return
+    with active_broadcasts_lock:
+        broadcast = active_broadcasts.get(job_id)
+    if broadcast is not None:
+        # Остановится после текущей пачки и сам сохранит позицию
+        broadcast.stop('paused')
+    else:
+        update_broadcast_status_message(job_id, job[0], job[1], 'paused', *job[2:])
+    answer_callback(call, "⏸ Рассылка будет приостановлена")
+
+@router.route("broadcast_resume_", int, admin_only=True)
+def broadcast_resume_callback(call, job_id):
+    with active_broadcasts_lock:
+        stopping = job_id in active_broadcasts
+    if stopping:
+        answer_callback(call, "⏳ Рассылка еще останавливается, попробуйте через несколько секунд")
+        return
+    if not change_broadcast_status(call, job_id, 'running', ('paused',)):
+        return
+    start_broadcast_job(job_id)
+    answer_callback(call, "▶️ Рассылка продолжается")
+
+@router.route("broadcast_cancel_", int, admin_only=True)
+def broadcast_cancel_callback(call, job_id):
+    job = change_broadcast_status(call, job_id, 'cancelled', ('running', 'paused'))
+    if not job:
+        return
+    with active_broadcasts_lock:
+        broadcast = active_broadcasts.get(job_id)
+    if broadcast is not None:
+        broadcast.stop('cancelled')
+    else:
+        update_broadcast_status_message(job_id, job[0], job[1], 'cancelled', *job[2:])
+    answer_callback(call, "🚫 Рассылка отменена")
+
+@router.route("admin_broadcast_jobs", admin_only=True)
+def admin_broadcast_jobs_callback(call):
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT job_id, status, total, delivered, failed, created_at
+            FROM broadcast_jobs ORDER BY job_id DESC LIMIT 10
+        ''')
+        jobs = cursor.fetchall()
     
-    for user in users:
-        user_id = user[0]
-        try:
-            bot.send_message(user_id, broadcast_text)
-            successful_sends += 1
-        except:
-            failed_sends += 1
+    if not jobs:
+        bot.send_message(call.message.chat.id, "📋 Рассылок пока не было", reply_markup=BACK_TO_ADMIN_MARKUP)
+        return
     
-    clear_user_state(message.from_user.id)
-    bot.send_message(
-        message.chat.id,
-        f"✅ Рассылка завершена!\n\n"
-        f"👥 Всего пользователей: {total_users}\n"
-        f"✅ Успешно отправлено: {successful_sends}\n"
-        f"❌ Не удалось отправить: {failed_sends}"
-    )
+    text = "📋 Последние рассылки:\n\n"
+    keyboard = InlineKeyboardMarkup()
+    for job_id, status, total, delivered, failed, created_at in jobs:
+        text += f"#{job_id} {BROADCAST_STATUS_TITLES[status]}: {delivered + failed}/{total} (❌ {failed}), {created_at}\n"
+        if status == 'running':
+            keyboard.add(InlineKeyboardButton(f"⏸ Пауза #{job_id}", callback_data=f"broadcast_pause_{job_id}"))
+        elif status == 'paused':
+            keyboard.add(InlineKeyboardButton(f"▶️ Продолжить #{job_id}", callback_data=f"broadcast_resume_{job_id}"))
+    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
+    bot.send_message(call.message.chat.id, text, reply_markup=keyboard)
 
 # АДМИН ФУНКЦИИ
+@menu.command("📊 Статистика", admin_only=True)
 def show_stats(message):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM slots WHERE is_active = TRUE')
-    active_slots = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT SUM(balance) FROM users')
-    total_balance = cursor.fetchone()[0] or 0
-    
-    cursor.execute('SELECT COUNT(*) FROM support_tickets WHERE status = "open"')
-    open_tickets = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM withdraw_requests WHERE status = "pending"')
-    pending_withdrawals = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM purchases WHERE status = "pending"')
-    pending_purchases = cursor.fetchone()[0]
-    
-    # Статистика сделок
-    cursor.execute('SELECT COUNT(*) FROM purchases WHERE status = "completed"')
-    successful_deals = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM purchases WHERE status = "pending"')
-    failed_deals = cursor.fetchone()[0]
-    
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM users')
+        total_users = cursor.fetchone()[0]
+        
+        cursor.execute("SELECT COUNT(*) FROM users WHERE delivery_status != 'ok'")
+        undeliverable_users = cursor.fetchone()[0]
+        
+        cursor.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+        outbox_pending = cursor.fetchone()[0]
+        
+        cursor.execute('SELECT COUNT(*) FROM slots WHERE is_active = TRUE')
+        active_slots = cursor.fetchone()[0]
+        
+        cursor.execute('SELECT SUM(balance) FROM users')
+        total_balance = cursor.fetchone()[0] or 0
+        
+        cursor.execute('SELECT COUNT(*) FROM support_tickets WHERE status = "open"')
+        open_tickets = cursor.fetchone()[0]
+        
+        cursor.execute('SELECT COUNT(*) FROM withdraw_requests WHERE status = "pending"')
+        pending_withdrawals = cursor.fetchone()[0]
+        
+        cursor.execute('SELECT COUNT(*) FROM purchases WHERE status = "pending"')
+        pending_purchases = cursor.fetchone()[0]
+        
+        # Статистика сделок
+        cursor.execute('SELECT COUNT(*) FROM purchases WHERE status = "completed"')
+        successful_deals = cursor.fetchone()[0]
+        
+        cursor.execute('SELECT COUNT(*) FROM purchases WHERE status = "pending"')
+        failed_deals = cursor.fetchone()[0]
+        
+        # Системные счета журнала
+        escrow_balance = ledger.balance_at(cursor, ESCROW)
+        withdrawals_balance = ledger.balance_at(cursor, WITHDRAWALS)
+        cursor.execute('SELECT COALESCE(MAX(txn_id), 0) FROM ledger_txns')
+        ledger_txns = cursor.fetchone()[0]
+    
+    cache_stats = subscription_cache.stats()
+    state_stats = state_store.stats()
+    index_stats = listing_index.stats()
+    outbound_stats = outbound.stats()
+    lane_stats = update_lanes.stats()
+    db_writer_stats = writer_stats()
     
     stats_text = (
         f"📊 Статистика платформы\n\n"
         f"👥 Всего пользователей: {total_users}\n"
+        f"🚫 Заблокировали бота: {undeliverable_users}\n"
         f"🎁 Активных слотов: {active_slots}\n"
         f"💰 Общий баланс: {format_balance(total_balance)} руб\n"
         f"📞 Открытых тикетов: {open_tickets}\n"
         f"💸 Заявок на вывод: {pending_withdrawals}\n"
         f"🛒 Ожидающих сделок: {pending_purchases}\n"
         f"✅ Успешных сделок: {successful_deals}\n"
-        f"❌ Неудачных сделок: {failed_deals}"
+        f"❌ Неудачных сделок: {failed_deals}\n"
+        f"📒 Журнал: {ledger_txns} проводок, в эскроу {format_balance(escrow_balance)} руб, "
+        f"на выводе {format_balance(withdrawals_balance)} руб; последняя сверка: "
+        f"{'не было' if ledger_audit['at'] is None else str(len(ledger_audit['mismatches'])) + ' расхождений'}\n"
+        f"⏰ Просроченные сделки: {escrow_sweep_stats['cancelled']} отменено, {escrow_sweep_stats['completed']} завершено\n"
+        f"📡 Кэш подписок: {cache_stats['hits']} попаданий / {cache_stats['misses']} промахов\n"
+        f"🧠 Кэш состояний: {state_stats['hits']} попаданий / {state_stats['misses']} промахов, "
+        f"{state_stats['dirty']} ждут записи, {state_stats['in_flight']} пишутся\n"
+        f"📚 Индекс слотов: {index_stats['size']} слотов, {index_stats['sellers']} продавцов, "
+        f"{listing_index.memory_usage() / 1024 / 1024:.1f} МБ\n"
+        f"💾 Запись в базу: {db_writer_stats['jobs']} заданий в {db_writer_stats['groups']} транзакциях "
+        f"(макс. {db_writer_stats['max_group']}), {db_writer_stats['failed']} ошибок, {db_writer_stats['queued']} в очереди\n"
+        f"📤 Очередь отправки: {outbound_stats['depth']} в очереди, {outbox_pending} уведомлений в outbox"
     )
+    for name, item in outbound_stats['priorities'].items():
+        stats_text += (
+            f"\n  {name}: {item['sent']} отправлено, ожидание {item['avg_wait_ms']:.0f} мс "
+            f"(макс. {item['max_wait_ms']:.0f}), {item['retried']} повторов, "
+            f"{item['failed']} ошибок, {item['dropped']} отброшено"
+        )
     
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
+    stats_text += (
+        f"\n\n🛣 Полосы апдейтов ({len(lane_stats)}): "
+        f"{sum(item['processed'] for item in lane_stats)} обработано, "
+        f"{sum(item['errors'] for item in lane_stats)} ошибок, {sum(item['rejected'] for item in lane_stats)} отклонено\n"
+        f"  в очереди: {' '.join(str(item['depth']) for item in lane_stats)}\n"
+        f"  максимум: {' '.join(str(item['max_depth']) for item in lane_stats)}"
+    )
     
-    bot.send_message(message.chat.id, stats_text, reply_markup=keyboard)
+    callback_latency = router.latency()
+    if callback_latency['ack'][0] is not None:
+        stats_text += (
+            f"\n\n🖱 Кнопки: ответ на нажатие p50 {callback_latency['ack'][0]:.0f} мс, p99 {callback_latency['ack'][1]:.0f} мс; "
+            f"обработка p50 {callback_latency['done'][0]:.0f} мс, p99 {callback_latency['done'][1]:.0f} мс"
+        )
+    
+    route_stats = router.stats()[:5]
+    if route_stats:
+        stats_text += "\n\n🔀 Частые кнопки:\n"
+        for item in route_stats:
+            stats_text += f"{item['pattern']}: {item['calls']} раз, {item['avg_ms']:.1f} мс в среднем, макс. {item['max_ms']:.1f} мс\n"
+    
+    bot.send_message(message.chat.id, stats_text, reply_markup=BACK_TO_ADMIN_MARKUP)
 
+@menu.command("📞 Тикеты", admin_only=True)
 def show_tickets(message):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT ticket_id, user_id, message, created_at 
-        FROM support_tickets 
-        WHERE status = 'open'
-        ORDER BY created_at DESC
-    ''')
-    tickets = cursor.fetchall()
+    # Username пользователя получаем тем же запросом
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT t.ticket_id, t.user_id, t.message, t.created_at, u.username
+            FROM support_tickets t
+            LEFT JOIN users u ON t.user_id = u.user_id
+            WHERE t.status = 'open'
+            ORDER BY t.created_at DESC
+        ''')
+        tickets = cursor.fetchall()
     
     if not tickets:
         bot.send_message(message.chat.id, "📭 Нет открытых тикетов")
-        conn.close()
         return
     
     for ticket in tickets:
-        ticket_id, user_id, ticket_message, created_at = ticket
-        
-        # Получаем username пользователя используя тот же курсор
-        cursor.execute('SELECT username FROM users WHERE user_id = ?', (user_id,))
-        user_info = cursor.fetchone()
-        username = user_info[0] if user_info else "Не указан"
+        ticket_id, user_id, ticket_message, created_at, username = ticket
         
         # Используем новую функцию для отображения username
         display_username = get_user_display(user_id, username)
@@ -1322,34 +2199,27 @@ def show_tickets(message):
         keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
         
         bot.send_message(message.chat.id, ticket_text, reply_markup=keyboard)
-    
-    conn.close()
 
+@menu.command("💰 Заявки на вывод", admin_only=True)
 def show_withdraw_requests(message):
     try:
-        conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT withdraw_id, user_id, amount, card_number, created_at 
-            FROM withdraw_requests 
-            WHERE status = 'pending'
-            ORDER BY created_at DESC
-        ''')
-        requests = cursor.fetchall()
+        # Username пользователя получаем тем же запросом
+        with db_read() as cursor:
+            cursor.execute('''
+                SELECT w.withdraw_id, w.user_id, w.amount, w.card_number, w.created_at, u.username
+                FROM withdraw_requests w
+                LEFT JOIN users u ON w.user_id = u.user_id
+                WHERE w.status = 'pending'
+                ORDER BY w.created_at DESC
+            ''')
+            requests = cursor.fetchall()
         
         if not requests:
             bot.send_message(message.chat.id, "📭 Нет заявок на вывод")
-            conn.close()
             return
         
         for req in requests:
-            withdraw_id, user_id, amount, card_number, created_at = req
-            
-            # Получаем username пользователя используя тот же курсор
-            cursor.execute('SELECT username FROM users WHERE user_id = ?', (user_id,))
-            user_info = cursor.fetchone()
-            username = user_info[0] if user_info else "Не указан"
+            withdraw_id, user_id, amount, card_number, created_at, username = req
             
             # Используем новую функцию для отображения username
             display_username = get_user_display(user_id, username)
@@ -1372,256 +2242,244 @@ def show_withdraw_requests(message):
             
             bot.send_message(message.chat.id, request_text, reply_markup=keyboard)
         
-        conn.close()
-        
     except Exception as e:
         logger.error(f"Error in show_withdraw_requests: {e}")
         bot.send_message(message.chat.id, "❌ Ошибка при загрузке заявок на вывод")
 
+@menu.command("👥 Пользователи", admin_only=True)
 def show_users_management(message):
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(
-        InlineKeyboardButton("👤 Забанить пользователя", callback_data="admin_ban"),
-        InlineKeyboardButton("👤 Разбанить пользователя", callback_data="admin_unban"),
-        InlineKeyboardButton("📋 Список пользователей", callback_data="admin_list_users")
-    )
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
-    
     bot.send_message(
         message.chat.id,
         "👥 Управление пользователями\n\nВыберите действие:",
-        reply_markup=keyboard
+        reply_markup=USERS_MANAGEMENT_MARKUP
     )
 
+@menu.command("💳 Управление балансом", admin_only=True)
 def show_balance_management(message):
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(
-        InlineKeyboardButton("💸 Пополнить баланс", callback_data="admin_add_balance"),
-        InlineKeyboardButton("📋 Балансы пользователей", callback_data="admin_list_balances")
-    )
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
-    
     bot.send_message(
         message.chat.id,
         "💳 Управление балансами\n\nВыберите действие:",
-        reply_markup=keyboard
+        reply_markup=BALANCE_MANAGEMENT_MARKUP
     )
 
+@menu.command("👑 Управление админами", admin_only=True)
 def show_admin_management(message):
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(
-        InlineKeyboardButton("👑 Добавить админа", callback_data="admin_add_admin"),
-        InlineKeyboardButton("👑 Удалить админа", callback_data="admin_remove_admin"),
-        InlineKeyboardButton("📋 Список админов", callback_data="admin_list_admins")
-    )
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
-    
     bot.send_message(
         message.chat.id,
         "👑 Управление администраторами\n\nВыберите действие:",
-        reply_markup=keyboard
+        reply_markup=ADMIN_MANAGEMENT_MARKUP
     )
 
 # ОБРАБОТЧИК ИНЛАЙН КНОПОК
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback(call):
-    user_id = call.from_user.id
-    data = call.data
-    
-    # Проверяем доступ для всех callback'ов (кроме админов и проверки подписки)
-    if data != "check_subscription" and not is_user_admin(user_id):
-        access, message_text = check_access(user_id)
-        if not access:
-            if message_text == "subscribe_required":
-                show_subscription_required(call.message.chat.id)
-            else:
-                bot.send_message(call.message.chat.id, message_text)
+    received = call.received = time.perf_counter()
+    resolved = router.resolve(call.data)
+    if resolved is None:
+        bot.answer_callback_query(call.id, "❌ Неизвестная команда")
+        return
+    
+    route, args = resolved
+    ctx = UserContext(call.from_user.id)
+    
+    # Проверяем доступ (кроме админов и маршрутов, не требующих подписки)
+    if not ctx.is_admin:
+        if not route.subscription_exempt:
+            access, message_text = check_access(ctx)
+            if not access:
+                bot.answer_callback_query(call.id)
+                if message_text == "subscribe_required":
+                    show_subscription_required(call.message.chat.id)
+                else:
+                    bot.send_message(call.message.chat.id, message_text)
+                return
+        if route.admin_only:
             bot.answer_callback_query(call.id)
             return
     
+    # Долгие маршруты (ack=) получают ответ на нажатие сразу, не дожидаясь обработчика:
+    # кнопка перестает "крутиться", а результат обработчик присылает сообщением.
+    # Остальные отвечают сами через answer_callback - итоговым текстом во всплывающем окне
+    if route.ack:
+        call.acked = True
+        callback_ack_pool.submit(ack_callback, call, route.ack, received)
     try:
-        if data == "back_to_main":
-            show_main_menu(call.message.chat.id, "Главное меню:")
-        elif data == "back_to_admin":
-            show_admin_menu(call.message.chat.id)
-        elif data == "back_to_slots":
-            find_slots_text(call.message)
-        elif data == "back_to_my_nft":
-            show_my_nft_text(call.message)
-        elif data == "check_subscription":
-            handle_subscription_check(call)
-        elif data == "change_name":
-            set_user_state(user_id, "waiting_name_change")
-            bot.send_message(call.message.chat.id, "✏️ Введите ваше новое имя:")
-        elif data == "withdraw_balance":
-            withdraw_start_callback(call)
-        elif data == "transfer_money":
-            transfer_money_start(call)
-        elif data == "my_reviews":
-            show_my_reviews(call)
-        elif data == "activate_promocode":
-            # Для промокода в профиле не проверяем подписку дополнительно
-            set_user_state(user_id, "waiting_promocode")
-            keyboard = InlineKeyboardMarkup()
-            keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main"))
-            
-            bot.send_message(
-                call.message.chat.id,
-                "🎁 Активация промокода\n\nВведите промокод:",
-                reply_markup=keyboard
-            )
-            bot.answer_callback_query(call.id)
-        elif data.startswith("slot_"):
-            slot_id = int(data.split("_")[1])
-            show_slot_details(call, slot_id)
-        elif data.startswith("myslot_"):
-            slot_id = int(data.split("_")[1])
-            show_my_slot_details(call, slot_id)
-        elif data.startswith("buy_"):
-            slot_id = int(data.split("_")[1])
-            buy_nft(call, slot_id)
-        elif data.startswith("delete_"):
-            slot_id = int(data.split("_")[1])
-            delete_slot(call, slot_id)
-        elif data.startswith("contact_"):
-            slot_id = int(data.split("_")[1])
-            show_contact_info(call, slot_id)
-        elif data.startswith("reviews_"):
-            user_id_to_show = int(data.split("_")[1])
-            review_type = data.split("_")[2]
-            show_reviews(call, user_id_to_show, review_type)
-        elif data.startswith("rate_buyer_"):
-            purchase_id = int(data.split("_")[2])
-            start_rating(call, purchase_id, "buyer")
-        elif data.startswith("rate_seller_"):
-            purchase_id = int(data.split("_")[2])
-            start_rating(call, purchase_id, "seller")
-        elif data.startswith("rating_"):
-            parts = data.split("_")
-            purchase_id = int(parts[1])
-            rate_type = parts[2]
-            rating = int(parts[3])
-            set_user_state(user_id, "waiting_rating", f"{purchase_id}|{rate_type}|{rating}")
-            bot.send_message(call.message.chat.id, f"💬 Напишите отзыв (или отправьте '-' если не хотите писать отзыв):")
-        elif data.startswith("admin_"):
-            if is_user_admin(user_id):
-                handle_admin_callback(call)
-        elif data.startswith("reply_ticket_"):
-            if is_user_admin(user_id):
-                ticket_id = int(data.split("_")[2])
-                set_user_state(user_id, "waiting_ticket_reply", str(ticket_id))
-                bot.send_message(call.message.chat.id, f"💬 Введите ответ на тикет #{ticket_id}:")
-        elif data.startswith("approve_withdraw_"):
-            if is_user_admin(user_id):
-                withdraw_id = int(data.split("_")[2])
-                approve_withdraw(call, withdraw_id)
-        elif data.startswith("reject_withdraw_"):
-            if is_user_admin(user_id):
-                withdraw_id = int(data.split("_")[2])
-                set_user_state(user_id, "waiting_reject_reason", str(withdraw_id))
-                bot.send_message(call.message.chat.id, f"📝 Введите причину отказа для заявки #{withdraw_id}:")
-        elif data.startswith("select_user_"):
-            if is_user_admin(user_id):
-                parts = data.split("_")
-                user_id_selected = int(parts[2])
-                action_type = parts[3]
-                handle_selected_user_action(call, user_id_selected, action_type)
-        elif data.startswith("confirm_send_"):
-            slot_id = int(data.split("_")[2])
-            confirm_send_nft(call, slot_id)
-        elif data.startswith("confirm_receive_"):
-            slot_id = int(data.split("_")[2])
-            confirm_receive_nft(call, slot_id)
-        elif data.startswith("cancel_deal_"):
-            slot_id = int(data.split("_")[2])
-            cancel_deal(call, slot_id)
-        else:
-            bot.answer_callback_query(call.id, "❌ Неизвестная команда")
+        router.call(route, call, args)
     except Exception as e:
-        logger.error(f"Error in callback handler: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка обработки команды")
+        logger.error(f"Error in callback handler {route.pattern}: {e}")
+        answer_callback(call, "❌ Ошибка обработки команды")
+    finally:
+        if not getattr(call, 'acked', False):
+            # Обработчику нечего было сказать - просто гасим "часики" на кнопке
+            call.acked = True
+            ack_callback(call, None, received)
+        router.done_latency.add(time.perf_counter() - received)
+
+def ack_callback(call, text, received):
+    try:
+        bot.answer_callback_query(call.id, text)
+    except Exception as e:
+        logger.error(f"Error answering callback: {e}")
+    router.ack_latency.add(time.perf_counter() - received)
+
+def answer_callback(call, text):
+    """Показывает пользователю результат нажатия кнопки.
+    
+    Первый ответ - всплывающее окно над кнопкой. Если на нажатие уже ответили
+    (маршрут с ack=), второй ответ Telegram не примет - текст приходит отдельным сообщением.
+    """
+    if getattr(call, 'acked', False):
+        bot.send_message(call.message.chat.id, text)
+    else:
+        call.acked = True
+        ack_callback(call, text, call.received)
+
+@router.route("back_to_main")
+def back_to_main_callback(call):
+    show_main_menu(call.message.chat.id, "Главное меню:")
+
+@router.route("back_to_admin", admin_only=True)
+def back_to_admin_callback(call):
+    show_admin_menu(call.message.chat.id)
+
+@router.route("back_to_slots")
+def back_to_slots_callback(call):
+    send_slots_page(call.message.chat.id, call.from_user.id)
+
+@router.route("back_to_my_nft")
+def back_to_my_nft_callback(call):
+    show_my_nft_text(call.message)
+
+@router.route("change_name")
+def change_name_callback(call):
+    set_user_state(call.from_user.id, "waiting_name_change")
+    bot.send_message(call.message.chat.id, "✏️ Введите ваше новое имя:")
+
+@router.route("activate_promocode")
+def activate_promocode_callback(call):
+    set_user_state(call.from_user.id, "waiting_promocode")
+    bot.send_message(
+        call.message.chat.id,
+        "🎁 Активация промокода\n\nВведите промокод:",
+        reply_markup=BACK_TO_MAIN_MARKUP
+    )
+
+@router.route("rate_buyer_", int)
+def rate_buyer_callback(call, purchase_id):
+    start_rating(call, purchase_id, "buyer")
+
+@router.route("rate_seller_", int)
+def rate_seller_callback(call, purchase_id):
+    start_rating(call, purchase_id, "seller")
+
+@router.route("rating_", int, str, int)
+def rating_callback(call, purchase_id, rate_type, rating):
+    set_user_state(call.from_user.id, "waiting_rating", purchase_id=purchase_id, rate_type=rate_type, rating=rating)
+    bot.send_message(call.message.chat.id, f"💬 Напишите отзыв (или отправьте '-' если не хотите писать отзыв):")
+
+@router.route("reply_ticket_", int, admin_only=True)
+def reply_ticket_callback(call, ticket_id):
+    set_user_state(call.from_user.id, "waiting_ticket_reply", ticket_id=ticket_id)
+    bot.send_message(call.message.chat.id, f"💬 Введите ответ на тикет #{ticket_id}:")
+
+@router.route("reject_withdraw_", int, admin_only=True)
+def reject_withdraw_callback(call, withdraw_id):
+    set_user_state(call.from_user.id, "waiting_reject_reason", withdraw_id=withdraw_id)
+    bot.send_message(call.message.chat.id, f"📝 Введите причину отказа для заявки #{withdraw_id}:")
+
+@router.route("admin_ban", admin_only=True)
+def admin_ban_callback(call):
+    show_user_selection(call.message, "ban")
+
+@router.route("admin_unban", admin_only=True)
+def admin_unban_callback(call):
+    show_user_selection(call.message, "unban")
+
+@router.route("admin_add_balance", admin_only=True)
+def admin_add_balance_callback(call):
+    show_user_selection(call.message, "balance")
+
+@router.route("admin_remove_admin", admin_only=True)
+def admin_remove_admin_callback(call):
+    show_user_selection(call.message, "remove_admin")
+
+@router.route("admin_create_promocode", admin_only=True)
+def admin_create_promocode_callback(call):
+    set_user_state(call.from_user.id, "waiting_promocode_name")
+    bot.send_message(call.message.chat.id, "🎁 Введите название промокода:")
+
+@router.route("admin_broadcast", admin_only=True)
+def admin_broadcast_callback(call):
+    set_user_state(call.from_user.id, "waiting_broadcast_message")
+    bot.send_message(call.message.chat.id, "📢 Введите сообщение для рассылки:")
+
+@router.route("admin_add_admin", admin_only=True)
+def admin_add_admin_callback(call):
+    set_user_state(call.from_user.id, "waiting_add_admin")
+    bot.send_message(call.message.chat.id, "👑 Введите ID пользователя для добавления в админы:")
 
 # ФУНКЦИЯ ДЛЯ ПРОВЕРКИ ПОДПИСКИ
+@router.route("check_subscription", subscription_exempt=True)
 def handle_subscription_check(call):
     user_id = call.from_user.id
     
-    if check_subscription(user_id):
-        update_user_subscription(user_id, True)
-        bot.answer_callback_query(call.id, "✅ Спасибо за подписку!")
+    # Пользователь только что подписался - кэшированный отказ не учитываем
+    if check_subscription(user_id, fresh=True):
         show_main_menu(call.message.chat.id, "Добро пожаловать в NFT Marketplace! 🎨\n\nЗдесь вы можете покупать и продавать NFT подарки.\nВыберите действие:")
     else:
-        bot.answer_callback_query(call.id, "❌ Вы не подписаны на канал")
+        answer_callback(call, "❌ Вы не подписаны на канал")
         show_subscription_required(call.message.chat.id)
 
-def handle_admin_callback(call):
-    data = call.data
-    
-    if data == "admin_ban":
-        show_user_selection(call.message, "ban")
-    elif data == "admin_unban":
-        show_user_selection(call.message, "unban")
-    elif data == "admin_add_balance":
-        show_user_selection(call.message, "balance")
-    elif data == "admin_list_users":
-        show_all_users(call)
-    elif data == "admin_list_balances":
-        show_all_balances(call)
-    elif data == "admin_create_promocode":
-        set_user_state(call.from_user.id, "waiting_promocode_name")
-        bot.send_message(call.message.chat.id, "🎁 Введите название промокода:")
-    elif data == "admin_list_promocodes":
-        show_all_promocodes(call)
-    elif data == "admin_broadcast":
-        set_user_state(call.from_user.id, "waiting_broadcast_message")
-        bot.send_message(call.message.chat.id, "📢 Введите сообщение для рассылки:")
-    elif data == "admin_add_admin":
-        set_user_state(call.from_user.id, "waiting_add_admin")
-        bot.send_message(call.message.chat.id, "👑 Введите ID пользователя для добавления в админы:")
-    elif data == "admin_remove_admin":
-        show_user_selection(call.message, "remove_admin")
-    elif data == "admin_list_admins":
-        show_all_admins(call)
-
 # ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ
+@router.route("withdraw_balance")
 def withdraw_start_callback(call):
     user_id = call.from_user.id
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
     
     if not result or result[0] <= 0:
-        bot.answer_callback_query(call.id, "❌ На балансе нет средств")
+        answer_callback(call, "❌ На балансе нет средств")
         return
     
     balance = result[0]
-    set_user_state(user_id, "waiting_withdraw_card", str(balance))
+    set_user_state(user_id, "waiting_withdraw_card", balance=balance)
     bot.send_message(call.message.chat.id, f"💰 Ваш баланс: {format_balance(balance)} руб\n\nВведите номер карты:")
 
-def process_withdraw_card(message, balance, user_id):
+@fsm.state("waiting_withdraw_card", balance=float)
+def process_withdraw_card(message, balance):
+    user_id = message.from_user.id
     card = message.text.strip()
     if len(card) < 16:
         bot.send_message(message.chat.id, "❌ Неверный номер карты")
         return
     
-    set_user_state(user_id, "waiting_withdraw_amount", f"{balance}|{card}")
+    set_user_state(user_id, "waiting_withdraw_amount", balance=balance, card=card)
     bot.send_message(message.chat.id, f"💳 Карта: {card}\n💰 Доступно: {format_balance(balance)} руб\n\nВведите сумму:")
 
-def process_withdraw_amount(message, balance, user_id, card):
+def create_withdraw_request(cursor, user_id, amount, card):
+    """Создает заявку и резервирует сумму на счете выводов. False - не хватает средств"""
+    cursor.execute('INSERT INTO withdraw_requests (user_id, amount, card_number) VALUES (?, ?, ?)',
+                   (user_id, amount, card))
+    withdraw_id = cursor.lastrowid
+    if not ledger.transfer(cursor, user_id, WITHDRAWALS, amount, 'withdraw_hold',
+                           f'Заявка на вывод #{withdraw_id}', check_funds=True):
+        cursor.execute('DELETE FROM withdraw_requests WHERE withdraw_id = ?', (withdraw_id,))
+        return False
+    return True
+
+@fsm.state("waiting_withdraw_amount", balance=float, card=str)
+def process_withdraw_amount(message, balance, card):
+    user_id = message.from_user.id
     try:
         amount = float(message.text)
         if amount <= 0 or amount > balance:
             bot.send_message(message.chat.id, f"❌ Неверная сумма. Максимум: {format_balance(balance)} руб")
             return
         
-        conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (amount, user_id))
-        cursor.execute('INSERT INTO withdraw_requests (user_id, amount, card_number) VALUES (?, ?, ?)',
-                     (user_id, amount, card))
-        conn.commit()
-        conn.close()
+        if not db_submit(create_withdraw_request, user_id, amount, card).result():
+            bot.send_message(message.chat.id, "❌ Недостаточно средств")
+            return
         
         clear_user_state(user_id)
         bot.send_message(message.chat.id, f"✅ Заявка на вывод {format_balance(amount)} руб создана!")
@@ -1630,11 +2488,14 @@ def process_withdraw_amount(message, balance, user_id, card):
     except ValueError:
         bot.send_message(message.chat.id, "❌ Введите число")
 
+@router.route("transfer_money")
 def transfer_money_start(call):
     set_user_state(call.from_user.id, "waiting_transfer_user")
     bot.send_message(call.message.chat.id, "👤 Введите ID пользователя, которому хотите перевести средства:")
 
-def process_transfer_user(message, user_id):
+@fsm.state("waiting_transfer_user")
+def process_transfer_user(message):
+    user_id = message.from_user.id
     try:
         target_user_id = int(message.text.strip())
         
@@ -1642,23 +2503,27 @@ def process_transfer_user(message, user_id):
             bot.send_message(message.chat.id, "❌ Нельзя переводить средства самому себе")
             return
             
-        conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (target_user_id,))
-        target_user = cursor.fetchone()
-        conn.close()
+        with db_read() as cursor:
+            cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (target_user_id,))
+            target_user = cursor.fetchone()
         
         if not target_user:
             bot.send_message(message.chat.id, "❌ Пользователь не найден")
             return
             
-        set_user_state(user_id, "waiting_transfer_amount", str(target_user_id))
+        set_user_state(user_id, "waiting_transfer_amount", target_user_id=target_user_id)
         bot.send_message(message.chat.id, f"👤 Получатель: {target_user_id}\n💰 Введите сумму для перевода:")
         
     except ValueError:
         bot.send_message(message.chat.id, "❌ Введите корректный ID пользователя (число)")
 
-def process_transfer_amount(message, user_id, target_user_id):
+def transfer_funds(cursor, user_id, target_user_id, amount):
+    return ledger.transfer(cursor, user_id, target_user_id, amount, 'transfer',
+                           f'Перевод от пользователя {user_id} пользователю {target_user_id}', check_funds=True)
+
+@fsm.state("waiting_transfer_amount", target_user_id=int)
+def process_transfer_amount(message, target_user_id):
+    user_id = message.from_user.id
     try:
         amount = float(message.text)
         
@@ -1666,38 +2531,23 @@ def process_transfer_amount(message, user_id, target_user_id):
             bot.send_message(message.chat.id, "❌ Сумма должна быть больше 0")
             return
             
-        conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-        cursor = conn.cursor()
-        
         # Проверяем баланс отправителя
-        cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-        sender_balance = cursor.fetchone()[0]
+        with db_read() as cursor:
+            cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
+            sender_balance = cursor.fetchone()[0]
         
         if sender_balance < amount:
             bot.send_message(message.chat.id, f"❌ Недостаточно средств. На вашем балансе: {format_balance(sender_balance)} руб")
-            conn.close()
             return
             
-        # Выполняем перевод
-        cursor.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (amount, user_id))
-        cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, target_user_id))
-        
-        # Записываем транзакции
-        cursor.execute('INSERT INTO transactions (user_id, amount, type, description) VALUES (?, ?, ?, ?)',
-                     (user_id, -amount, 'transfer_out', f'Перевод пользователю {target_user_id}'))
-        cursor.execute('INSERT INTO transactions (user_id, amount, type, description) VALUES (?, ?, ?, ?)',
-                     (target_user_id, amount, 'transfer_in', f'Перевод от пользователя {user_id}'))
-        
-        conn.commit()
-        conn.close()
+        if not db_submit(transfer_funds, user_id, target_user_id, amount).result():
+            bot.send_message(message.chat.id, "❌ Недостаточно средств")
+            return
         
         clear_user_state(user_id)
         
         # Уведомляем получателя
-        try:
-            bot.send_message(target_user_id, f"💰 Вам переведено {format_balance(amount)} руб от пользователя {user_id}")
-        except:
-            pass
+        notify_user(target_user_id, f"💰 Вам переведено {format_balance(amount)} руб от пользователя {user_id}")
             
         bot.send_message(message.chat.id, f"✅ Средства успешно переведены!\n👤 Получатель: {target_user_id}\n💰 Сумма: {format_balance(amount)} руб")
         show_main_menu(message.chat.id, "Главное меню:")
@@ -1705,22 +2555,21 @@ def process_transfer_amount(message, user_id, target_user_id):
     except ValueError:
         bot.send_message(message.chat.id, "❌ Введите корректную сумму")
 
-def process_name_change(message, user_id):
+@fsm.state("waiting_name_change")
+def process_name_change(message):
+    user_id = message.from_user.id
     name = message.text.strip()
     if len(name) < 2:
         bot.send_message(message.chat.id, "❌ Имя слишком короткое")
         return
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET full_name = ? WHERE user_id = ?', (name, user_id))
-    conn.commit()
-    conn.close()
+    db_execute('UPDATE users SET full_name = ? WHERE user_id = ?', (name, user_id)).result()
     
     clear_user_state(user_id)
     bot.send_message(message.chat.id, f"✅ Имя изменено на: {name}")
     show_main_menu(message.chat.id, "Главное меню:")
 
+@router.route("my_reviews")
 def show_my_reviews(call):
     user_id = call.from_user.id
     
@@ -1733,21 +2582,19 @@ def show_my_reviews(call):
     
     bot.send_message(call.message.chat.id, "📊 Мои отзывы\n\nВыберите тип отзывов:", reply_markup=keyboard)
 
+@router.route("contact_", int)
 def show_contact_info(call, slot_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT s.contact_info, s.description, u.username, u.user_id
-        FROM slots s 
-        JOIN users u ON s.seller_id = u.user_id 
-        WHERE s.slot_id = ?
-    ''', (slot_id,))
-    slot = cursor.fetchone()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT s.contact_info, s.description, u.username, u.user_id
+            FROM slots s 
+            JOIN users u ON s.seller_id = u.user_id 
+            WHERE s.slot_id = ?
+        ''', (slot_id,))
+        slot = cursor.fetchone()
     
     if not slot:
-        bot.answer_callback_query(call.id, "❌ Слот не найден")
+        answer_callback(call, "❌ Слот не найден")
         return
     
     contact_info, description, username, seller_id = slot
@@ -1765,17 +2612,26 @@ def show_contact_info(call, slot_id):
     
     bot.send_message(call.message.chat.id, message_text)
 
+@router.route("reviews_", int, str)
 def show_reviews(call, user_id, review_type):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Получаем информацию о пользователе
-    cursor.execute('SELECT username, full_name FROM users WHERE user_id = ?', (user_id,))
-    user_info = cursor.fetchone()
+    with db_read() as cursor:
+        # Получаем информацию о пользователе
+        cursor.execute('SELECT username, full_name FROM users WHERE user_id = ?', (user_id,))
+        user_info = cursor.fetchone()
+        
+        # Получаем отзывы
+        cursor.execute('''
+            SELECT r.rating, r.review_text, u.username, r.created_at, u.user_id
+            FROM reviews r 
+            JOIN users u ON r.reviewer_id = u.user_id 
+            WHERE r.user_id = ? AND r.review_type = ?
+            ORDER BY r.created_at DESC
+        ''', (user_id, review_type))
+        
+        reviews = cursor.fetchall()
     
     if not user_info:
-        bot.answer_callback_query(call.id, "❌ Пользователь не найден")
-        conn.close()
+        answer_callback(call, "❌ Пользователь не найден")
         return
     
     username, full_name = user_info
@@ -1783,18 +2639,6 @@ def show_reviews(call, user_id, review_type):
     # Используем новую функцию для отображения username
     display_username = get_user_display(user_id, username)
     
-    # Получаем отзывы
-    cursor.execute('''
-        SELECT r.rating, r.review_text, u.username, r.created_at, u.user_id
-        FROM reviews r 
-        JOIN users u ON r.reviewer_id = u.user_id 
-        WHERE r.user_id = ? AND r.review_type = ?
-        ORDER BY r.created_at DESC
-    ''', (user_id, review_type))
-    
-    reviews = cursor.fetchall()
-    conn.close()
-    
     review_type_text = "продавца" if review_type == "seller" else "покупателя"
     user_text = f"{full_name or 'Без имени'} (@{display_username})"
     
@@ -1813,10 +2657,7 @@ def show_reviews(call, user_id, review_type):
         display_reviewer_username = get_user_display(reviewer_id, reviewer_username)
         message_text += f"{i}. {stars}\n👤 @{display_reviewer_username or 'аноним'}\n💬 {review_display}\n📅 {created_at[:16]}\n\n"
     
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main"))
-    
-    bot.send_message(call.message.chat.id, message_text, reply_markup=keyboard)
+    bot.send_message(call.message.chat.id, message_text, reply_markup=BACK_TO_MAIN_MARKUP)
 
 def start_rating(call, purchase_id, rate_type):
     keyboard = InlineKeyboardMarkup(row_width=5)
@@ -1831,19 +2672,17 @@ def start_rating(call, purchase_id, rate_type):
     rate_type_text = "продавца" if rate_type == "seller" else "покупателя"
     bot.send_message(call.message.chat.id, f"⭐ Оцените {rate_type_text} от 1 до 5 звезд:", reply_markup=keyboard)
 
+@fsm.state("waiting_rating", purchase_id=int, rate_type=str, rating=int)
 def process_review(message, purchase_id, rate_type, rating):
     review_text = message.text.strip()
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Получаем информацию о покупке
-    cursor.execute('SELECT buyer_id, seller_id FROM purchases WHERE purchase_id = ?', (purchase_id,))
-    purchase = cursor.fetchone()
+    with db_read() as cursor:
+        # Получаем информацию о покупке
+        cursor.execute('SELECT buyer_id, seller_id FROM purchases WHERE purchase_id = ?', (purchase_id,))
+        purchase = cursor.fetchone()
     
     if not purchase:
         bot.send_message(message.chat.id, "❌ Покупка не найдена")
-        conn.close()
         return
     
     buyer_id, seller_id = purchase
@@ -1862,34 +2701,35 @@ def process_review(message, purchase_id, rate_type, rating):
         rating_value_field = "buyer_rating"
         review_field = "buyer_review"
     
-    # Сохраняем оценку в покупке
-    cursor.execute(f'UPDATE purchases SET {rating_field} = TRUE, {rating_value_field} = ?, {review_field} = ? WHERE purchase_id = ?', 
-                  (rating, review_text, purchase_id))
-    
-    # Сохраняем отзыв
-    cursor.execute('''
-        INSERT INTO reviews (user_id, reviewer_id, review_type, rating, review_text, purchase_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, reviewer_id, rate_type, rating, review_text, purchase_id))
-    
-    # Обновляем рейтинг пользователя
-    if rate_type == "seller":
-        cursor.execute('''
-            UPDATE users SET rating_seller = (
-                SELECT AVG(r.rating) FROM reviews r 
-                WHERE r.user_id = ? AND r.review_type = 'seller'
-            ) WHERE user_id = ?
-        ''', (user_id, user_id))
-    else:
+    with db_write() as cursor:
+        # Сохраняем оценку в покупке
+        cursor.execute(f'UPDATE purchases SET {rating_field} = TRUE, {rating_value_field} = ?, {review_field} = ? WHERE purchase_id = ?', 
+                      (rating, review_text, purchase_id))
+        
+        # Сохраняем отзыв
         cursor.execute('''
-            UPDATE users SET rating_buyer = (
-                SELECT AVG(r.rating) FROM reviews r 
-                WHERE r.user_id = ? AND r.review_type = 'buyer'
-            ) WHERE user_id = ?
-        ''', (user_id, user_id))
-    
-    conn.commit()
-    conn.close()
+            INSERT INTO reviews (user_id, reviewer_id, review_type, rating, review_text, purchase_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, reviewer_id, rate_type, rating, review_text, purchase_id))
+        
+        # Обновляем рейтинг пользователя
+        if rate_type == "seller":
+            cursor.execute('''
+                UPDATE users SET rating_seller = (
+                    SELECT AVG(r.rating) FROM reviews r 
+                    WHERE r.user_id = ? AND r.review_type = 'seller'
+                ) WHERE user_id = ?
+            ''', (user_id, user_id))
+        else:
+            cursor.execute('''
+                UPDATE users SET rating_buyer = (
+                    SELECT AVG(r.rating) FROM reviews r 
+                    WHERE r.user_id = ? AND r.review_type = 'buyer'
+                ) WHERE user_id = ?
+            ''', (user_id, user_id))
+    if rate_type == "seller":
+        # Рейтинг продавца скопирован в его слоты (триггер) и в индекс слотов
+        listing_index.refresh_seller(user_id)
     
     clear_user_state(message.from_user.id)
     
@@ -1897,35 +2737,44 @@ def process_review(message, purchase_id, rate_type, rating):
     bot.send_message(message.chat.id, f"✅ Вы оценили {rate_type_text}!")
     show_main_menu(message.chat.id, "Главное меню:")
 
-def approve_withdraw(call, withdraw_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
+def close_withdraw_request(cursor, withdraw_id, status, comment):
+    """Одобряет (сумма уходит в выплаты) или отклоняет (сумма возвращается) заявку на вывод.
+
+    Заявка закрывается, только если она еще ожидает решения; иначе возвращает False.
+    """
+    cursor.execute('UPDATE withdraw_requests SET status = ?, admin_comment = ? WHERE withdraw_id = ? AND status = "pending"',
+                   (status, comment, withdraw_id))
+    if cursor.rowcount != 1:
+        return False
     cursor.execute('SELECT user_id, amount FROM withdraw_requests WHERE withdraw_id = ?', (withdraw_id,))
-    withdraw = cursor.fetchone()
+    user_id, amount = cursor.fetchone()
+    if status == 'approved':
+        ledger.transfer(cursor, WITHDRAWALS, PAYOUTS, amount, 'withdraw', f'Вывод средств (заявка #{withdraw_id})')
+    else:
+        ledger.transfer(cursor, WITHDRAWALS, user_id, amount, 'withdraw_reject', f'Отказ в выводе (заявка #{withdraw_id})')
+    return True
+
+@router.route("approve_withdraw_", int, admin_only=True, ack="⏳ Одобряем заявку...")
+def approve_withdraw(call, withdraw_id):
+    with db_read() as cursor:
+        cursor.execute('SELECT user_id, amount FROM withdraw_requests WHERE withdraw_id = ?', (withdraw_id,))
+        withdraw = cursor.fetchone()
     
     if not withdraw:
-        bot.answer_callback_query(call.id, "❌ Заявка не найдена")
-        conn.close()
+        answer_callback(call, "❌ Заявка не найдена")
         return
     
     user_id, amount = withdraw
     
-    cursor.execute('UPDATE withdraw_requests SET status = "approved" WHERE withdraw_id = ?', (withdraw_id,))
-    cursor.execute('INSERT INTO transactions (user_id, amount, type, description) VALUES (?, ?, ?, ?)',
-                 (user_id, -amount, 'withdraw', f'Вывод средств (заявка #{withdraw_id})'))
-    
-    conn.commit()
-    conn.close()
+    if not db_submit(close_withdraw_request, withdraw_id, 'approved', None).result():
+        answer_callback(call, "❌ Заявка уже обработана")
+        return
     
-    try:
-        bot.send_message(user_id, f"✅ Ваша заявка на вывод {format_balance(amount)} руб одобрена!")
-    except:
-        pass
+    notify_user(user_id, f"✅ Ваша заявка на вывод {format_balance(amount)} руб одобрена!")
     
-    bot.answer_callback_query(call.id, "✅ Заявка одобрена")
     bot.send_message(call.message.chat.id, f"✅ Заявка #{withdraw_id} одобрена")
 
+@router.route("select_user_", int, str, admin_only=True)
 def handle_selected_user_action(call, user_id_selected, action_type):
     """Обрабатывает выбранного пользователя"""
     try:
@@ -1934,201 +2783,179 @@ def handle_selected_user_action(call, user_id_selected, action_type):
         elif action_type == "unban":
             unban_user(call, user_id_selected)
         elif action_type == "balance":
-            set_user_state(call.from_user.id, "waiting_admin_balance", str(user_id_selected))
+            set_user_state(call.from_user.id, "waiting_admin_balance", target_user_id=user_id_selected)
             bot.send_message(call.message.chat.id, f"💸 Введите сумму для пополнения баланса пользователя {user_id_selected}:")
         elif action_type == "add_admin":
             add_admin(call, user_id_selected)
         elif action_type == "remove_admin":
             remove_admin(call, user_id_selected)
         else:
-            bot.answer_callback_query(call.id, "❌ Неизвестное действие")
+            answer_callback(call, "❌ Неизвестное действие")
     except Exception as e:
         logger.error(f"Error in handle_selected_user_action: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка обработки")
+        answer_callback(call, "❌ Ошибка обработки")
 
 def ban_user(call, user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
+    with db_write() as cursor:
+        cursor.execute('UPDATE users SET is_banned = TRUE WHERE user_id = ?', (user_id,))
     
-    cursor.execute('UPDATE users SET is_banned = TRUE WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    notify_user(user_id, "❌ Вы были забанены администратором.")
     
-    try:
-        bot.send_message(user_id, "❌ Вы были забанены администратором.")
-    except:
-        pass
-    
-    bot.answer_callback_query(call.id, "✅ Пользователь забанен")
     bot.send_message(call.message.chat.id, f"✅ Пользователь {user_id} забанен")
 
 def unban_user(call, user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
+    with db_write() as cursor:
+        cursor.execute('UPDATE users SET is_banned = FALSE WHERE user_id = ?', (user_id,))
     
-    cursor.execute('UPDATE users SET is_banned = FALSE WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    notify_user(user_id, "✅ Вы были разбанены администратором.")
     
-    try:
-        bot.send_message(user_id, "✅ Вы были разбанены администратором.")
-    except:
-        pass
-    
-    bot.answer_callback_query(call.id, "✅ Пользователь разбанен")
     bot.send_message(call.message.chat.id, f"✅ Пользователь {user_id} разбанен")
 
 def add_admin(call, user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('UPDATE users SET is_admin = TRUE WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db_write() as cursor:
+        cursor.execute('UPDATE users SET is_admin = TRUE WHERE user_id = ?', (user_id,))
     
     update_global_admins()
     
-    try:
-        bot.send_message(user_id, "👑 Вы были назначены администратором!")
-    except:
-        pass
+    notify_user(user_id, "👑 Вы были назначены администратором!")
     
-    bot.answer_callback_query(call.id, "✅ Пользователь добавлен в админы")
     bot.send_message(call.message.chat.id, f"✅ Пользователь {user_id} добавлен в админы")
 
 def remove_admin(call, user_id):
     if user_id == ADMIN_ID:
-        bot.answer_callback_query(call.id, "❌ Нельзя удалить главного администратора")
+        answer_callback(call, "❌ Нельзя удалить главного администратора")
         return
         
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('UPDATE users SET is_admin = FALSE WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db_write() as cursor:
+        cursor.execute('UPDATE users SET is_admin = FALSE WHERE user_id = ?', (user_id,))
     
     update_global_admins()
     
-    try:
-        bot.send_message(user_id, "👑 Вы были удалены из администраторов.")
-    except:
-        pass
+    notify_user(user_id, "👑 Вы были удалены из администраторов.")
     
-    bot.answer_callback_query(call.id, "✅ Пользователь удален из админов")
     bot.send_message(call.message.chat.id, f"✅ Пользователь {user_id} удален из админов")
 
+@router.route("confirm_send_", int, ack="⏳ Подтверждаем отправку...")
 def confirm_send_nft(call, slot_id):
     user_id = call.from_user.id
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Получаем информацию о покупке
-    cursor.execute('''
-        SELECT p.purchase_id, p.buyer_id, p.amount, s.description 
-        FROM purchases p 
-        JOIN slots s ON p.slot_id = s.slot_id 
-        WHERE p.slot_id = ? AND p.status = 'pending'
-    ''', (slot_id,))
-    purchase = cursor.fetchone()
+    with db_read() as cursor:
+        # Получаем информацию о покупке
+        cursor.execute('''
+            SELECT p.purchase_id, p.buyer_id, p.amount, COALESCE(s.description, '')
+            FROM purchases p 
+            LEFT JOIN slots s ON p.slot_id = s.slot_id 
+            WHERE p.slot_id = ? AND p.status = 'pending'
+        ''', (slot_id,))
+        purchase = cursor.fetchone()
     
     if not purchase:
-        bot.answer_callback_query(call.id, "❌ Покупка не найдена")
-        conn.close()
+        answer_callback(call, "❌ Покупка не найдена")
         return
     
     purchase_id, buyer_id, amount, description = purchase
     
-    # Обновляем статус покупки - NFT отправлен
-    cursor.execute('UPDATE purchases SET nft_sent = TRUE WHERE purchase_id = ?', (purchase_id,))
-    
-    conn.commit()
-    conn.close()
-    
-    # Уведомляем покупателя
-    try:
-        bot.send_message(
-            buyer_id,
-            f"📦 Продавец подтвердил отправку NFT!\n\n"
-            f"🎁 {description}\n\n"
-            f"✅ Пожалуйста, проверьте получение NFT и подтвердите его получение."
-        )
-    except:
-        pass
+    with db_write() as cursor:
+        # Обновляем статус покупки - NFT отправлен (если сделку еще не закрыли)
+        cursor.execute('UPDATE purchases SET nft_sent = TRUE, sent_at = CURRENT_TIMESTAMP WHERE purchase_id = ? AND status = "pending" AND nft_sent = FALSE', (purchase_id,))
+        sent = cursor.rowcount == 1
+        
+        # Уведомляем покупателя
+        if sent:
+            queue_notification(
+                cursor,
+                buyer_id,
+                f"📦 Продавец подтвердил отправку NFT!\n\n"
+                f"🎁 {description}\n\n"
+                f"✅ Пожалуйста, проверьте получение NFT и подтвердите его получение."
+            )
+    if not sent:
+        answer_callback(call, "❌ Сделка уже закрыта или отправка уже подтверждена")
+        return
+    outbox_wakeup.set()
     
-    bot.answer_callback_query(call.id, "✅ Отправка NFT подтверждена!")
     bot.send_message(
         call.message.chat.id,
         "✅ Вы подтвердили отправку NFT. Ожидайте подтверждения получения от покупателя."
     )
 
-def confirm_receive_nft(call, slot_id):
-    user_id = call.from_user.id
-    
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Получаем информацию о покупке
-    cursor.execute('''
-        SELECT p.purchase_id, p.seller_id, p.amount, s.description, p.nft_sent
-        FROM purchases p 
-        JOIN slots s ON p.slot_id = s.slot_id 
-        WHERE p.slot_id = ? AND p.buyer_id = ? AND p.status = 'pending'
-    ''', (slot_id, user_id))
-    purchase = cursor.fetchone()
-    
-    if not purchase:
-        bot.answer_callback_query(call.id, "❌ Покупка не найдена")
-        conn.close()
-        return
-    
-    purchase_id, seller_id, amount, description, nft_sent = purchase
-    
-    if not nft_sent:
-        bot.answer_callback_query(call.id, "❌ Продавец еще не подтвердил отправку NFT")
-        conn.close()
-        return
-    
-    # Обновляем статус покупки - завершена
-    cursor.execute('UPDATE purchases SET status = "completed", nft_received = TRUE WHERE purchase_id = ?', (purchase_id,))
+def complete_purchase(cursor, purchase_id, user_id, seller_id, amount, description, expired=False):
+    """Завершает сделку: деньги из эскроу переходят продавцу. False - сделка уже закрыта.
+
+    expired - покупатель не подтвердил получение вовремя: уведомление получают оба.
+    """
+    cursor.execute('UPDATE purchases SET status = "completed", nft_received = TRUE WHERE purchase_id = ? AND status = "pending"', (purchase_id,))
+    if cursor.rowcount != 1:
+        return False
     
     # Переводим средства продавцу
-    cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, seller_id))
+    ledger.transfer(cursor, ESCROW, seller_id, amount, 'sale', f'Продажа NFT: {description}')
     
     # Обновляем статистику
     cursor.execute('UPDATE users SET total_sales = total_sales + 1, successful_sales = successful_sales + 1 WHERE user_id = ?', (seller_id,))
     cursor.execute('UPDATE users SET total_purchases = total_purchases + 1, successful_purchases = successful_purchases + 1 WHERE user_id = ?', (user_id,))
     
-    # Добавляем транзакцию
-    cursor.execute('INSERT INTO transactions (user_id, amount, type, description) VALUES (?, ?, ?, ?)',
-                 (seller_id, amount, 'sale', f'Продажа NFT: {description}'))
+    # Уведомляем продавца
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("⭐ Оценить покупателя", callback_data=f"rate_buyer_{purchase_id}"))
     
-    conn.commit()
-    conn.close()
+    seller_message = (
+        f"{'⏰ Покупатель не подтвердил получение NFT вовремя.' if expired else '💰 Покупатель подтвердил получение NFT!'}\n\n"
+        f"🎁 {description}\n"
+        f"💸 Сумма: {format_balance(amount)} руб переведена на ваш баланс\n\n"
+        f"✅ Сделка {'завершена автоматически' if expired else 'успешно завершена'}!\n"
+        f"Оцените покупателя:"
+    )
+    queue_notification(cursor, seller_id, seller_message, keyboard)
     
-    # Уведомляем продавца
-    try:
+    if expired:
         keyboard = InlineKeyboardMarkup()
-        keyboard.add(InlineKeyboardButton("⭐ Оценить покупателя", callback_data=f"rate_buyer_{purchase_id}"))
-        
-        seller_message = (
-            f"💰 Покупатель подтвердил получение NFT!\n\n"
+        keyboard.add(InlineKeyboardButton("⭐ Оценить продавца", callback_data=f"rate_seller_{purchase_id}"))
+        queue_notification(
+            cursor,
+            user_id,
+            f"⏰ Сделка завершена автоматически: получение NFT не подтверждено "
+            f"за {ESCROW_CONFIRM_TIMEOUT_HOURS} ч.\n\n"
             f"🎁 {description}\n"
-            f"💸 Сумма: {format_balance(amount)} руб переведена на ваш баланс\n\n"
-            f"✅ Сделка успешно завершена!\n"
-            f"Оцените покупателя:"
+            f"💰 Сумма: {format_balance(amount)} руб переведена продавцу\n\n"
+            f"Оцените продавца:",
+            keyboard
         )
-        
-        bot.send_message(seller_id, seller_message, reply_markup=keyboard)
-    except:
-        pass
+    return True
+
+@router.route("confirm_receive_", int, ack="⏳ Завершаем сделку...")
+def confirm_receive_nft(call, slot_id):
+    user_id = call.from_user.id
+    
+    with db_read() as cursor:
+        # Получаем информацию о покупке
+        cursor.execute('''
+            SELECT p.purchase_id, p.seller_id, p.amount, COALESCE(s.description, ''), p.nft_sent
+            FROM purchases p 
+            LEFT JOIN slots s ON p.slot_id = s.slot_id 
+            WHERE p.slot_id = ? AND p.buyer_id = ? AND p.status = 'pending'
+        ''', (slot_id, user_id))
+        purchase = cursor.fetchone()
+    
+    if not purchase:
+        answer_callback(call, "❌ Покупка не найдена")
+        return
+    
+    purchase_id, seller_id, amount, description, nft_sent = purchase
+    
+    if not nft_sent:
+        answer_callback(call, "❌ Продавец еще не подтвердил отправку NFT")
+        return
+    
+    if not db_submit(complete_purchase, purchase_id, user_id, seller_id, amount, description).result():
+        answer_callback(call, "❌ Покупка не найдена")
+        return
+    outbox_wakeup.set()
     
     # Уведомляем покупателя
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("⭐ Оценить продавца", callback_data=f"rate_seller_{purchase_id}"))
     
-    bot.answer_callback_query(call.id, "✅ Получение NFT подтверждено!")
     bot.send_message(
         call.message.chat.id,
         f"✅ Вы подтвердили получение NFT. Сделка завершена!\n\n"
@@ -2138,57 +2965,150 @@ def confirm_receive_nft(call, slot_id):
         reply_markup=keyboard
     )
 
-def cancel_deal(call, slot_id):
-    user_id = call.from_user.id
-    
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Получаем информацию о покупке
-    cursor.execute('''
-        SELECT p.purchase_id, p.seller_id, p.amount, s.description
-        FROM purchases p 
-        JOIN slots s ON p.slot_id = s.slot_id 
-        WHERE p.slot_id = ? AND p.buyer_id = ? AND p.status = 'pending'
-    ''', (slot_id, user_id))
-    purchase = cursor.fetchone()
-    
-    if not purchase:
-        bot.answer_callback_query(call.id, "❌ Покупка не найдена")
-        conn.close()
-        return
-    
-    purchase_id, seller_id, amount, description = purchase
+def cancel_purchase(cursor, purchase_id, slot_id, user_id, seller_id, amount, description, expired=False):
+    """Отменяет сделку: деньги из эскроу возвращаются покупателю, слот снова активен.
+
+    Возвращает False, если сделка уже закрыта. expired - продавец не отправил NFT
+    вовремя: сделка отменяется, только если отправка так и не подтверждена,
+    неудачной она считается только у продавца, уведомление получают оба.
+    """
+    # Удаляем покупку
+    if expired:
+        cursor.execute('DELETE FROM purchases WHERE purchase_id = ? AND status = "pending" AND nft_sent = FALSE', (purchase_id,))
+    else:
+        cursor.execute('DELETE FROM purchases WHERE purchase_id = ? AND status = "pending"', (purchase_id,))
+    if cursor.rowcount != 1:
+        return False
     
     # Возвращаем средства покупателю
-    cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
+    ledger.transfer(cursor, ESCROW, user_id, amount, 'refund', f'Отмена покупки NFT: {description}')
     
     # Обновляем статистику неудачных сделок
     cursor.execute('UPDATE users SET failed_sales = failed_sales + 1 WHERE user_id = ?', (seller_id,))
-    cursor.execute('UPDATE users SET failed_purchases = failed_purchases + 1 WHERE user_id = ?', (user_id,))
+    if not expired:
+        cursor.execute('UPDATE users SET failed_purchases = failed_purchases + 1 WHERE user_id = ?', (user_id,))
     
     # Делаем слот активным снова
     cursor.execute('UPDATE slots SET is_active = TRUE WHERE slot_id = ?', (slot_id,))
     
-    # Удаляем покупку
-    cursor.execute('DELETE FROM purchases WHERE purchase_id = ?', (purchase_id,))
-    
-    conn.commit()
-    conn.close()
-    
-    # Уведомляем продавца
-    try:
-        bot.send_message(
+    # Уведомляем продавца (и покупателя, если сделку отменили по сроку)
+    if expired:
+        queue_notification(
+            cursor,
+            seller_id,
+            f"⏰ Сделка отменена: отправка NFT не подтверждена за {ESCROW_SEND_TIMEOUT_HOURS} ч.\n\n"
+            f"🎁 {description}\n"
+            f"💰 Сумма: {format_balance(amount)} руб возвращена покупателю\n"
+            f"📈 Ваш слот снова активен для продажи"
+        )
+        queue_notification(
+            cursor,
+            user_id,
+            f"⏰ Сделка отменена: продавец не подтвердил отправку NFT за {ESCROW_SEND_TIMEOUT_HOURS} ч.\n\n"
+            f"🎁 {description}\n"
+            f"💰 Сумма: {format_balance(amount)} руб возвращена на ваш баланс"
+        )
+    else:
+        queue_notification(
+            cursor,
             seller_id,
             f"❌ Покупатель отменил сделку!\n\n"
             f"🎁 {description}\n"
             f"💰 Сумма: {format_balance(amount)} руб возвращена покупателю\n"
             f"📈 Ваш слот снова активен для продажи"
         )
-    except:
-        pass
+    return True
+
+def find_unsent_purchases(cursor):
+    """Сделки, где NFT не отправлен за ESCROW_SEND_TIMEOUT_HOURS от покупки (самые старые, не больше ESCROW_SWEEP_BATCH)"""
+    cursor.execute('''
+        SELECT p.purchase_id, p.slot_id, p.buyer_id, p.seller_id, p.amount, COALESCE(s.description, '')
+        FROM purchases p
+        LEFT JOIN slots s ON p.slot_id = s.slot_id
+        WHERE p.status = 'pending' AND p.created_at <= datetime('now', ?) AND p.nft_sent = FALSE
+        ORDER BY p.created_at
+        LIMIT ?
+    ''', (f'-{ESCROW_SEND_TIMEOUT_HOURS} hours', ESCROW_SWEEP_BATCH))
+    return cursor.fetchall()
+
+def find_unconfirmed_purchases(cursor):
+    """Сделки, где получение не подтверждено за ESCROW_CONFIRM_TIMEOUT_HOURS от отправки (не больше ESCROW_SWEEP_BATCH)"""
+    cursor.execute('''
+        SELECT p.purchase_id, p.slot_id, p.buyer_id, p.seller_id, p.amount, COALESCE(s.description, '')
+        FROM purchases p
+        LEFT JOIN slots s ON p.slot_id = s.slot_id
+        WHERE p.status = 'pending' AND p.nft_sent = TRUE AND p.sent_at <= datetime('now', ?)
+        ORDER BY p.sent_at
+        LIMIT ?
+    ''', (f'-{ESCROW_CONFIRM_TIMEOUT_HOURS} hours', ESCROW_SWEEP_BATCH))
+    return cursor.fetchall()
+
+escrow_sweep_stats = {'cancelled': 0, 'completed': 0}
+
+def sweep_expired_purchases():
+    """Отменяет сделки с неотправленным NFT и завершает неподтвержденные после сроков.
+
+    Задания отправляются писателю разом и попадают в одну групповую транзакцию.
+    Возвращает (отменено, завершено).
+    """
+    with db_read() as cursor:
+        unsent = find_unsent_purchases(cursor)
+        unconfirmed = find_unconfirmed_purchases(cursor)
+    if not unsent and not unconfirmed:
+        return 0, 0
+    
+    cancels = [(slot_id, db_submit(cancel_purchase, purchase_id, slot_id, buyer_id, seller_id, amount, description, True))
+               for purchase_id, slot_id, buyer_id, seller_id, amount, description in unsent]
+    completions = [db_submit(complete_purchase, purchase_id, buyer_id, seller_id, amount, description, True)
+                   for purchase_id, slot_id, buyer_id, seller_id, amount, description in unconfirmed]
+    
+    cancelled = 0
+    for slot_id, future in cancels:
+        if future.result():
+            cancelled += 1
+            listing_index.refresh(slot_id)
+    completed = sum(1 for future in completions if future.result())
+    outbox_wakeup.set()
+    
+    escrow_sweep_stats['cancelled'] += cancelled
+    escrow_sweep_stats['completed'] += completed
+    logger.info(f"Expired deals: {cancelled} cancelled, {completed} completed")
+    return cancelled, completed
+
+def escrow_sweeper():
+    while True:
+        time.sleep(ESCROW_SWEEP_INTERVAL)
+        try:
+            sweep_expired_purchases()
+        except Exception as e:
+            logger.error(f"Error sweeping expired deals: {e}")
+
+@router.route("cancel_deal_", int, ack="⏳ Отменяем сделку...")
+def cancel_deal(call, slot_id):
+    user_id = call.from_user.id
+    
+    with db_read() as cursor:
+        # Получаем информацию о покупке
+        cursor.execute('''
+            SELECT p.purchase_id, p.seller_id, p.amount, COALESCE(s.description, '')
+            FROM purchases p 
+            LEFT JOIN slots s ON p.slot_id = s.slot_id 
+            WHERE p.slot_id = ? AND p.buyer_id = ? AND p.status = 'pending'
+        ''', (slot_id, user_id))
+        purchase = cursor.fetchone()
+    
+    if not purchase:
+        answer_callback(call, "❌ Покупка не найдена")
+        return
+    
+    purchase_id, seller_id, amount, description = purchase
+    
+    if not db_submit(cancel_purchase, purchase_id, slot_id, user_id, seller_id, amount, description).result():
+        answer_callback(call, "❌ Покупка не найдена")
+        return
+    outbox_wakeup.set()
+    listing_index.refresh(slot_id)
     
-    bot.answer_callback_query(call.id, "✅ Сделка отменена!")
     bot.send_message(
         call.message.chat.id,
         f"✅ Вы отменили сделку.\n\n"
@@ -2200,12 +3120,9 @@ def cancel_deal(call, slot_id):
 # ФУНКЦИЯ ДЛЯ ВЫБОРА ПОЛЬЗОВАТЕЛЯ
 def show_user_selection(message, action_type):
     """Показывает список пользователей для выбора"""
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT user_id, username, full_name FROM users ORDER BY user_id')
-    users = cursor.fetchall()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('SELECT user_id, username, full_name FROM users ORDER BY user_id')
+        users = cursor.fetchall()
     
     if not users:
         bot.send_message(message.chat.id, "👥 Нет пользователей")
@@ -2235,13 +3152,11 @@ def show_user_selection(message, action_type):
         reply_markup=keyboard
     )
 
+@router.route("admin_list_users", admin_only=True)
 def show_all_users(call):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT user_id, username, full_name, is_banned FROM users ORDER BY user_id')
-    users = cursor.fetchall()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('SELECT user_id, username, full_name, is_banned FROM users ORDER BY user_id')
+        users = cursor.fetchall()
     
     if not users:
         bot.send_message(call.message.chat.id, "👥 Нет пользователей")
@@ -2255,18 +3170,13 @@ def show_all_users(call):
         display_username = get_user_display(user_id, username)
         users_text += f"🆔 {user_id} | @{display_username} | {full_name or 'нет'} | {status}\n"
     
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
-    
-    bot.send_message(call.message.chat.id, users_text, reply_markup=keyboard)
+    bot.send_message(call.message.chat.id, users_text, reply_markup=BACK_TO_ADMIN_MARKUP)
 
+@router.route("admin_list_balances", admin_only=True)
 def show_all_balances(call):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT user_id, username, balance FROM users WHERE balance > 0 ORDER BY balance DESC')
-    users = cursor.fetchall()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('SELECT user_id, username, balance FROM users WHERE balance > 0 ORDER BY balance DESC')
+        users = cursor.fetchall()
     
     if not users:
         bot.send_message(call.message.chat.id, "💰 Нет пользователей с балансом")
@@ -2279,18 +3189,13 @@ def show_all_balances(call):
         display_username = get_user_display(user_id, username)
         balances_text += f"🆔 {user_id} | @{display_username} | {format_balance(balance)} руб\n"
     
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
-    
-    bot.send_message(call.message.chat.id, balances_text, reply_markup=keyboard)
+    bot.send_message(call.message.chat.id, balances_text, reply_markup=BACK_TO_ADMIN_MARKUP)
 
+@router.route("admin_list_admins", admin_only=True)
 def show_all_admins(call):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT user_id, username, full_name FROM users WHERE is_admin = TRUE ORDER BY user_id')
-    admins = cursor.fetchall()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('SELECT user_id, username, full_name FROM users WHERE is_admin = TRUE ORDER BY user_id')
+        admins = cursor.fetchall()
     
     if not admins:
         bot.send_message(call.message.chat.id, "👑 Нет администраторов")
@@ -2303,23 +3208,18 @@ def show_all_admins(call):
         display_username = get_user_display(user_id, username)
         admins_text += f"🆔 {user_id} | @{display_username} | {full_name or 'нет имени'}\n"
     
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
-    
-    bot.send_message(call.message.chat.id, admins_text, reply_markup=keyboard)
+    bot.send_message(call.message.chat.id, admins_text, reply_markup=BACK_TO_ADMIN_MARKUP)
 
+@router.route("admin_list_promocodes", admin_only=True)
 def show_all_promocodes(call):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT p.code, p.amount, p.max_activations, p.current_activations, p.created_at, u.username 
-        FROM promocodes p 
-        LEFT JOIN users u ON p.created_by = u.user_id 
-        ORDER BY p.created_at DESC
-    ''')
-    promocodes = cursor.fetchall()
-    conn.close()
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT p.code, p.amount, p.max_activations, p.current_activations, p.created_at, u.username 
+            FROM promocodes p 
+            LEFT JOIN users u ON p.created_by = u.user_id 
+            ORDER BY p.created_at DESC
+        ''')
+        promocodes = cursor.fetchall()
     
     if not promocodes:
         bot.send_message(call.message.chat.id, "🎁 Нет созданных промокодов")
@@ -2331,12 +3231,13 @@ def show_all_promocodes(call):
         status = "🟢 Активен" if current_activations < max_activations else "🔴 Завершен"
         promocodes_text += f"🎁 {code}\n💰 {format_balance(amount)} руб\n🔄 {current_activations}/{max_activations}\n📅 {created_at[:16]}\n👤 Создал: @{get_user_display(0, creator_username)}\n{status}\n\n"
     
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin"))
-    
-    bot.send_message(call.message.chat.id, promocodes_text, reply_markup=keyboard)
+    bot.send_message(call.message.chat.id, promocodes_text, reply_markup=BACK_TO_ADMIN_MARKUP)
+
+def admin_add_balance(cursor, user_id, amount):
+    ledger.transfer(cursor, DEPOSITS, user_id, amount, 'admin_add', 'Пополнение администратором')
 
-def process_admin_balance(message):
+@fsm.state("waiting_admin_balance", admin_only=True, target_user_id=int)
+def process_admin_balance(message, target_user_id):
     try:
         amount = float(message.text)
         
@@ -2344,110 +3245,79 @@ def process_admin_balance(message):
             bot.send_message(message.chat.id, "❌ Сумма должна быть больше 0")
             return
         
-        state, state_data = get_user_state(message.from_user.id)
-        user_id = int(state_data) if state_data else None
-        
-        if not user_id:
-            bot.send_message(message.chat.id, "❌ Ошибка: пользователь не выбран")
-            return
-        
-        conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
-        cursor.execute('INSERT INTO transactions (user_id, amount, type, description) VALUES (?, ?, ?, ?)',
-                     (user_id, amount, 'admin_add', f'Пополнение администратором'))
-        
-        conn.commit()
-        conn.close()
+        db_submit(admin_add_balance, target_user_id, amount).result()
         
-        try:
-            bot.send_message(user_id, f"💰 Ваш баланс пополнен на {format_balance(amount)} руб администратором!")
-        except:
-            pass
+        notify_user(target_user_id, f"💰 Ваш баланс пополнен на {format_balance(amount)} руб администратором!")
         
-        bot.send_message(message.chat.id, f"✅ Баланс пользователя {user_id} пополнен на {format_balance(amount)} руб")
+        bot.send_message(message.chat.id, f"✅ Баланс пользователя {target_user_id} пополнен на {format_balance(amount)} руб")
         clear_user_state(message.from_user.id)
         
     except ValueError:
         bot.send_message(message.chat.id, "❌ Введите корректную сумму")
 
+@fsm.state("waiting_admin_ban", admin_only=True)
 def process_admin_ban(message):
     show_user_selection(message, "ban")
 
+@fsm.state("waiting_admin_unban", admin_only=True)
 def process_admin_unban(message):
     show_user_selection(message, "unban")
 
+@fsm.state("waiting_reject_reason", admin_only=True, withdraw_id=int)
 def process_reject_reason(message, withdraw_id):
     reason = message.text
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT user_id, amount FROM withdraw_requests WHERE withdraw_id = ?', (withdraw_id,))
-    withdraw = cursor.fetchone()
+    with db_read() as cursor:
+        cursor.execute('SELECT user_id, amount FROM withdraw_requests WHERE withdraw_id = ?', (withdraw_id,))
+        withdraw = cursor.fetchone()
     
     if not withdraw:
         bot.send_message(message.chat.id, "❌ Заявка не найдена")
-        conn.close()
         return
     
     user_id, amount = withdraw
     
-    cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
-    cursor.execute('UPDATE withdraw_requests SET status = "rejected", admin_comment = ? WHERE withdraw_id = ?', 
-                  (reason, withdraw_id))
+    if not db_submit(close_withdraw_request, withdraw_id, 'rejected', reason).result():
+        bot.send_message(message.chat.id, "❌ Заявка уже обработана")
+        clear_user_state(message.from_user.id)
+        return
     
-    conn.commit()
-    conn.close()
-    
-    try:
-        bot.send_message(user_id, f"❌ Ваша заявка на вывод {format_balance(amount)} руб отклонена.\n\nПричина: {reason}")
-    except:
-        pass
+    notify_user(user_id, f"❌ Ваша заявка на вывод {format_balance(amount)} руб отклонена.\n\nПричина: {reason}")
     
     bot.send_message(message.chat.id, f"✅ Заявка #{withdraw_id} отклонена")
     clear_user_state(message.from_user.id)
 
+@fsm.state("waiting_ticket_reply", admin_only=True, ticket_id=int)
 def process_ticket_reply(message, ticket_id):
     reply_text = message.text
     
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT user_id FROM support_tickets WHERE ticket_id = ?', (ticket_id,))
-    ticket = cursor.fetchone()
+    with db_read() as cursor:
+        cursor.execute('SELECT user_id FROM support_tickets WHERE ticket_id = ?', (ticket_id,))
+        ticket = cursor.fetchone()
     
     if not ticket:
         bot.send_message(message.chat.id, "❌ Тикет не найден")
-        conn.close()
         return
     
     user_id = ticket[0]
     
-    cursor.execute('UPDATE support_tickets SET status = "closed", admin_response = ? WHERE ticket_id = ?', 
-                  (reply_text, ticket_id))
+    with db_write() as cursor:
+        cursor.execute('UPDATE support_tickets SET status = "closed", admin_response = ? WHERE ticket_id = ?', 
+                      (reply_text, ticket_id))
     
-    conn.commit()
-    conn.close()
-    
-    try:
-        bot.send_message(user_id, f"📞 Ответ от поддержки:\n\n{reply_text}")
-    except:
-        pass
+    notify_user(user_id, f"📞 Ответ от поддержки:\n\n{reply_text}")
     
     bot.send_message(message.chat.id, f"✅ Ответ на тикет #{ticket_id} отправлен")
     clear_user_state(message.from_user.id)
 
+@fsm.state("waiting_add_admin", admin_only=True)
 def process_add_admin(message):
     try:
         user_id = int(message.text.strip())
         
-        conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        target_user = cursor.fetchone()
-        conn.close()
+        with db_read() as cursor:
+            cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
+            target_user = cursor.fetchone()
         
         if not target_user:
             bot.send_message(message.chat.id, "❌ Пользователь не найден")
@@ -2459,23 +3329,17 @@ def process_add_admin(message):
         bot.send_message(message.chat.id, "❌ Введите корректный ID пользователя (число)")
 
 def add_admin_by_id(message, user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('UPDATE users SET is_admin = TRUE WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db_write() as cursor:
+        cursor.execute('UPDATE users SET is_admin = TRUE WHERE user_id = ?', (user_id,))
     
     update_global_admins()
     
-    try:
-        bot.send_message(user_id, "👑 Вы были назначены администратором!")
-    except:
-        pass
+    notify_user(user_id, "👑 Вы были назначены администратором!")
     
     bot.send_message(message.chat.id, f"✅ Пользователь {user_id} добавлен в админы")
     clear_user_state(message.from_user.id)
 
+@fsm.state("waiting_remove_admin", admin_only=True)
 def process_remove_admin(message):
     try:
         user_id = int(message.text.strip())
@@ -2484,11 +3348,9 @@ def process_remove_admin(message):
             bot.send_message(message.chat.id, "❌ Нельзя удалить главного администратора")
             return
             
-        conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        target_user = cursor.fetchone()
-        conn.close()
+        with db_read() as cursor:
+            cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
+            target_user = cursor.fetchone()
         
         if not target_user:
             bot.send_message(message.chat.id, "❌ Пользователь не найден")
@@ -2500,26 +3362,127 @@ def process_remove_admin(message):
         bot.send_message(message.chat.id, "❌ Введите корректный ID пользователя (число)")
 
 def remove_admin_by_id(message, user_id):
-    conn = sqlite3.connect('nft_market.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('UPDATE users SET is_admin = FALSE WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db_write() as cursor:
+        cursor.execute('UPDATE users SET is_admin = FALSE WHERE user_id = ?', (user_id,))
     
     update_global_admins()
     
-    try:
-        bot.send_message(user_id, "👑 Вы были удалены из администраторов.")
-    except:
-        pass
+    notify_user(user_id, "👑 Вы были удалены из администраторов.")
     
     bot.send_message(message.chat.id, f"✅ Пользователь {user_id} удален из админов")
     clear_user_state(message.from_user.id)
 
 # Запуск бота
+# ПРИЕМ АПДЕЙТОВ
+def update_user_id(update):
+    """Id пользователя, от которого пришел апдейт; по нему выбирается полоса"""
+    for event in (update.message, update.callback_query, update.chat_member, update.my_chat_member):
+        if event is not None and event.from_user is not None:
+            return event.from_user.id
+    return update.update_id
+
+def process_update(update):
+    bot.process_new_updates([update])
+
+if BOT_RUNTIME == 'asyncio':
+    update_lanes = AsyncLaneDispatcher(process_update, update_user_id, UPDATE_LANES, UPDATE_LANE_SIZE, UPDATE_LANES)
+else:
+    update_lanes = LaneDispatcher(process_update, update_user_id, UPDATE_LANES, UPDATE_LANE_SIZE)
+
+def poll_updates():
+    """Long polling: апдейты раскладываются по полосам update_lanes.
+    
+    Если очередь полосы заполнена, следующий запрос к Telegram ждет, пока она освободится.
+    """
+    offset = None
+    error_delay = 1
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=ALLOWED_UPDATES,
+                                      long_polling_timeout=POLLING_TIMEOUT)
+            error_delay = 1
+        except Exception as e:
+            logger.error(f"Polling error: {e}")
+            time.sleep(error_delay)
+            error_delay = min(error_delay * 2, 60)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            update_lanes.submit(update)
+
+webhook_running = Event()
+
+def receive_webhook_update(secret):
+    """Проверяет секрет и ставит апдейт в очередь его полосы"""
+    header = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not (hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode())
+            and hmac.compare_digest(header.encode(), WEBHOOK_SECRET.encode())):
+        abort(403)
+    if not webhook_running.is_set():
+        # Еще не запустились или уже останавливаемся - Telegram повторит доставку
+        abort(503)
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'update_id' not in data:
+        abort(400)
+    # Апдейты, которые бот не обрабатывает, подтверждаем сразу
+    if not any(kind in data for kind in ALLOWED_UPDATES):
+        return ''
+    
+    update = telebot.types.Update.de_json(data)
+    if not update_lanes.submit(update, block=False):
+        logger.warning(f"Update lane is full, update {update.update_id} will be redelivered")
+        abort(503)
+    return ''
+
+def start_webhook():
+    """Запускает полосы обработки и регистрирует вебхук у Telegram"""
+    update_lanes.start()
+    webhook_running.set()
+    bot.set_webhook(
+        url=f"{WEBHOOK_URL.rstrip('/')}/webhook/{WEBHOOK_SECRET}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=ALLOWED_UPDATES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS
+    )
+
+def stop_webhook():
+    """Перестает принимать апдейты и дожидается обработки уже принятых"""
+    webhook_running.clear()
+    update_lanes.join(WEBHOOK_DRAIN_TIMEOUT)
+
 if __name__ == '__main__':
     init_db()
     update_global_admins()
-    logger.info("🤖 Бот запущен!")
-    bot.infinity_polling()
\ No newline at end of file
+    listing_index.load()
+    
+    # Несброшенные состояния пишем в базу при остановке (в том числе по SIGTERM),
+    # затем дожидаемся записей, поставленных без ожидания коммита
+    atexit.register(db_flush)
+    state_store.start()
+    atexit.register(state_store.flush)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    Thread(target=subscription_reconciler, daemon=True).start()
+    Thread(target=listing_index_checker, daemon=True).start()
+    Thread(target=outbox_relay, daemon=True).start()
+    Thread(target=ledger_snapshotter, daemon=True).start()
+    Thread(target=escrow_sweeper, daemon=True).start()
+    resume_broadcast_jobs()
+    
+    if WEBHOOK_URL:
+        start_webhook()
+        # Выполняется раньше state_store.flush: сначала дообрабатываем принятые апдейты
+        atexit.register(stop_webhook)
+        logger.info("🤖 Бот запущен (вебхук)!")
+        # Апдейты принимает веб-сервер, главный поток ждет сигнала остановки
+        Event().wait()
+    else:
+        # Пока у Telegram зарегистрирован вебхук, getUpdates не работает
+        update_lanes.start()
+        bot.remove_webhook()
+        logger.info(f"🤖 Бот запущен ({BOT_RUNTIME})!")
+        if BOT_RUNTIME == 'asyncio':
+            update_lanes.poll(BOT_TOKEN, ALLOWED_UPDATES, POLLING_TIMEOUT)
+        else:
+            poll_updates()
\ No newline at end of file
@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram_errors import retry_after
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcast:
+    """Рассылка одного сообщения в фоновом потоке.
+
+    batches - итератор пачек user_id получателей по возрастанию, send(user_id) -
+    отправка одному. Пачка отправляется пулом из workers потоков, каждая отправка
+    берет токен у общего limiter. На 429 limiter ставится на паузу retry_after
+    и отправка повторяется.
+
+    После каждой пачки checkpoint становится равен ее последнему user_id и
+    вызывается on_batch(broadcast) - с этого места рассылку можно продолжить.
+    stop() останавливает рассылку на границе пачки. on_progress(broadcast)
+    вызывается не чаще раза в progress_interval секунд и один раз в конце,
+    on_finish(broadcast) - после завершения, остановки или ошибки.
+    """
+
+    def __init__(self, batches, send, limiter, workers, total=0, delivered=0, failed=0, checkpoint=0,
+                 on_batch=None, on_progress=None, on_finish=None, progress_interval=3, max_attempts=5):
+        self.batches = batches
+        self.send = send
+        self.limiter = limiter
+        self.workers = workers
+        self.total = total
+        self.on_batch = on_batch
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.progress_interval = progress_interval
+        self.max_attempts = max_attempts
+        self.status = 'running'
+        self.delivered = delivered
+        self.failed = failed
+        self.checkpoint = checkpoint
+        self.retried = 0
+        self._done_before = delivered + failed
+        self.started_at = None
+        self.finished_at = None
+        self._reported_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.delivered + self.failed
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def rate(self):
+        """Средняя скорость отправки с момента запуска, сообщений в секунду"""
+        if self.started_at is None:
+            return 0.0
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return (self.done - self._done_before) / elapsed if elapsed > 0 else 0.0
+
+    def stop(self, status):
+        """Останавливает рассылку после текущей пачки; status - 'paused' или 'cancelled'"""
+        self.status = status
+
+    def start(self):
+        """Запускает run() в фоновом потоке"""
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        self.started_at = time.monotonic()
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                for batch in self.batches:
+                    if self.status != 'running':
+                        break
+                    # Следующая пачка читается, только когда отправлена текущая
+                    for _ in pool.map(self._deliver, batch):
+                        pass
+                    self.checkpoint = batch[-1]
+                    if self.on_batch is not None:
+                        self.on_batch(self)
+            if self.status == 'running':
+                self.status = 'completed'
+        except Exception as e:
+            self.status = 'failed'
+            logger.error(f"Broadcast stopped: {e}")
+        finally:
+            self.finished_at = time.monotonic()
+            self._report(force=True)
+            if self.on_finish is not None:
+                self.on_finish(self)
+
+    def _deliver(self, user_id):
+        for attempt in range(self.max_attempts):
+            self.limiter.acquire()
+            try:
+                self.send(user_id)
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None or attempt == self.max_attempts - 1:
+                    logger.debug(f"Broadcast to {user_id} failed: {e}")
+                    break
+                self.limiter.pause(delay)
+                with self._lock:
+                    self.retried += 1
+            else:
+                with self._lock:
+                    self.delivered += 1
+                self._report()
+                return True
+        with self._lock:
+            self.failed += 1
+        self._report()
+        return False
+
+    def _report(self, force=False):
+        if self.on_progress is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._reported_at < self.progress_interval:
+                return
+            self._reported_at = now
+        try:
+            self.on_progress(self)
+        except Exception as e:
+            logger.error(f"Error reporting broadcast progress: {e}")
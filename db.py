@@ -0,0 +1,237 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+# Путь к базе данных (можно переопределить переменной окружения)
+DB_PATH = os.environ.get("DB_PATH", "nft_market.db")
+
+# Настройки соединения: применяются один раз при открытии
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=134217728",
+)
+
+_local = threading.local()
+_readers = {}
+_readers_lock = threading.Lock()
+
+# Групповой коммит: в транзакцию попадает все, что накопилось, пока шла предыдущая.
+# GROUP_COMMIT_WINDOW - сколько дополнительно ждать следующих заданий (0 - не ждать:
+# ожидание только задерживает тех, кто ждет коммита), GROUP_COMMIT_MAX_JOBS - предел группы
+GROUP_COMMIT_WINDOW = 0
+GROUP_COMMIT_MAX_JOBS = 500
+
+_writer = None
+_writer_lock = threading.RLock()
+
+_write_queue = queue.Queue()
+_write_thread = None
+_write_thread_lock = threading.Lock()
+_write_stats = {'jobs': 0, 'groups': 0, 'failed': 0, 'max_group': 0}
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _prune_readers():
+    """Закрывает соединения потоков, которые уже завершились"""
+    alive = {thread.ident for thread in threading.enumerate()}
+    for ident in list(_readers):
+        if ident not in alive:
+            _readers.pop(ident).close()
+
+
+def _get_reader():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _connect()
+        conn.execute("PRAGMA query_only=ON")
+        with _readers_lock:
+            _prune_readers()
+            _readers[threading.get_ident()] = conn
+        _local.conn = conn
+    return conn
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        _writer = _connect()
+    return _writer
+
+
+@contextmanager
+def db_read():
+    """Курсор на долгоживущем читающем соединении текущего потока"""
+    cursor = _get_reader().cursor()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def db_write():
+    """Курсор единственного пишущего соединения внутри транзакции.
+
+    Коммитит при выходе, откатывает при исключении. Вложенные вызовы
+    в том же потоке выполняются в рамках внешней транзакции.
+    """
+    with _writer_lock:
+        conn = _get_writer()
+        nested = conn.in_transaction
+        cursor = conn.cursor()
+        if not nested:
+            cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            if not nested:
+                conn.rollback()
+            raise
+        else:
+            if not nested:
+                conn.commit()
+        finally:
+            cursor.close()
+
+
+class _WriteJob:
+    __slots__ = ('func', 'args', 'future')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.future = Future()
+
+
+def db_submit(func, *args):
+    """Ставит запись func(cursor, *args) в очередь пишущего потока. Возвращает Future.
+
+    Пишущий поток собирает накопившиеся в очереди задания в одну транзакцию
+    (групповой коммит). Каждое задание выполняется в своем SAVEPOINT:
+    ошибка откатывает только его, исключение получит его Future. Future
+    завершается после COMMIT с результатом func - future.result() ждет, пока
+    запись станет постоянной; если ждать не нужно, Future можно не смотреть.
+    """
+    global _write_thread
+    if _write_thread is None:
+        with _write_thread_lock:
+            if _write_thread is None:
+                _write_thread = threading.Thread(target=_write_loop, name='db-writer', daemon=True)
+                _write_thread.start()
+    job = _WriteJob(func, args)
+    _write_queue.put(job)
+    return job.future
+
+
+def _execute(cursor, sql, params):
+    cursor.execute(sql, params)
+    return cursor.rowcount
+
+
+def db_execute(sql, params=()):
+    """Один запрос через пишущий поток (см. db_submit). Future с числом измененных строк"""
+    return db_submit(_execute, sql, params)
+
+
+def db_flush():
+    """Ждет, пока будут закоммичены все поставленные до этого задания"""
+    db_submit(lambda cursor: None).result()
+
+
+def _write_loop():
+    while True:
+        jobs = [_write_queue.get()]
+        deadline = time.monotonic() + GROUP_COMMIT_WINDOW
+        while len(jobs) < GROUP_COMMIT_MAX_JOBS:
+            # Забираем все, что накопилось, пока шла предыдущая транзакция
+            try:
+                jobs.append(_write_queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(_write_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        _commit_group(jobs)
+
+
+def _commit_group(jobs):
+    results = []
+    try:
+        with _writer_lock:
+            conn = _get_writer()
+            cursor = conn.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                for job in jobs:
+                    cursor.execute("SAVEPOINT job")
+                    try:
+                        result = job.func(cursor, *job.args)
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO job")
+                        cursor.execute("RELEASE job")
+                        results.append((False, e))
+                    else:
+                        cursor.execute("RELEASE job")
+                        results.append((True, result))
+                conn.commit()
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            finally:
+                cursor.close()
+    except Exception as e:
+        # Не удалось закоммитить группу - ошибку получают все ее задания
+        results = [(False, e)] * len(jobs)
+
+    failed = 0
+    for job, (ok, value) in zip(jobs, results):
+        if ok:
+            job.future.set_result(value)
+        else:
+            failed += 1
+            job.future.set_exception(value)
+    with _write_thread_lock:
+        _write_stats['jobs'] += len(jobs)
+        _write_stats['groups'] += 1
+        _write_stats['failed'] += failed
+        _write_stats['max_group'] = max(_write_stats['max_group'], len(jobs))
+
+
+def writer_stats():
+    """Счетчики пишущего потока: заданий, транзакций, ошибок, самая большая группа, в очереди"""
+    with _write_thread_lock:
+        return dict(_write_stats, queued=_write_queue.qsize())
+
+
+def close_all():
+    """Закрывает все соединения (при остановке процесса)"""
+    global _writer
+    with _readers_lock:
+        for conn in _readers.values():
+            conn.close()
+        _readers.clear()
+    _local.__dict__.pop('conn', None)
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
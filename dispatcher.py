@@ -0,0 +1,96 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LaneDispatcher:
+    """Обработка апдейтов в lanes потоках ("полосах").
+
+    Полоса выбирается по ключу апдейта: key(update) % lanes (ключ - id пользователя).
+    Апдейты одного пользователя обрабатываются по очереди в одной полосе, разных
+    пользователей - параллельно в разных. У каждой полосы своя очередь не больше
+    lane_size апдейтов. process(update) - обработка одного апдейта.
+    """
+
+    def __init__(self, process, key, lanes, lane_size):
+        self.process = process
+        self.key = key
+        self.lanes = lanes
+        self.lane_size = lane_size
+        self._queues = [queue.Queue(lane_size) for _ in range(lanes)]
+        self._counters = [{'processed': 0, 'errors': 0, 'rejected': 0, 'max_depth': 0} for _ in range(lanes)]
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for lane in range(self.lanes):
+                thread = threading.Thread(target=self._run, args=(lane,), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def lane_of(self, update):
+        return hash(self.key(update)) % self.lanes
+
+    def submit(self, update, block=True):
+        """Ставит апдейт в очередь его полосы. Если block=False и очередь полна, возвращает False"""
+        if not self._threads:
+            self.start()
+        lane = self.lane_of(update)
+        try:
+            self._queues[lane].put(update, block)
+        except queue.Full:
+            with self._lock:
+                self._counters[lane]['rejected'] += 1
+            return False
+        depth = self._queues[lane].qsize()
+        with self._lock:
+            counters = self._counters[lane]
+            counters['max_depth'] = max(counters['max_depth'], depth)
+        return True
+
+    def _run(self, lane):
+        updates = self._queues[lane]
+        while True:
+            update = updates.get()
+            failed = False
+            try:
+                self.process(update)
+            except Exception as e:
+                failed = True
+                logger.error(f"Error processing update in lane {lane}: {e}")
+            finally:
+                with self._lock:
+                    self._counters[lane]['processed'] += 1
+                    self._counters[lane]['errors'] += failed
+                updates.task_done()
+
+    def pending(self):
+        """Сколько принятых апдейтов еще не обработано"""
+        return sum(updates.unfinished_tasks for updates in self._queues)
+
+    def join(self, timeout):
+        """Ждет обработки принятых апдейтов не дольше timeout секунд. True - все обработаны"""
+        deadline = time.monotonic() + timeout
+        while self.pending():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def stats(self):
+        """Счетчики по полосам: глубина очереди сейчас и максимальная, обработано, ошибок, отклонено"""
+        with self._lock:
+            return [{
+                'lane': lane,
+                'depth': self._queues[lane].qsize(),
+                'max_depth': counters['max_depth'],
+                'processed': counters['processed'],
+                'errors': counters['errors'],
+                'rejected': counters['rejected'],
+            } for lane, counters in enumerate(self._counters)]
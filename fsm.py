@@ -0,0 +1,59 @@
+import json
+
+
+class StateHandler:
+    """Обработчик одного состояния и описание его данных"""
+
+    __slots__ = ('name', 'handler', 'fields', 'admin_only')
+
+    def __init__(self, name, handler, fields, admin_only):
+        self.name = name
+        self.handler = handler
+        self.fields = fields
+        self.admin_only = admin_only
+
+    def decode(self, state_data):
+        """Разбирает state_data в словарь аргументов с нужными типами"""
+        if state_data is None:
+            raise ValueError(f"State {self.name} has no data")
+        if state_data.startswith('{'):
+            raw = json.loads(state_data)
+        else:
+            # Старый формат "a|b|c" из записей, сохраненных до перехода на JSON
+            raw = dict(zip(self.fields, state_data.split('|', len(self.fields) - 1)))
+        return {field: field_type(raw[field]) for field, field_type in self.fields.items()}
+
+
+class StateMachine:
+    """Реестр состояний пользователя: имя состояния -> обработчик.
+
+    Данные состояния хранятся в user_states.state_data как JSON-объект.
+    """
+
+    def __init__(self):
+        self._states = {}
+
+    def state(self, name, admin_only=False, **fields):
+        """Декоратор: регистрирует обработчик состояния и типы его данных"""
+        def decorator(handler):
+            self._states[name] = StateHandler(name, handler, fields, admin_only)
+            return handler
+        return decorator
+
+    @staticmethod
+    def encode(payload):
+        if not payload:
+            return None
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+    def resolve(self, state, state_data):
+        """Возвращает (обработчик, аргументы) или None, если состояние неизвестно или данные битые"""
+        entry = self._states.get(state)
+        if entry is None:
+            return None
+        if not entry.fields:
+            return entry, {}
+        try:
+            return entry, entry.decode(state_data)
+        except (ValueError, KeyError, TypeError):
+            return None
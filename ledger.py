@@ -0,0 +1,216 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Счета журнала: счет пользователя - его user_id, системные счета отрицательные
+ESCROW = -1       # деньги покупателей по незавершенным сделкам
+WITHDRAWALS = -2  # суммы заявок на вывод до решения администратора
+PAYOUTS = -3      # выведено из системы
+DEPOSITS = -4     # пополнения администратором
+PROMOCODES = -5   # начисления по промокодам
+OPENING = -6      # остатки на момент перехода на журнал
+
+ACCOUNT_NAMES = {
+    ESCROW: 'escrow',
+    WITHDRAWALS: 'withdrawals',
+    PAYOUTS: 'payouts',
+    DEPOSITS: 'deposits',
+    PROMOCODES: 'promocodes',
+    OPENING: 'opening',
+}
+
+# Расхождение меньше копейки - погрешность REAL, а не ошибка
+TOLERANCE = 0.005
+
+TABLES = {
+    # Проводка: одна денежная операция
+    'ledger_txns': '''
+        CREATE TABLE IF NOT EXISTS ledger_txns (
+            txn_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    # Движения по счетам; сумма движений одной проводки равна нулю
+    'ledger': '''
+        CREATE TABLE IF NOT EXISTS ledger (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            txn_id INTEGER NOT NULL,
+            account_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (txn_id) REFERENCES ledger_txns (txn_id)
+        )
+    ''',
+    # Баланс счета по журналу с учетом всех движений до entry_id включительно
+    'ledger_snapshots': '''
+        CREATE TABLE IF NOT EXISTS ledger_snapshots (
+            snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account_id INTEGER NOT NULL,
+            entry_id INTEGER NOT NULL,
+            balance REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+}
+
+INDEXES = [
+    # Движения счета за период (покрывающий: сумма считается без обращения к таблице)
+    'CREATE INDEX IF NOT EXISTS idx_ledger_account ON ledger (account_id, created_at, entry_id, amount)',
+    'CREATE INDEX IF NOT EXISTS idx_ledger_snapshots_account ON ledger_snapshots (account_id, created_at, entry_id)',
+]
+
+# Журнал только дописывается
+TRIGGERS = [
+    f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_no_{action} BEFORE {action.upper()} ON {table} BEGIN
+            SELECT RAISE(ABORT, '{table} is append-only');
+        END
+    '''
+    for table in ('ledger_txns', 'ledger') for action in ('update', 'delete')
+]
+
+
+def create_schema(cursor):
+    """Таблицы, индексы и триггеры журнала; при первом создании - начальные остатки"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ledger'")
+    exists = cursor.fetchone()
+    for table_sql in TABLES.values():
+        cursor.execute(table_sql)
+    for index_sql in INDEXES:
+        cursor.execute(index_sql)
+    for trigger_sql in TRIGGERS:
+        cursor.execute(trigger_sql)
+    if not exists:
+        open_balances(cursor)
+        snapshot(cursor)
+
+
+def open_balances(cursor):
+    """Переносит в журнал балансы, накопленные до него: users.balance, эскроу и заявки на вывод.
+
+    users.balance уже содержит эти суммы, поэтому проекция не обновляется.
+    """
+    cursor.execute('SELECT user_id, balance FROM users WHERE balance != 0')
+    legs = cursor.fetchall()
+    cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM purchases WHERE status = 'pending'")
+    legs.append((ESCROW, cursor.fetchone()[0]))
+    cursor.execute("SELECT COALESCE(SUM(amount), 0) FROM withdraw_requests WHERE status = 'pending'")
+    legs.append((WITHDRAWALS, cursor.fetchone()[0]))
+    legs = [(account, amount) for account, amount in legs if amount]
+    if not legs:
+        return None
+    legs.append((OPENING, -sum(amount for _, amount in legs)))
+    txn_id = _journal(cursor, 'opening', 'Остатки на момент перехода на журнал', legs)
+    logger.info(f"Ledger opened with {len(legs) - 1} balances")
+    return txn_id
+
+
+def _journal(cursor, kind, description, legs):
+    cursor.execute('INSERT INTO ledger_txns (kind, description) VALUES (?, ?)', (kind, description))
+    txn_id = cursor.lastrowid
+    cursor.executemany('INSERT INTO ledger (txn_id, account_id, amount) VALUES (?, ?, ?)',
+                       [(txn_id, account, amount) for account, amount in legs])
+    return txn_id
+
+
+def _project(cursor, account, amount):
+    # users.balance - кэш баланса по журналу, меняется в той же транзакции
+    if account > 0:
+        cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, account))
+        if cursor.rowcount != 1:
+            raise ValueError(f"Unknown ledger account {account}")
+
+
+def transfer(cursor, source, target, amount, kind, description, check_funds=False):
+    """Проводка: amount со счета source на счет target. Возвращает txn_id.
+
+    Выполняется внутри транзакции писателя (cursor из db_write или задания db_submit).
+    check_funds - списать со счета пользователя, только если баланса хватает;
+    иначе ничего не записывается и возвращается None.
+    """
+    if amount <= 0:
+        raise ValueError(f"Ledger amount must be positive: {amount}")
+    if check_funds and source > 0:
+        cursor.execute('UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?',
+                       (amount, source, amount))
+        if cursor.rowcount != 1:
+            return None
+    else:
+        _project(cursor, source, -amount)
+    _project(cursor, target, amount)
+    return _journal(cursor, kind, description, [(source, -amount), (target, amount)])
+
+
+def _last_snapshot(cursor, account, at=None):
+    if at is None:
+        cursor.execute('''
+            SELECT entry_id, balance, created_at FROM ledger_snapshots
+            WHERE account_id = ? ORDER BY created_at DESC, entry_id DESC LIMIT 1
+        ''', (account,))
+    else:
+        cursor.execute('''
+            SELECT entry_id, balance, created_at FROM ledger_snapshots
+            WHERE account_id = ? AND created_at <= ? ORDER BY created_at DESC, entry_id DESC LIMIT 1
+        ''', (account, at))
+    return cursor.fetchone() or (0, 0.0, '')
+
+
+def balance_at(cursor, account, at=None):
+    """Баланс счета по журналу на момент at ('YYYY-MM-DD HH:MM:SS', UTC); None - текущий.
+
+    Последний снимок до at плюс движения после него - поиск по индексам,
+    без просмотра всего журнала.
+    """
+    entry_id, balance, since = _last_snapshot(cursor, account, at)
+    if at is None:
+        cursor.execute('''
+            SELECT COALESCE(SUM(amount), 0) FROM ledger
+            WHERE account_id = ? AND created_at >= ? AND entry_id > ?
+        ''', (account, since, entry_id))
+    else:
+        cursor.execute('''
+            SELECT COALESCE(SUM(amount), 0) FROM ledger
+            WHERE account_id = ? AND created_at >= ? AND created_at <= ? AND entry_id > ?
+        ''', (account, since, at, entry_id))
+    return balance + cursor.fetchone()[0]
+
+
+def snapshot(cursor):
+    """Снимает балансы счетов, по которым были движения с прошлого снимка, и сверяет их.
+
+    Работа пропорциональна числу новых движений. Возвращает словарь:
+    accounts - сколько счетов снято, entries - сколько движений учтено,
+    imbalance - сумма новых движений (для двойной записи 0),
+    mismatches - [(user_id, users.balance, баланс по журналу)].
+    """
+    cursor.execute('SELECT entry_id FROM ledger_snapshots ORDER BY snapshot_id DESC LIMIT 1')
+    row = cursor.fetchone()
+    last_entry = row[0] if row else 0
+    cursor.execute('SELECT COALESCE(MAX(entry_id), 0) FROM ledger')
+    high = cursor.fetchone()[0]
+    result = {'accounts': 0, 'entries': 0, 'imbalance': 0.0, 'mismatches': []}
+    if high <= last_entry:
+        return result
+
+    cursor.execute('''
+        SELECT account_id, SUM(amount), COUNT(*) FROM ledger
+        WHERE entry_id > ? AND entry_id <= ? GROUP BY account_id
+    ''', (last_entry, high))
+    changes = cursor.fetchall()
+    snapshots = []
+    for account, delta, entries in changes:
+        balance = _last_snapshot(cursor, account)[1] + delta
+        snapshots.append((account, high, balance))
+        result['entries'] += entries
+        result['imbalance'] += delta
+        if account > 0:
+            cursor.execute('SELECT balance FROM users WHERE user_id = ?', (account,))
+            cached = cursor.fetchone()
+            cached = cached[0] if cached else None
+            if cached is None or abs(cached - balance) > TOLERANCE:
+                result['mismatches'].append((account, cached, balance))
+    cursor.executemany('INSERT INTO ledger_snapshots (account_id, entry_id, balance) VALUES (?, ?, ?)', snapshots)
+    result['accounts'] = len(snapshots)
+    return result
@@ -0,0 +1,231 @@
+import bisect
+import sys
+import threading
+from collections import Counter
+
+from db import db_read
+
+# Столбцы, которые индекс держит в памяти (slots + денормализованный username продавца)
+_COLUMNS = 's.slot_id, s.seller_id, s.description, s.price_rub, s.seller_rating, u.username'
+
+
+class Listing:
+    """Активный слот со скопированными данными продавца"""
+
+    __slots__ = ('slot_id', 'seller_id', 'description', 'price_rub', 'seller_rating', 'username')
+
+    def __init__(self, slot_id, seller_id, description, price_rub, seller_rating, username):
+        self.slot_id = slot_id
+        self.seller_id = seller_id
+        self.description = description
+        self.price_rub = price_rub
+        self.seller_rating = 0.0 if seller_rating is None else seller_rating
+        self.username = username
+
+    def as_row(self):
+        return (self.slot_id, self.seller_id, self.description, self.price_rub, self.seller_rating, self.username)
+
+
+class ListingIndex:
+    """Активные слоты в памяти, отсортированные под каждую сортировку списка.
+
+    sorts: код -> (столбцы ключа, по убыванию ли). Последний столбец ключа - slot_id.
+    bands: ценовые диапазоны [(от, до)], None - без границы.
+    Для каждой пары (сортировка, диапазон) хранится отсортированный список ключей
+    (столбцы по убыванию хранятся с обратным знаком), страницы ищутся через bisect.
+    Курсоры те же, что у SQL-запроса: значения столбцов ключа через ":".
+    """
+
+    def __init__(self, sorts, bands):
+        self.sorts = sorts
+        self.bands = bands
+        self.loaded = False
+        self._listings = {}
+        self._by_seller = {}
+        self._keys = self._empty_keys()
+        self._lock = threading.RLock()
+
+    def _empty_keys(self):
+        return {(code, band): [] for code in self.sorts for band in range(len(self.bands))}
+
+    def _bands_of(self, listing):
+        price = listing.price_rub
+        return [band for band, (low, high) in enumerate(self.bands)
+                if (low is None or price >= low) and (high is None or price < high)]
+
+    def _key(self, sort, listing):
+        columns, descending = self.sorts[sort]
+        sign = -1 if descending else 1
+        return tuple(sign * getattr(listing, column) for column in columns)
+
+    def _parse_cursor(self, sort, cursor):
+        _, descending = self.sorts[sort]
+        sign = -1 if descending else 1
+        return tuple(sign * float(value) for value in cursor.split(':'))
+
+    def _format_cursor(self, sort, listing):
+        columns, _ = self.sorts[sort]
+        return ':'.join(str(getattr(listing, column)) for column in columns)
+
+    def _slot_id(self, sort, key):
+        _, descending = self.sorts[sort]
+        return int(-key[-1] if descending else key[-1])
+
+    def load(self):
+        """Полная загрузка активных слотов из базы"""
+        with db_read() as cursor:
+            cursor.execute(f'''
+                SELECT {_COLUMNS}
+                FROM slots s LEFT JOIN users u ON u.user_id = s.seller_id
+                WHERE s.is_active = TRUE
+            ''')
+            listings = [Listing(*row) for row in cursor.fetchall()]
+
+        by_seller = {}
+        for listing in listings:
+            by_seller.setdefault(listing.seller_id, set()).add(listing.slot_id)
+        keys = self._empty_keys()
+        for listing in listings:
+            for band in self._bands_of(listing):
+                for code in self.sorts:
+                    keys[code, band].append(self._key(code, listing))
+        for band_keys in keys.values():
+            band_keys.sort()
+
+        with self._lock:
+            self._listings = {listing.slot_id: listing for listing in listings}
+            self._by_seller = by_seller
+            self._keys = keys
+            self.loaded = True
+
+    def _add(self, listing):
+        self._listings[listing.slot_id] = listing
+        self._by_seller.setdefault(listing.seller_id, set()).add(listing.slot_id)
+        for band in self._bands_of(listing):
+            for code in self.sorts:
+                bisect.insort(self._keys[code, band], self._key(code, listing))
+
+    def _remove(self, slot_id):
+        listing = self._listings.pop(slot_id, None)
+        if listing is None:
+            return
+        seller_slots = self._by_seller.get(listing.seller_id)
+        if seller_slots is not None:
+            seller_slots.discard(slot_id)
+            if not seller_slots:
+                del self._by_seller[listing.seller_id]
+        for band in self._bands_of(listing):
+            for code in self.sorts:
+                keys = self._keys[code, band]
+                key = self._key(code, listing)
+                index = bisect.bisect_left(keys, key)
+                if index < len(keys) and keys[index] == key:
+                    del keys[index]
+
+    def refresh(self, *slot_ids):
+        """Перечитывает слоты из базы: активные добавляются или обновляются, остальные удаляются"""
+        if not self.loaded or not slot_ids:
+            return
+        with db_read() as cursor:
+            cursor.execute(f'''
+                SELECT {_COLUMNS}
+                FROM slots s LEFT JOIN users u ON u.user_id = s.seller_id
+                WHERE s.is_active = TRUE AND s.slot_id IN ({', '.join('?' * len(slot_ids))})
+            ''', slot_ids)
+            rows = cursor.fetchall()
+        with self._lock:
+            for slot_id in slot_ids:
+                self._remove(slot_id)
+            for row in rows:
+                self._add(Listing(*row))
+
+    def refresh_seller(self, seller_id):
+        """Перечитывает все слоты продавца (например, после изменения его рейтинга)"""
+        if not self.loaded:
+            return
+        with self._lock:
+            slot_ids = tuple(self._by_seller.get(seller_id, ()))
+        self.refresh(*slot_ids)
+
+    def page(self, viewer_id, sort, band, page_size, after=None, before=None):
+        """Страница слотов: ([(slot_id, описание, цена)], курсор_предыдущей, курсор_следующей).
+
+        Слоты самого viewer_id пропускаются, band - номер ценового диапазона.
+        """
+        backwards = before is not None
+        cursor_value = before if backwards else after
+
+        with self._lock:
+            keys = self._keys[sort, band]
+            if cursor_value is not None:
+                key = self._parse_cursor(sort, cursor_value)
+                start = bisect.bisect_left(keys, key) if backwards else bisect.bisect_right(keys, key)
+            else:
+                start = 0
+
+            found = []
+            step = -1 if backwards else 1
+            index = start - 1 if backwards else start
+            while 0 <= index < len(keys) and len(found) <= page_size:
+                listing = self._listings[self._slot_id(sort, keys[index])]
+                index += step
+                if listing.seller_id != viewer_id:
+                    found.append(listing)
+
+        has_more = len(found) > page_size
+        found = found[:page_size]
+        if backwards:
+            found.reverse()
+        if not found:
+            return [], None, None
+
+        first_key = self._format_cursor(sort, found[0])
+        last_key = self._format_cursor(sort, found[-1])
+        if backwards:
+            prev_cursor, next_cursor = (first_key if has_more else None), last_key
+        else:
+            prev_cursor, next_cursor = (first_key if after is not None else None), (last_key if has_more else None)
+        return [(listing.slot_id, listing.description, listing.price_rub) for listing in found], prev_cursor, next_cursor
+
+    def check(self):
+        """Сверяет индекс с базой. Возвращает (нет в индексе, лишние в индексе, устаревшие)"""
+        with db_read() as cursor:
+            cursor.execute(f'''
+                SELECT {_COLUMNS}
+                FROM slots s LEFT JOIN users u ON u.user_id = s.seller_id
+                WHERE s.is_active = TRUE
+            ''')
+            expected = {row[0]: Listing(*row).as_row() for row in cursor.fetchall()}
+        with self._lock:
+            actual = {slot_id: listing.as_row() for slot_id, listing in self._listings.items()}
+            band_sizes = Counter(band for listing in self._listings.values() for band in self._bands_of(listing))
+            sizes_ok = all(len(keys) == band_sizes[band] for (_, band), keys in self._keys.items())
+
+        missing = len(expected.keys() - actual.keys())
+        extra = len(actual.keys() - expected.keys())
+        stale = sum(1 for slot_id in expected.keys() & actual.keys() if expected[slot_id] != actual[slot_id])
+        if not sizes_ok:
+            stale += 1
+        return missing, extra, stale
+
+    def memory_usage(self):
+        """Примерный объем памяти индекса в байтах (контейнеры, объекты, строки и ключи)"""
+        with self._lock:
+            total = sys.getsizeof(self._listings) + sys.getsizeof(self._by_seller)
+            for listing in self._listings.values():
+                total += sys.getsizeof(listing) + sys.getsizeof(listing.description)
+                if listing.username is not None:
+                    total += sys.getsizeof(listing.username)
+            for seller_slots in self._by_seller.values():
+                total += sys.getsizeof(seller_slots)
+            for keys in self._keys.values():
+                total += sys.getsizeof(keys) + sum(sys.getsizeof(key) for key in keys)
+            return total
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._listings),
+                'sellers': len(self._by_seller),
+                'loaded': self.loaded,
+            }
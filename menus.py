@@ -0,0 +1,49 @@
+from telebot.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup
+
+
+def reply_markup(labels, row_width=2):
+    """Сериализованная обычная клавиатура (собирается один раз)"""
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=row_width)
+    keyboard.add(*(KeyboardButton(label) for label in labels))
+    return keyboard.to_json()
+
+
+def inline_markup(*rows):
+    """Сериализованная инлайн-клавиатура: каждая строка - список InlineKeyboardButton"""
+    keyboard = InlineKeyboardMarkup()
+    for row in rows:
+        keyboard.add(*row)
+    return keyboard.to_json()
+
+
+class MenuCommand:
+    """Кнопка текстового меню и ее обработчик"""
+
+    __slots__ = ('label', 'handler', 'admin_only')
+
+    def __init__(self, label, handler, admin_only):
+        self.label = label
+        self.handler = handler
+        self.admin_only = admin_only
+
+
+class MenuRegistry:
+    """Реестр кнопок текстовых меню: надпись -> обработчик.
+
+    labels - frozenset всех надписей для проверки "это команда меню?" за O(1).
+    """
+
+    def __init__(self):
+        self._commands = {}
+        self.labels = frozenset()
+
+    def command(self, label, admin_only=False):
+        """Декоратор: регистрирует обработчик handler(message) кнопки меню"""
+        def decorator(handler):
+            self._commands[label] = MenuCommand(label, handler, admin_only)
+            self.labels = frozenset(self._commands)
+            return handler
+        return decorator
+
+    def get(self, label):
+        return self._commands.get(label)
@@ -0,0 +1,249 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from telebot import TeleBot
+
+from ratelimit import TokenBucket
+from telegram_errors import retry_after
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих сообщений: меньше - раньше
+URGENT = 0  # уведомления о сделках и деньгах
+REPLY = 1   # ответы пользователю в его чате
+BULK = 2    # рассылки
+
+PRIORITY_NAMES = {URGENT: 'urgent', REPLY: 'reply', BULK: 'bulk'}
+
+
+class OutboundQueueFull(Exception):
+    """Очередь отправки переполнена, сообщение отброшено"""
+
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'chat_id', 'func', 'args', 'kwargs',
+                 'future', 'enqueued_at', 'attempts', 'holds_chat')
+
+    def __init__(self, priority, seq, chat_id, func, args, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.holds_chat = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundQueue:
+    """Очередь исходящих запросов к Bot API с приоритетами и ограничением скорости.
+
+    Запрос берется из очереди по приоритету, если у его чата есть токен
+    (chat_rate в секунду, не больше chat_burst подряд), иначе откладывается до
+    появления токена. Затем рабочий поток ждет токен общего ограничителя
+    global_rate. В одном чате одновременно отправляется не больше одного
+    сообщения, поэтому порядок сообщений чата сохраняется.
+
+    На 429 чат и общий ограничитель ставятся на паузу retry_after, запрос
+    повторяется (до max_attempts раз). Если в очереди уже maxsize запросов,
+    новый отбрасывается: его Future завершается OutboundQueueFull.
+    """
+
+    def __init__(self, global_rate, chat_rate, chat_burst, workers, maxsize,
+                 max_attempts=5, max_chats=10000):
+        # Общий лимит без запаса: сообщения идут равномерно, без всплесков сверх global_rate
+        self.global_limiter = TokenBucket(global_rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_attempts = max_attempts
+        self.max_chats = max_chats
+        self._chat_limiters = OrderedDict()
+        self._ready = []
+        self._delayed = []
+        self._busy = set()
+        self._parked = {}
+        self._size = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._counters = {
+            priority: {'queued': 0, 'sent': 0, 'failed': 0, 'dropped': 0, 'retried': 0,
+                       'wait_total': 0.0, 'wait_max': 0.0}
+            for priority in PRIORITY_NAMES
+        }
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._run, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, priority, chat_id, func, *args, **kwargs):
+        """Ставит вызов func(*args, **kwargs) в очередь; возвращает Future с результатом"""
+        if not self._threads:
+            self.start()
+        job = _Job(priority, next(self._seq), chat_id, func, args, kwargs)
+        with self._cond:
+            counters = self._counters[priority]
+            if self._size >= self.maxsize:
+                counters['dropped'] += 1
+                job.future.set_exception(OutboundQueueFull(f"Outbound queue is full ({self.maxsize})"))
+                return job.future
+            counters['queued'] += 1
+            self._size += 1
+            heapq.heappush(self._ready, job)
+            self._cond.notify()
+        return job.future
+
+    def _chat_limiter(self, chat_id):
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._chat_limiters[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_limiters) > self.max_chats:
+                self._chat_limiters.popitem(last=False)
+        else:
+            self._chat_limiters.move_to_end(chat_id)
+        return limiter
+
+    def _take(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    heapq.heappush(self._ready, heapq.heappop(self._delayed)[1])
+                while self._ready:
+                    job = heapq.heappop(self._ready)
+                    if job.chat_id in self._busy and not job.holds_chat:
+                        # Чат занят отправляемым или отложенным сообщением - ждем его, чтобы не нарушить порядок
+                        self._parked.setdefault(job.chat_id, deque()).append(job)
+                        continue
+                    self._busy.add(job.chat_id)
+                    job.holds_chat = True
+                    delay = self._chat_limiter(job.chat_id).try_acquire()
+                    if delay:
+                        heapq.heappush(self._delayed, (now + delay, job))
+                        continue
+                    return job
+                self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+
+    def _finish(self, job):
+        with self._cond:
+            self._size -= 1
+            counters = self._counters[job.priority]
+            counters['queued'] -= 1
+            wait = time.monotonic() - job.enqueued_at
+            counters['wait_total'] += wait
+            counters['wait_max'] = max(counters['wait_max'], wait)
+            self._busy.discard(job.chat_id)
+            parked = self._parked.pop(job.chat_id, None)
+            if parked:
+                for parked_job in parked:
+                    heapq.heappush(self._ready, parked_job)
+                self._cond.notify(len(parked))
+
+    def _run(self):
+        while True:
+            job = self._take()
+            self.global_limiter.acquire()
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is not None and job.attempts + 1 < self.max_attempts:
+                    job.attempts += 1
+                    self._chat_limiter(job.chat_id).pause(delay)
+                    self.global_limiter.pause(delay)
+                    with self._cond:
+                        self._counters[job.priority]['retried'] += 1
+                        heapq.heappush(self._delayed, (time.monotonic() + delay, job))
+                        self._cond.notify()
+                    continue
+                with self._cond:
+                    self._counters[job.priority]['failed'] += 1
+                self._finish(job)
+                job.future.set_exception(e)
+            else:
+                with self._cond:
+                    self._counters[job.priority]['sent'] += 1
+                self._finish(job)
+                job.future.set_result(result)
+
+    def stats(self):
+        """Глубина очереди и счетчики по приоритетам; ожидание - от постановки до отправки, мс"""
+        with self._cond:
+            priorities = {}
+            for priority, counters in self._counters.items():
+                done = counters['sent'] + counters['failed']
+                priorities[PRIORITY_NAMES[priority]] = {
+                    'queued': counters['queued'],
+                    'sent': counters['sent'],
+                    'failed': counters['failed'],
+                    'dropped': counters['dropped'],
+                    'retried': counters['retried'],
+                    'avg_wait_ms': counters['wait_total'] / done * 1000 if done else 0.0,
+                    'max_wait_ms': counters['wait_max'] * 1000,
+                }
+            return {
+                'depth': self._size,
+                'delayed': len(self._delayed),
+                'chats': len(self._chat_limiters),
+                'priorities': priorities,
+            }
+
+
+class QueuedTeleBot(TeleBot):
+    """TeleBot, который отправляет send_message, send_photo и edit_message_text через OutboundQueue.
+
+    По умолчанию вызов только ставит запрос в очередь и возвращает Future: обработчик
+    не ждет лимита чата. Ошибку такой отправки получает on_error(chat_id, error).
+    wait=True - дождаться отправки и вернуть результат или бросить ошибку API, как
+    обычный TeleBot (нужно, если используется ответ). priority - приоритет в очереди.
+    """
+
+    def __init__(self, token, outbound, on_error=None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.outbound = outbound
+        self.on_error = on_error
+
+    def _queued(self, priority, wait, chat_id, method, *args, **kwargs):
+        future = self.outbound.submit(priority, chat_id, method, *args, **kwargs)
+        if wait:
+            return future.result()
+        future.add_done_callback(lambda done: self._report(chat_id, done))
+        return future
+
+    def _report(self, chat_id, future):
+        error = future.exception()
+        if error is None:
+            return
+        if self.on_error is None:
+            logger.warning(f"Error sending to {chat_id}: {error}")
+            return
+        try:
+            self.on_error(chat_id, error)
+        except Exception as e:
+            logger.error(f"Error handling send failure for {chat_id}: {e}")
+
+    def send_message(self, chat_id, text, *args, priority=REPLY, wait=False, **kwargs):
+        return self._queued(priority, wait, chat_id, super().send_message, chat_id, text, *args, **kwargs)
+
+    def send_photo(self, chat_id, photo, *args, priority=REPLY, wait=False, **kwargs):
+        return self._queued(priority, wait, chat_id, super().send_photo, chat_id, photo, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, *args, priority=REPLY, wait=False, **kwargs):
+        return self._queued(priority, wait, chat_id, super().edit_message_text, text, chat_id, *args, **kwargs)
@@ -0,0 +1,72 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, не больше capacity подряд.
+
+    acquire() блокирует поток до появления токена. pause() останавливает выдачу
+    токенов всем потокам (например, на retry_after из ответа 429).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.waits = 0
+        self.pauses = 0
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        waited = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self.waits += waited
+                        return
+                    delay = (1 - self._tokens) / self.rate
+            waited = True
+            time.sleep(delay)
+
+    def try_acquire(self):
+        """Берет токен без ожидания. Возвращает 0, если токен взят, иначе сколько секунд ждать"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def pause(self, seconds):
+        """Не выдавать токены seconds секунд; накопленный запас сгорает"""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._paused_until:
+                self._paused_until = until
+                self.pauses += 1
+            self._tokens = 0.0
+            self._updated = self._paused_until
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'waits': self.waits,
+                'pauses': self.pauses,
+                'paused': max(0.0, self._paused_until - time.monotonic()),
+            }
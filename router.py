@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import deque
+
+
+class Route:
+    """Маршрут инлайн-кнопки: обработчик, типы аргументов, политика доступа и текст ответа на нажатие"""
+
+    __slots__ = ('pattern', 'handler', 'args', 'admin_only', 'subscription_exempt', 'ack',
+                 'calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, pattern, handler, args, admin_only, subscription_exempt, ack):
+        self.pattern = pattern
+        self.handler = handler
+        self.args = args
+        self.admin_only = admin_only
+        self.subscription_exempt = subscription_exempt
+        self.ack = ack
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def decode(self, tail):
+        """Разбирает хвост callback_data "a_b_c" в аргументы нужных типов.
+
+        Последний аргумент забирает остаток строки целиком, поэтому может содержать "_".
+        """
+        if not self.args:
+            if tail:
+                raise ValueError(f"Unexpected arguments for {self.pattern}: {tail}")
+            return ()
+        if len(self.args) == 1:
+            return (self.args[0](tail),)
+        parts = tail.split('_', len(self.args) - 1)
+        if len(parts) != len(self.args):
+            raise ValueError(f"Expected {len(self.args)} arguments for {self.pattern}: {tail}")
+        return tuple([arg_type(part) for arg_type, part in zip(self.args, parts)])
+
+
+class LatencyWindow:
+    """Последние size замеров времени для перцентилей"""
+
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentiles(self, *points):
+        """Перцентили в миллисекундах (None, если замеров нет), например percentiles(50, 99)"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return tuple(None for _ in points)
+        return tuple(samples[min(len(samples) - 1, int(len(samples) * point / 100))] * 1000 for point in points)
+
+
+class CallbackRouter:
+    """Таблица маршрутов callback_data.
+
+    Маршруты без аргументов ищутся в словаре по точному совпадению,
+    маршруты с аргументами - по самому длинному префиксу. Префиксы
+    заканчиваются на "_", поэтому проверяются только границы сегментов
+    callback_data (не глубже самого длинного префикса). Время поиска
+    не зависит от числа маршрутов.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = {}
+        self._max_segments = 0
+        self._lock = threading.Lock()
+        # От получения нажатия до ответа Telegram и до завершения обработчика
+        self.ack_latency = LatencyWindow()
+        self.done_latency = LatencyWindow()
+
+    def route(self, pattern, *args, admin_only=False, subscription_exempt=False, ack=None):
+        """Декоратор: регистрирует обработчик handler(call, *args).
+
+        Если указаны типы аргументов, pattern считается префиксом ("slot_"),
+        иначе - точным значением callback_data ("back_to_main").
+        ack - текст, который пользователь видит сразу после нажатия, пока работает обработчик.
+        """
+        def decorator(handler):
+            entry = Route(pattern, handler, args, admin_only, subscription_exempt, ack)
+            if args:
+                if not pattern.endswith('_'):
+                    raise ValueError(f"Route prefix must end with '_': {pattern}")
+                self._prefixes[pattern] = entry
+                self._max_segments = max(self._max_segments, pattern.count('_'))
+            else:
+                self._exact[pattern] = entry
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        """Возвращает (маршрут, аргументы) или None, если маршрут не найден или аргументы не разобрались"""
+        entry = self._exact.get(data)
+        if entry is not None:
+            return entry, ()
+
+        depth = 0
+        end = data.find('_')
+        for _ in range(self._max_segments):
+            if end == -1:
+                break
+            candidate = self._prefixes.get(data[:end + 1])
+            if candidate is not None:
+                entry, depth = candidate, end + 1
+            end = data.find('_', end + 1)
+        if entry is None:
+            return None
+        try:
+            return entry, entry.decode(data[depth:])
+        except ValueError:
+            return None
+
+    def call(self, entry, call, args):
+        """Вызывает обработчик маршрута и учитывает число вызовов и время"""
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = entry.handler(call, *args)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                entry.calls += 1
+                entry.errors += failed
+                entry.total_time += elapsed
+                entry.max_time = max(entry.max_time, elapsed)
+
+    def stats(self):
+        """Счетчики маршрутов, по которым были вызовы, от самых частых"""
+        with self._lock:
+            routes = list(self._exact.values()) + list(self._prefixes.values())
+            return sorted(
+                ({
+                    'pattern': entry.pattern,
+                    'calls': entry.calls,
+                    'errors': entry.errors,
+                    'avg_ms': entry.total_time / entry.calls * 1000,
+                    'max_ms': entry.max_time * 1000,
+                } for entry in routes if entry.calls),
+                key=lambda item: item['calls'],
+                reverse=True,
+            )
+
+    def latency(self):
+        """p50 и p99 (мс) времени до ответа на нажатие и до завершения обработки"""
+        return {
+            'ack': self.ack_latency.percentiles(50, 99),
+            'done': self.done_latency.percentiles(50, 99),
+        }
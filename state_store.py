@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from db import db_read, db_submit
+
+logger = logging.getLogger(__name__)
+
+
+def _write_states(cursor, states):
+    for user_id, value in states.items():
+        if value is None:
+            cursor.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
+        else:
+            cursor.execute('REPLACE INTO user_states (user_id, state, state_data) VALUES (?, ?, ?)',
+                           (user_id, value[0], value[1]))
+
+
+def _log_write_error(future):
+    if future.exception() is not None:
+        logger.error(f"Error writing user state: {future.exception()}")
+
+
+class StateStore:
+    """Кэш таблицы user_states в памяти.
+
+    Чтения обслуживаются из ограниченного LRU. При flush_interval = 0 каждое
+    изменение сразу ставится в очередь пишущего потока базы, не дожидаясь коммита
+    (write-through), иначе изменения копятся и сбрасываются одной записью раз в
+    flush_interval секунд (write-behind). Из LRU не вытесняются несброшенные записи
+    и записи, коммита которых еще ждут: иначе get() прочитал бы из базы старое состояние.
+    """
+
+    def __init__(self, maxsize, flush_interval=0):
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self._data = OrderedDict()  # user_id -> (state, state_data) или None
+        self._dirty = {}
+        self._in_flight = {}  # user_id -> число записей, отправленных в базу и еще не закоммиченных
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def get(self, user_id):
+        with self._lock:
+            if user_id in self._data:
+                self._data.move_to_end(user_id)
+                self.hits += 1
+                value = self._data[user_id]
+                return value if value else (None, None)
+            self.misses += 1
+
+        with db_read() as cursor:
+            cursor.execute('SELECT state, state_data FROM user_states WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+
+        with self._lock:
+            # Если пока читали, состояние успели изменить - оставляем новое
+            value = self._data.setdefault(user_id, tuple(row) if row else None)
+            self._evict()
+        return value if value else (None, None)
+
+    def set(self, user_id, state, state_data=None):
+        self._put(user_id, (state, state_data))
+
+    def clear(self, user_id):
+        self._put(user_id, None)
+
+    def _put(self, user_id, value):
+        with self._lock:
+            self._data[user_id] = value
+            self._data.move_to_end(user_id)
+            if self.flush_interval:
+                self._dirty[user_id] = value
+            else:
+                self._pin((user_id,))
+            self._evict()
+        if not self.flush_interval:
+            # Задания пишущего потока выполняются по порядку - последнее значение побеждает
+            future = db_submit(_write_states, {user_id: value})
+            future.add_done_callback(_log_write_error)
+            future.add_done_callback(lambda _: self._unpin((user_id,)))
+
+    def _pin(self, user_ids):
+        for user_id in user_ids:
+            self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+
+    def _unpin(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                if self._in_flight[user_id] == 1:
+                    del self._in_flight[user_id]
+                else:
+                    self._in_flight[user_id] -= 1
+            self._evict()
+
+    def _evict(self):
+        if len(self._data) <= self.maxsize:
+            return
+        for user_id in list(self._data):
+            if len(self._data) <= self.maxsize:
+                break
+            if user_id not in self._dirty and user_id not in self._in_flight:
+                del self._data[user_id]
+
+    def flush(self):
+        """Пишет накопленные изменения в user_states и ждет коммита"""
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+                self._pin(dirty)
+            if not dirty:
+                return
+            try:
+                db_submit(_write_states, dirty).result()
+            except Exception:
+                # Возвращаем в очередь то, что не успели перезаписать новыми значениями
+                with self._lock:
+                    for user_id, value in dirty.items():
+                        self._dirty.setdefault(user_id, value)
+                raise
+            finally:
+                self._unpin(dirty)
+            self.flushes += 1
+
+    def start(self):
+        if self.flush_interval and self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing user states: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'dirty': len(self._dirty),
+                'in_flight': len(self._in_flight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'flushes': self.flushes,
+            }
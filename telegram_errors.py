@@ -0,0 +1,44 @@
+from telebot.apihelper import ApiTelegramException
+
+# Пользователь заблокировал бота или удалил аккаунт - писать ему бесполезно
+BLOCKED = 'blocked'
+# Чат не найден: бот никогда не общался с пользователем или id неверный
+NOT_FOUND = 'not_found'
+# 429 Too Many Requests: повторить после retry_after
+RATE_LIMITED = 'rate_limited'
+
+UNDELIVERABLE = (BLOCKED, NOT_FOUND)
+
+_NOT_FOUND_MARKERS = ('chat not found', 'user not found', 'peer_id_invalid')
+# getChatMember: неизвестен сам пользователь (а не канал)
+_MEMBER_NOT_FOUND_MARKERS = ('user not found', 'participant_id_invalid')
+
+
+def classify_error(error):
+    """Тип ошибки отправки: BLOCKED, NOT_FOUND, RATE_LIMITED или None для прочих ошибок"""
+    if not isinstance(error, ApiTelegramException):
+        return None
+    if error.error_code == 429:
+        return RATE_LIMITED
+    if error.error_code == 403:
+        return BLOCKED
+    description = (error.description or '').lower()
+    if error.error_code == 400 and any(marker in description for marker in _NOT_FOUND_MARKERS):
+        return NOT_FOUND
+    return None
+
+
+def retry_after(error):
+    """Сколько секунд ждать по ответу 429 Too Many Requests (None - это не 429)"""
+    if classify_error(error) != RATE_LIMITED:
+        return None
+    parameters = (error.result_json or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+
+def member_not_found(error):
+    """getChatMember ответил, что такого пользователя нет (а не что недоступен канал)"""
+    if not isinstance(error, ApiTelegramException) or error.error_code != 400:
+        return False
+    description = (error.description or '').lower()
+    return any(marker in description for marker in _MEMBER_NOT_FOUND_MARKERS)
@@ -0,0 +1,47 @@
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# DB_PATH читается при импорте db, поэтому временная база задается до импорта bot
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='bot-tests-'), 'nft_market.db')
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+
+from telebot import apihelper
+
+
+class FakeResponse:
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, result):
+        self.text = json.dumps({'ok': True, 'result': result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def fake_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    """Bot API без сети: сообщения "отправляются", остальные методы возвращают True"""
+    name = url.rsplit('/', 1)[-1]
+    if name in ('sendMessage', 'sendPhoto', 'editMessageText'):
+        chat_id = int((params or {}).get('chat_id', 1))
+        return FakeResponse({'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': ''})
+    if name == 'getMe':
+        return FakeResponse({'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'bot'})
+    return FakeResponse(True)
+
+
+apihelper.CUSTOM_REQUEST_SENDER = fake_request_sender
+
+
+@pytest.fixture(scope='session')
+def bot_module():
+    import bot
+    bot.init_db()
+    return bot
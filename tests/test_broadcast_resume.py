@@ -0,0 +1,130 @@
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from db import db_read, db_write
+from ratelimit import TokenBucket
+
+USERS = range(750000, 750350)
+ADMIN_CHAT = 750999
+
+
+class Crash(BaseException):
+    """Падение процесса: не ловится ни отправкой, ни Broadcast.run"""
+
+
+@pytest.fixture
+def broadcast_env(bot_module, monkeypatch):
+    """Получатели рассылки, журнал отправок и рассылка без лимита скорости"""
+    with db_write() as cursor:
+        cursor.executemany('INSERT OR IGNORE INTO users (user_id, username, full_name) VALUES (?, ?, ?)',
+                           [(user_id, f'u{user_id}', f'User {user_id}') for user_id in USERS])
+    monkeypatch.setattr(bot_module, 'broadcast_limiter', TokenBucket(1e6, 1e6))
+    sent = []
+    lock = threading.Lock()
+
+    def send(user_id, text):
+        with lock:
+            sent.append(user_id)
+    monkeypatch.setattr(bot_module, 'send_broadcast_message', send)
+    return sent
+
+
+def recipients():
+    """Кого должна обойти рассылка - тот же отбор, что в broadcast_recipients"""
+    with db_read() as cursor:
+        cursor.execute("SELECT user_id FROM users WHERE delivery_status = 'ok' AND is_banned = FALSE ORDER BY user_id")
+        return [row[0] for row in cursor.fetchall()]
+
+
+def create_job(total):
+    with db_write() as cursor:
+        cursor.execute('INSERT INTO broadcast_jobs (admin_id, chat_id, status_message_id, text, total) VALUES (?, ?, ?, ?, ?)',
+                       (ADMIN_CHAT, ADMIN_CHAT, 1, 'hello', total))
+        return cursor.lastrowid
+
+
+def job_row(job_id):
+    with db_read() as cursor:
+        cursor.execute('SELECT status, last_user_id, delivered, failed FROM broadcast_jobs WHERE job_id = ?', (job_id,))
+        return cursor.fetchone()
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def crash_at(bot_module, monkeypatch, job_id, crash_user_id, sent):
+    """Запускает рассылку и "убивает процесс" на отправке crash_user_id.
+
+    После падения не отправляется ничего, а итог не сохраняется (finally
+    мертвого процесса не выполняется) - в базе остается последняя контрольная
+    точка. active_broadcasts очищается, как после перезапуска.
+    """
+    crashed = threading.Event()
+    exited = threading.Event()
+    deliver = bot_module.send_broadcast_message
+
+    def send(user_id, text):
+        if user_id == crash_user_id:
+            crashed.set()
+        if crashed.is_set():
+            raise Crash()
+        deliver(user_id, text)
+    with monkeypatch.context() as patch:
+        patch.setattr(bot_module, 'send_broadcast_message', send)
+        patch.setattr(bot_module, 'finish_broadcast_job', lambda job_id, broadcast: None)
+        # Поток рассылки завершается этим исключением
+        patch.setattr(threading, 'excepthook', lambda args: exited.set())
+        assert bot_module.start_broadcast_job(job_id)
+        wait_for(exited.is_set)
+    assert crashed.is_set()
+    bot_module.active_broadcasts.pop(job_id)
+    assert crash_user_id not in sent
+
+
+def resume(bot_module, job_id):
+    bot_module.resume_broadcast_jobs()
+    wait_for(lambda: job_id not in bot_module.active_broadcasts)
+
+
+def test_resume_after_checkpoint_sends_everyone_once(bot_module, broadcast_env, monkeypatch):
+    sent = broadcast_env
+    # Один поток: падение ровно на первом получателе третьей пачки
+    monkeypatch.setattr(bot_module, 'BROADCAST_WORKERS', 1)
+    expected = recipients()
+    batch = bot_module.BROADCAST_BATCH_SIZE
+    assert len(expected) > 3 * batch
+    job_id = create_job(len(expected))
+
+    crash_at(bot_module, monkeypatch, job_id, expected[2 * batch], sent)
+    assert sent == expected[:2 * batch]
+    assert job_row(job_id) == ('running', expected[2 * batch - 1], 2 * batch, 0)
+
+    resume(bot_module, job_id)
+    assert sent == expected
+    assert job_row(job_id) == ('completed', expected[-1], len(expected), 0)
+
+
+def test_resume_after_crash_mid_batch_skips_nobody(bot_module, broadcast_env, monkeypatch):
+    sent = broadcast_env
+    expected = recipients()
+    batch = bot_module.BROADCAST_BATCH_SIZE
+    job_id = create_job(len(expected))
+
+    crash_at(bot_module, monkeypatch, job_id, expected[batch + batch // 2], sent)
+    assert job_row(job_id) == ('running', expected[batch - 1], batch, 0)
+
+    resume(bot_module, job_id)
+    counts = Counter(sent)
+    assert set(counts) == set(expected)
+    # Повторно получают только те, кому успели отправить из пачки, на которой упали
+    resent = {user_id for user_id, count in counts.items() if count > 1}
+    assert resent and resent <= set(expected[batch:2 * batch])
+    assert max(counts.values()) <= 2
+    assert job_row(job_id) == ('completed', expected[-1], len(expected), 0)
@@ -0,0 +1,111 @@
+import time
+
+from telebot import types
+
+import ledger
+from db import db_read, db_submit, db_write
+
+PRICE = 1000
+
+
+def create_deals(bot_module, user_base, count):
+    """Продавец, count покупателей и по сделке у каждого (NFT еще не отправлен)"""
+    seller_id = user_base
+    buyer_ids = list(range(user_base + 1, user_base + 1 + count))
+    slot_ids = []
+    with db_write() as cursor:
+        for user_id in [seller_id] + buyer_ids:
+            cursor.execute('INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?)',
+                           (user_id, f'u{user_id}', f'User {user_id}'))
+        for index, user_id in enumerate(buyer_ids):
+            ledger.transfer(cursor, ledger.DEPOSITS, user_id, PRICE, 'admin_add', 'test deposit')
+            cursor.execute('INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info) VALUES (?, ?, ?, ?, ?)',
+                           (seller_id, 'photo', f'NFT {index}', PRICE, '@seller'))
+            slot_ids.append(cursor.lastrowid)
+    purchase_ids = []
+    for slot_id, user_id in zip(slot_ids, buyer_ids):
+        error, deal = db_submit(bot_module.purchase_slot, slot_id, user_id).result()
+        assert error is None
+        with db_read() as cursor:
+            cursor.execute('SELECT purchase_id FROM purchases WHERE slot_id = ? AND status = "pending"', (slot_id,))
+            purchase_ids.append(cursor.fetchone()[0])
+    return seller_id, buyer_ids, slot_ids, purchase_ids
+
+
+def backdate(purchase_id, created_hours, sent_hours=None):
+    with db_write() as cursor:
+        cursor.execute("UPDATE purchases SET created_at = datetime('now', ?) WHERE purchase_id = ?",
+                       (f'-{created_hours} hours', purchase_id))
+        if sent_hours is not None:
+            cursor.execute("UPDATE purchases SET nft_sent = TRUE, sent_at = datetime('now', ?) WHERE purchase_id = ?",
+                           (f'-{sent_hours} hours', purchase_id))
+
+
+def balances(user_ids):
+    with db_read() as cursor:
+        cursor.execute(f'SELECT user_id, balance FROM users WHERE user_id IN ({", ".join("?" * len(user_ids))})', user_ids)
+        cached = dict(cursor.fetchall())
+        journal = {user_id: ledger.balance_at(cursor, user_id) for user_id in user_ids}
+    for user_id in user_ids:
+        assert abs(cached[user_id] - journal[user_id]) < ledger.TOLERANCE
+    return cached
+
+
+def test_sweeper_cancels_unsent_and_completes_unconfirmed(bot_module):
+    send_timeout = bot_module.ESCROW_SEND_TIMEOUT_HOURS
+    confirm_timeout = bot_module.ESCROW_CONFIRM_TIMEOUT_HOURS
+    seller_id, buyer_ids, slot_ids, purchase_ids = create_deals(bot_module, 720000, 5)
+    unsent, unconfirmed, sent_recently, fresh, orphaned = purchase_ids
+
+    backdate(unsent, send_timeout + 1)
+    backdate(unconfirmed, send_timeout + confirm_timeout + 2, confirm_timeout + 1)
+    # Срок подтверждения считается от отправки, а не от покупки
+    backdate(sent_recently, send_timeout + confirm_timeout + 2, 1)
+    backdate(orphaned, send_timeout + 1)
+    # Слот удален, пока шла сделка (старые базы): сделка все равно должна закрыться
+    with db_write() as cursor:
+        cursor.execute('DELETE FROM slots WHERE slot_id = ?', (slot_ids[4],))
+
+    assert bot_module.sweep_expired_purchases() == (2, 1)
+    assert bot_module.sweep_expired_purchases() == (0, 0)
+
+    with db_read() as cursor:
+        cursor.execute(f'SELECT purchase_id, status FROM purchases WHERE purchase_id IN ({", ".join("?" * 5)})', purchase_ids)
+        statuses = dict(cursor.fetchall())
+        cursor.execute('SELECT is_active FROM slots WHERE slot_id = ?', (slot_ids[0],))
+        relisted = cursor.fetchone()[0]
+    assert statuses == {unconfirmed: 'completed', sent_recently: 'pending', fresh: 'pending'}
+    assert relisted
+
+    after = balances([seller_id] + buyer_ids)
+    assert after[buyer_ids[0]] == PRICE
+    assert after[buyer_ids[4]] == PRICE
+    assert after[buyer_ids[1]] == after[buyer_ids[2]] == after[buyer_ids[3]] == 0
+    assert after[seller_id] == PRICE
+
+    audit = db_submit(ledger.snapshot).result()
+    assert audit['mismatches'] == []
+    assert abs(audit['imbalance']) < ledger.TOLERANCE
+
+
+def test_seller_cannot_delete_slot_with_pending_deal(bot_module):
+    seller_id, buyer_ids, slot_ids, purchase_ids = create_deals(bot_module, 730000, 1)
+    call = types.CallbackQuery.de_json({
+        'id': '1', 'chat_instance': 'test', 'data': f'delete_{slot_ids[0]}',
+        'from': {'id': seller_id, 'is_bot': False, 'first_name': 'U'},
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': seller_id, 'type': 'private'}, 'text': ''},
+    })
+    call.received = time.perf_counter()
+
+    bot_module.delete_slot(call, slot_ids[0])
+    with db_read() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM slots WHERE slot_id = ?', (slot_ids[0],))
+        assert cursor.fetchone()[0] == 1
+
+    # После отмены сделки слот удаляется
+    backdate(purchase_ids[0], bot_module.ESCROW_SEND_TIMEOUT_HOURS + 1)
+    assert bot_module.sweep_expired_purchases() == (1, 0)
+    bot_module.delete_slot(call, slot_ids[0])
+    with db_read() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM slots WHERE slot_id = ?', (slot_ids[0],))
+        assert cursor.fetchone()[0] == 0
@@ -0,0 +1,127 @@
+import sqlite3
+
+import pytest
+
+import ledger
+
+
+@pytest.fixture
+def cursor():
+    """База до перехода на журнал: балансы, сделки и заявки на вывод"""
+    connection = sqlite3.connect(':memory:', isolation_level=None)
+    cursor = connection.cursor()
+    cursor.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, balance REAL DEFAULT 0)')
+    cursor.execute('CREATE TABLE purchases (purchase_id INTEGER PRIMARY KEY, amount REAL, status TEXT)')
+    cursor.execute('CREATE TABLE withdraw_requests (withdraw_id INTEGER PRIMARY KEY, amount REAL, status TEXT)')
+    yield cursor
+    connection.close()
+
+
+def journal_at(cursor, created_at, legs):
+    """Проводка с заданным временем (transfer пишет текущее)"""
+    cursor.execute('INSERT INTO ledger_txns (kind, description, created_at) VALUES (?, ?, ?)', ('test', 'test', created_at))
+    txn_id = cursor.lastrowid
+    cursor.executemany('INSERT INTO ledger (txn_id, account_id, amount, created_at) VALUES (?, ?, ?, ?)',
+                       [(txn_id, account, amount, created_at) for account, amount in legs])
+
+
+def snapshot_at(cursor, created_at):
+    result = ledger.snapshot(cursor)
+    cursor.execute('UPDATE ledger_snapshots SET created_at = ? WHERE created_at > ?', (created_at, created_at))
+    return result
+
+
+def test_open_balances_migrates_existing_database(cursor):
+    cursor.executemany('INSERT INTO users (user_id, balance) VALUES (?, ?)', [(1, 150.0), (2, 0.0), (3, 42.5)])
+    cursor.executemany('INSERT INTO purchases (amount, status) VALUES (?, ?)',
+                       [(100.0, 'pending'), (30.0, 'pending'), (500.0, 'completed')])
+    cursor.executemany('INSERT INTO withdraw_requests (amount, status) VALUES (?, ?)',
+                       [(70.0, 'pending'), (20.0, 'approved')])
+
+    ledger.create_schema(cursor)
+
+    assert ledger.balance_at(cursor, 1) == 150.0
+    assert ledger.balance_at(cursor, 2) == 0.0
+    assert ledger.balance_at(cursor, 3) == 42.5
+    assert ledger.balance_at(cursor, ledger.ESCROW) == 130.0
+    assert ledger.balance_at(cursor, ledger.WITHDRAWALS) == 70.0
+    assert ledger.balance_at(cursor, ledger.OPENING) == -(150.0 + 42.5 + 130.0 + 70.0)
+    # Проекция не меняется: users.balance уже содержит эти суммы
+    cursor.execute('SELECT user_id, balance FROM users ORDER BY user_id')
+    assert cursor.fetchall() == [(1, 150.0), (2, 0.0), (3, 42.5)]
+    cursor.execute('SELECT COUNT(*) FROM ledger_txns')
+    assert cursor.fetchone()[0] == 1
+
+    # Повторный запуск не открывает остатки второй раз
+    ledger.create_schema(cursor)
+    cursor.execute('SELECT COUNT(*) FROM ledger_txns')
+    assert cursor.fetchone()[0] == 1
+    audit = ledger.snapshot(cursor)
+    assert audit['mismatches'] == []
+    assert audit['imbalance'] == 0
+
+
+def test_open_balances_on_empty_database(cursor):
+    ledger.create_schema(cursor)
+    cursor.execute('SELECT COUNT(*) FROM ledger')
+    assert cursor.fetchone()[0] == 0
+
+
+def test_balance_at_uses_past_snapshots(cursor):
+    ledger.create_schema(cursor)
+    cursor.execute('INSERT INTO users (user_id, balance) VALUES (1, 0)')
+
+    journal_at(cursor, '2026-01-01 10:00:00', [(ledger.DEPOSITS, -100.0), (1, 100.0)])
+    snapshot_at(cursor, '2026-01-01 12:00:00')
+    journal_at(cursor, '2026-01-02 10:00:00', [(1, -30.0), (ledger.ESCROW, 30.0)])
+    snapshot_at(cursor, '2026-01-02 12:00:00')
+    journal_at(cursor, '2026-01-03 10:00:00', [(ledger.DEPOSITS, -20.0), (1, 20.0)])
+
+    assert ledger.balance_at(cursor, 1, '2025-12-31 00:00:00') == 0
+    assert ledger.balance_at(cursor, 1, '2026-01-01 11:00:00') == 100.0
+    assert ledger.balance_at(cursor, 1, '2026-01-01 23:59:59') == 100.0
+    assert ledger.balance_at(cursor, 1, '2026-01-02 11:00:00') == 70.0
+    assert ledger.balance_at(cursor, 1, '2026-01-02 13:00:00') == 70.0
+    assert ledger.balance_at(cursor, 1, '2026-01-03 12:00:00') == 90.0
+    assert ledger.balance_at(cursor, 1) == 90.0
+    assert ledger.balance_at(cursor, ledger.ESCROW, '2026-01-02 13:00:00') == 30.0
+
+    # Баланс на момент берется из последнего снимка до него, а не суммой всего журнала
+    cursor.execute("UPDATE ledger_snapshots SET balance = balance + 1000 WHERE account_id = 1 AND created_at = '2026-01-01 12:00:00'")
+    assert ledger.balance_at(cursor, 1, '2026-01-01 23:59:59') == 1100.0
+    assert ledger.balance_at(cursor, 1, '2026-01-01 11:00:00') == 100.0
+
+
+def test_transfer_checks_funds(cursor):
+    ledger.create_schema(cursor)
+    cursor.execute('INSERT INTO users (user_id, balance) VALUES (1, 0)')
+    ledger.transfer(cursor, ledger.DEPOSITS, 1, 50.0, 'admin_add', 'deposit')
+
+    assert ledger.transfer(cursor, 1, ledger.ESCROW, 80.0, 'purchase', 'too much', check_funds=True) is None
+    assert ledger.transfer(cursor, 1, ledger.ESCROW, 50.0, 'purchase', 'all in', check_funds=True) is not None
+    cursor.execute('SELECT balance FROM users WHERE user_id = 1')
+    assert cursor.fetchone()[0] == 0
+    assert ledger.balance_at(cursor, 1) == 0
+    assert ledger.balance_at(cursor, ledger.ESCROW) == 50.0
+
+    with pytest.raises(ValueError):
+        ledger.transfer(cursor, ledger.DEPOSITS, 1, 0, 'admin_add', 'zero')
+    with pytest.raises(ValueError):
+        ledger.transfer(cursor, ledger.DEPOSITS, 999, 10.0, 'admin_add', 'unknown user')
+
+
+@pytest.mark.parametrize('statement', [
+    'UPDATE ledger SET amount = amount + 1',
+    'DELETE FROM ledger',
+    "UPDATE ledger_txns SET description = 'edited'",
+    'DELETE FROM ledger_txns',
+])
+def test_ledger_is_append_only(cursor, statement):
+    ledger.create_schema(cursor)
+    cursor.execute('INSERT INTO users (user_id, balance) VALUES (1, 0)')
+    ledger.transfer(cursor, ledger.DEPOSITS, 1, 10.0, 'admin_add', 'deposit')
+
+    with pytest.raises(sqlite3.DatabaseError, match='append-only'):
+        cursor.execute(statement)
+    cursor.execute('SELECT COUNT(*), SUM(amount) FROM ledger')
+    assert cursor.fetchone() == (2, 0.0)
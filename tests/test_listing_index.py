@@ -0,0 +1,115 @@
+import pytest
+
+from db import db_read, db_write
+from listing_index import ListingIndex
+
+SORTS = ['n', 'p', 'r']
+BANDS = range(5)
+# Цены на границах диапазонов и повторы: порядок внутри одной цены решает slot_id
+PRICES = [100, 499, 500, 500, 1999, 2000, 2000, 9999, 10000, 50000, 250, 750]
+RATINGS = [0, 4.5, 4.5, 3.0, 5.0]
+
+
+@pytest.fixture(scope='module')
+def market(bot_module):
+    """Пять продавцов с разными (и совпадающими) рейтингами и по 12 слотов у каждого"""
+    seller_ids = list(range(740000, 740000 + len(RATINGS)))
+    with db_write() as cursor:
+        for seller_id, rating in zip(seller_ids, RATINGS):
+            cursor.execute('INSERT INTO users (user_id, username, full_name, rating_seller) VALUES (?, ?, ?, ?)',
+                           (seller_id, f'u{seller_id}', f'User {seller_id}', rating))
+        for index in range(len(PRICES) * len(seller_ids)):
+            cursor.execute('INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info) VALUES (?, ?, ?, ?, ?)',
+                           (seller_ids[index % len(seller_ids)], 'photo', f'NFT {index}', PRICES[index % len(PRICES)], '@seller'))
+    return seller_ids
+
+
+@pytest.fixture
+def sql_pages(bot_module, monkeypatch):
+    """get_slots_page без индекса в памяти - страницы из build_slots_page_query"""
+    monkeypatch.setattr(bot_module.listing_index, 'loaded', False)
+
+    def page(viewer_id, sort, band, after=None, before=None):
+        return bot_module.get_slots_page(viewer_id, sort, band, after, before)
+    return page
+
+
+def make_index(bot_module):
+    index = ListingIndex(bot_module.listing_index.sorts, bot_module.listing_index.bands)
+    index.load()
+    return index
+
+
+def walk(page):
+    """Все страницы вперед от первой, затем назад от последней"""
+    forward = [page(None, None)]
+    while forward[-1][2] is not None:
+        forward.append(page(forward[-1][2], None))
+    backward = []
+    current = forward[-1]
+    while current[1] is not None:
+        current = page(None, current[1])
+        backward.append(current)
+    return forward, backward
+
+
+def expected_slot_ids(bot_module, viewer_id, band):
+    low, high, _ = bot_module.PRICE_BANDS[band]
+    with db_read() as cursor:
+        cursor.execute('''
+            SELECT slot_id FROM slots
+            WHERE is_active = TRUE AND seller_id != ?
+            AND (? IS NULL OR price_rub >= ?) AND (? IS NULL OR price_rub < ?)
+        ''', (viewer_id, low, low, high, high))
+        return {row[0] for row in cursor.fetchall()}
+
+
+def assert_index_matches_sql(bot_module, index, sql_pages, viewer_id):
+    for sort in SORTS:
+        for band in BANDS:
+            def index_page(after, before):
+                return index.page(viewer_id, sort, band, bot_module.SLOTS_PAGE_SIZE, after, before)
+
+            def sql_page(after, before):
+                return sql_pages(viewer_id, sort, band, after, before)
+
+            forward, backward = walk(index_page)
+            assert (forward, backward) == walk(sql_page), (sort, band)
+            # Назад - те же страницы с теми же курсорами
+            assert backward == forward[-2::-1], (sort, band)
+            listed = [slot[0] for page in forward for slot in page[0]]
+            assert len(listed) == len(set(listed))
+            assert set(listed) == expected_slot_ids(bot_module, viewer_id, band), (sort, band)
+
+
+def test_index_pages_match_sql(bot_module, market, sql_pages):
+    index = make_index(bot_module)
+    # Зритель - один из продавцов: его слоты не попадают ни в одну страницу
+    assert_index_matches_sql(bot_module, index, sql_pages, market[1])
+    assert_index_matches_sql(bot_module, index, sql_pages, 1)
+
+
+def test_check_is_clean_after_refresh(bot_module, market, sql_pages):
+    index = make_index(bot_module)
+    assert index.check() == (0, 0, 0)
+
+    seller_id = market[2]
+    with db_write() as cursor:
+        cursor.execute('SELECT slot_id FROM slots WHERE seller_id = ? AND is_active = TRUE ORDER BY slot_id LIMIT 2',
+                       (market[0],))
+        repriced, sold = [row[0] for row in cursor.fetchall()]
+        # Слот переезжает в другой ценовой диапазон, другой снимается с продажи, появляется новый
+        cursor.execute('UPDATE slots SET price_rub = 15000 WHERE slot_id = ?', (repriced,))
+        cursor.execute('UPDATE slots SET is_active = FALSE WHERE slot_id = ?', (sold,))
+        cursor.execute('INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info) VALUES (?, ?, ?, ?, ?)',
+                       (market[0], 'photo', 'NFT new', 700, '@seller'))
+        added = cursor.lastrowid
+        # Рейтинг продавца копируется триггером во все его слоты
+        cursor.execute('UPDATE users SET rating_seller = 1.5, username = ? WHERE user_id = ?', ('renamed', seller_id))
+    assert index.check() != (0, 0, 0)
+
+    index.refresh(repriced, sold, added)
+    assert index.check()[:2] == (0, 0)
+    index.refresh_seller(seller_id)
+    assert index.check() == (0, 0, 0)
+    assert_index_matches_sql(bot_module, index, sql_pages, market[1])
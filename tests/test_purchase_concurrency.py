@@ -0,0 +1,100 @@
+import threading
+
+import ledger
+from db import db_read, db_submit, db_write
+
+PRICE = 1000
+SLOTS = 20
+BUYERS = 40
+TAPS = 2
+
+
+def create_market(user_base):
+    """Продавец, SLOTS слотов и BUYERS покупателей: у первой половины денег ровно на один слот"""
+    seller_id = user_base
+    buyer_ids = list(range(user_base + 1, user_base + 1 + BUYERS))
+    with db_write() as cursor:
+        for user_id in [seller_id] + buyer_ids:
+            cursor.execute('INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?)',
+                           (user_id, f'u{user_id}', f'User {user_id}'))
+        for index, user_id in enumerate(buyer_ids):
+            amount = PRICE if index < BUYERS // 2 else PRICE * SLOTS
+            ledger.transfer(cursor, ledger.DEPOSITS, user_id, amount, 'admin_add', 'test deposit')
+        slot_ids = []
+        for index in range(SLOTS):
+            cursor.execute('INSERT INTO slots (seller_id, nft_photo, description, price_rub, contact_info) VALUES (?, ?, ?, ?, ?)',
+                           (seller_id, 'photo', f'NFT {index}', PRICE, '@seller'))
+            slot_ids.append(cursor.lastrowid)
+    return seller_id, buyer_ids, slot_ids
+
+
+def test_concurrent_buyers_never_double_sell(bot_module):
+    seller_id, buyer_ids, slot_ids = create_market(700000)
+    with db_read() as cursor:
+        deposited = {user_id: ledger.balance_at(cursor, user_id) for user_id in buyer_ids}
+
+    # Каждый покупатель "нажимает" TAPS раз параллельно, проходя слоты в разном порядке
+    barrier = threading.Barrier(BUYERS * TAPS)
+    errors = []
+
+    def buyer(user_id, order):
+        barrier.wait()
+        for slot_id in order:
+            try:
+                db_submit(bot_module.purchase_slot, slot_id, user_id).result()
+            except Exception as e:
+                errors.append(e)
+
+    threads = []
+    for index, user_id in enumerate(buyer_ids):
+        shift = index % SLOTS
+        threads.append(threading.Thread(target=buyer, args=(user_id, slot_ids[shift:] + slot_ids[:shift])))
+        threads.append(threading.Thread(target=buyer, args=(user_id, slot_ids[::-1])))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    placeholders = ', '.join('?' * len(slot_ids))
+    buyers = ', '.join('?' * len(buyer_ids))
+    with db_read() as cursor:
+        cursor.execute(f'SELECT slot_id, COUNT(*) FROM purchases WHERE slot_id IN ({placeholders}) GROUP BY slot_id', slot_ids)
+        sold = dict(cursor.fetchall())
+        cursor.execute(f'SELECT COUNT(*) FROM slots WHERE slot_id IN ({placeholders}) AND is_active = TRUE', slot_ids)
+        active = cursor.fetchone()[0]
+        cursor.execute(f'SELECT user_id, balance FROM users WHERE user_id IN ({buyers})', buyer_ids)
+        balances = dict(cursor.fetchall())
+        cursor.execute(f'SELECT buyer_id, SUM(amount) FROM purchases WHERE buyer_id IN ({buyers}) GROUP BY buyer_id', buyer_ids)
+        spent = dict(cursor.fetchall())
+        ledger_balances = {user_id: ledger.balance_at(cursor, user_id) for user_id in buyer_ids}
+        cursor.execute('SELECT COUNT(*) FROM (SELECT txn_id FROM ledger GROUP BY txn_id HAVING ABS(SUM(amount)) > 0.005)')
+        unbalanced = cursor.fetchone()[0]
+
+    # Каждый слот продан ровно один раз
+    assert sold == {slot_id: 1 for slot_id in slot_ids}
+    assert active == 0
+    # Никто не ушел в минус, деньги списаны ровно за купленное
+    for user_id in buyer_ids:
+        assert balances[user_id] >= 0
+        assert balances[user_id] == deposited[user_id] - spent.get(user_id, 0)
+        assert abs(ledger_balances[user_id] - balances[user_id]) < ledger.TOLERANCE
+    assert unbalanced == 0
+
+    audit = db_submit(ledger.snapshot).result()
+    assert audit['mismatches'] == []
+    assert abs(audit['imbalance']) < ledger.TOLERANCE
+
+
+def test_buyer_cannot_buy_own_or_sold_slot(bot_module):
+    seller_id, buyer_ids, slot_ids = create_market(710000)
+    slot_id = slot_ids[0]
+
+    error, deal = db_submit(bot_module.purchase_slot, slot_id, seller_id).result()
+    assert deal is None and error
+
+    error, deal = db_submit(bot_module.purchase_slot, slot_id, buyer_ids[0]).result()
+    assert error is None and deal[1] == PRICE
+
+    error, deal = db_submit(bot_module.purchase_slot, slot_id, buyer_ids[-1]).result()
+    assert deal is None and error
@@ -0,0 +1,122 @@
+import pytest
+from telebot import types
+
+from router import CallbackRouter
+
+
+def handler(name):
+    def handle(call, *args):
+        return name, args
+    handle.__name__ = name
+    return handle
+
+
+@pytest.fixture
+def router():
+    router = CallbackRouter()
+    router.route("back_to_main")(handler('back_to_main'))
+    router.route("buy_", int)(handler('buy'))
+    router.route("buy_nft_", int, str)(handler('buy_nft'))
+    router.route("slot_", int)(handler('slot'))
+    router.route("slots_next_", str, int, str)(handler('slots_next'))
+    router.route("tag_", str)(handler('tag'))
+    router.route("price_", float)(handler('price'))
+    return router
+
+
+def resolved(router, data):
+    result = router.resolve(data)
+    if result is None:
+        return None
+    entry, args = result
+    return entry.pattern, args
+
+
+def test_exact_match(router):
+    assert resolved(router, 'back_to_main') == ('back_to_main', ())
+    # Точный маршрут не принимает хвост и не совпадает по префиксу
+    assert resolved(router, 'back_to_main_1') is None
+    assert resolved(router, 'back_to') is None
+    assert resolved(router, 'back_to_mainx') is None
+
+
+def test_prefix_match(router):
+    assert resolved(router, 'buy_42') == ('buy_', (42,))
+    assert resolved(router, 'slot_7') == ('slot_', (7,))
+    assert resolved(router, 'tag_') == ('tag_', ('',))
+    assert resolved(router, 'price_99.5') == ('price_', (99.5,))
+
+
+def test_longest_prefix_wins(router):
+    assert resolved(router, 'buy_nft_5_gift') == ('buy_nft_', (5, 'gift'))
+    # buy_nft_ не подходит по аргументам - более короткий buy_ не подставляется
+    assert resolved(router, 'buy_nft_x_gift') is None
+    assert resolved(router, 'buy_nft') is None
+    # Совпадение только на границе сегмента: slots_ не превращается в slot_ + "s..."
+    assert resolved(router, 'slots_next_p_2_abc') == ('slots_next_', ('p', 2, 'abc'))
+    assert resolved(router, 'slots_7') is None
+
+
+def test_last_argument_keeps_underscores(router):
+    assert resolved(router, 'slots_next_p_2_100_15') == ('slots_next_', ('p', 2, '100_15'))
+    assert resolved(router, 'buy_nft_5_gift_with_bow') == ('buy_nft_', (5, 'gift_with_bow'))
+    assert resolved(router, 'tag_a_b') == ('tag_', ('a_b',))
+
+
+@pytest.mark.parametrize('data', [
+    'buy_', 'buy_abc', 'buy_1.5', 'buy_-', 'slot_', 'slot_7x',
+    'slots_next_p_x_abc', 'slots_next_p_2', 'price_cheap',
+])
+def test_bad_arguments_do_not_resolve(router, data):
+    assert router.resolve(data) is None
+
+
+@pytest.mark.parametrize('data', ['', '_', 'unknown', 'unknown_1', 'buy', 'BUY_1', 'x_buy_1'])
+def test_unknown_data_does_not_resolve(router, data):
+    assert router.resolve(data) is None
+
+
+def test_prefix_must_end_with_underscore():
+    router = CallbackRouter()
+    with pytest.raises(ValueError):
+        router.route("buy", int)(handler('buy'))
+
+
+def test_call_counts_calls_and_errors(router):
+    entry, args = router.resolve('buy_nft_5_gift')
+    assert router.call(entry, None, args) == ('buy_nft', (5, 'gift'))
+
+    def broken(call):
+        raise RuntimeError('boom')
+    router.route("broken")(broken)
+    entry, args = router.resolve('broken')
+    with pytest.raises(RuntimeError):
+        router.call(entry, None, args)
+
+    stats = {item['pattern']: item for item in router.stats()}
+    assert set(stats) == {'buy_nft_', 'broken'}
+    assert (stats['buy_nft_']['calls'], stats['buy_nft_']['errors']) == (1, 0)
+    assert (stats['broken']['calls'], stats['broken']['errors']) == (1, 1)
+
+
+def test_bot_routes(bot_module):
+    router = bot_module.router
+    assert resolved(router, 'slot_12')[0] == 'slot_'
+    assert resolved(router, 'slots_view_p_2')[1] == ('p', 2)
+    assert resolved(router, 'slots_next_n_0_1700000000_15')[1] == ('n', 0, '1700000000_15')
+    assert resolved(router, 'rating_12_seller_5')[1] == (12, 'seller', 5)
+    assert resolved(router, 'broadcast_pause_3')[0] == 'broadcast_pause_'
+
+
+def test_unknown_callback_is_answered(bot_module, monkeypatch):
+    answers = []
+    monkeypatch.setattr(bot_module.bot, 'answer_callback_query',
+                        lambda callback_query_id, text=None, *args, **kwargs: answers.append((callback_query_id, text)))
+    for data in ('no_such_button', 'slot_abc'):
+        call = types.CallbackQuery.de_json({
+            'id': data, 'chat_instance': 'test', 'data': data,
+            'from': {'id': 760000, 'is_bot': False, 'first_name': 'U'},
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': 760000, 'type': 'private'}, 'text': ''},
+        })
+        bot_module.handle_callback(call)
+    assert answers == [('no_such_button', "❌ Неизвестная команда"), ('slot_abc', "❌ Неизвестная команда")]
@@ -0,0 +1,38 @@
+import pytest
+
+from db import db_read
+
+PAGES = ['first', 'next', 'prev']
+
+
+def explain(query, params):
+    with db_read() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {query}', params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+@pytest.mark.parametrize('page', PAGES)
+@pytest.mark.parametrize('band', range(5))
+@pytest.mark.parametrize('sort', ['n', 'p', 'r'])
+def test_slots_page_uses_sort_index(bot_module, sort, band, page):
+    assert len(bot_module.PRICE_BANDS) == 5
+    key, index = bot_module.SLOT_SORTS[sort][1], bot_module.SLOT_SORTS[sort][3]
+    cursor_value = ':'.join(['100'] * len(key))
+    after = cursor_value if page == 'next' else None
+    before = cursor_value if page == 'prev' else None
+
+    query, params = bot_module.build_slots_page_query(123, sort, band, after, before)
+    plan = explain(query, params)
+
+    # Слоты читаются по индексу сортировки (SCAN по индексу - обход в порядке ORDER BY до LIMIT),
+    # без полного просмотра таблицы и без сортировки во временном B-дереве
+    assert len(plan) == 1, plan
+    assert plan[0].split(' (')[0] in (f'SEARCH s USING INDEX {index}', f'SCAN s USING INDEX {index}'), plan
+    assert not any('TEMP B-TREE' in step for step in plan), plan
+
+
+def test_sort_indexes_exist(bot_module):
+    with db_read() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'slots'")
+        indexes = {row[0] for row in cursor.fetchall()}
+    assert {sort[3] for sort in bot_module.SLOT_SORTS.values()} <= indexes
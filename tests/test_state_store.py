@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from db import db_flush, db_submit
+from state_store import StateStore
+
+
+@pytest.fixture
+def stalled_writer(bot_module):
+    """Держит пишущий поток базы занятым, пока тест не отпустит событие"""
+    release = threading.Event()
+    started = threading.Event()
+
+    def stall(cursor):
+        started.set()
+        release.wait(10)
+
+    db_submit(stall)
+    started.wait(10)
+    yield release
+    release.set()
+    db_flush()
+
+
+def test_write_through_keeps_uncommitted_states(stalled_writer):
+    store = StateStore(maxsize=2)
+    for user_id in range(700001, 700011):
+        store.set(user_id, 'waiting_amount', str(user_id))
+
+    # Ни одна запись еще не закоммичена - вытеснять нечего, иначе get() прочитает пустую базу
+    assert store.stats()['in_flight'] == 10
+    for user_id in range(700001, 700011):
+        assert store.get(user_id) == ('waiting_amount', str(user_id))
+
+    stalled_writer.set()
+    db_flush()
+    stats = store.stats()
+    assert stats['in_flight'] == 0
+    assert stats['size'] <= 2
+    for user_id in range(700001, 700011):
+        assert store.get(user_id) == ('waiting_amount', str(user_id))
+
+
+def test_write_behind_keeps_states_until_flush_commits(stalled_writer):
+    store = StateStore(maxsize=2, flush_interval=60)
+    for user_id in range(700101, 700106):
+        store.set(user_id, 'waiting_card', str(user_id))
+
+    flusher = threading.Thread(target=store.flush)
+    flusher.start()
+    while store.stats()['dirty']:
+        pass
+    # flush уже забрал изменения, но коммита еще не было; новые записи вытесняют старые
+    for user_id in range(700201, 700206):
+        store.set(user_id, 'waiting_card', str(user_id))
+    for user_id in range(700101, 700106):
+        assert store.get(user_id) == ('waiting_card', str(user_id))
+
+    stalled_writer.set()
+    flusher.join(10)
+    store.flush()
+    assert store.stats()['size'] <= 2
+    for user_id in range(700101, 700106):
+        assert store.get(user_id) == ('waiting_card', str(user_id))